@@ -0,0 +1,323 @@
+""" Load test the API against the mock controller.
+
+Starts the app from config.startup.app() with the mock MachinekitController on a local port, lets a number of
+clients run a mix of scenarios against it and reports throughput and p50/p95/p99 latency per route.
+Run it from the repository root:
+
+    python -m benchmarks.load --clients 10 --duration 30 --output bench_results.json
+    python -m benchmarks.load --baseline bench_results.json --output new.json
+
+The results are written as json so runs of different commits can be compared with --baseline. The output has to be
+another file than the baseline.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+import configparser
+from config.startup import app as create_app
+from config.components import start_components, stop_components
+from routes.files import files as files_route
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("default.ini")
+# Scenario weights per mix. floor is the shop floor: mostly status screens, one operator jogging and
+# dragging the override sliders, now and then someone browsing or uploading programs
+MIXES = {
+    "floor": [("status", 60), ("jog", 10), ("override", 15), ("files", 10),
+              ("upload", 5)],
+    "status": [("status", 100)],
+    "commands": [("jog", 50), ("override", 50)]
+}
+PROGRAM = "".join("G1 X%d Y%d F1000\n" % (i % 50, i % 30) for i in range(200))
+BOUNDARY = "benchmarkboundary"
+
+
+def percentile(ordered, percent):
+    """ Nearest rank percentile of a sorted list """
+    if not ordered:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+class Client(threading.Thread):
+    """ Runs scenarios back to back on one keep-alive connection until the deadline.
+    Every client keeps its own samples, they are only merged when the run is over """
+    def __init__(self, number, port, token, mix, started, warmup, deadline, think):
+        super(Client, self).__init__()
+        self.daemon = True
+        self.number = number
+        self.connection = HTTPConnection("127.0.0.1", port, timeout=30)
+        self.token = token
+        self.scenarios = [name for name, weight in mix for _ in range(weight)]
+        self.measure_from = started + warmup
+        self.deadline = deadline
+        self.think = think
+        self.random = random.Random(number)
+        self.samples = {}
+        self.etag = None
+        self.uploads = 0
+
+    def run(self):
+        while time.time() < self.deadline:
+            getattr(self, self.random.choice(self.scenarios))()
+            if self.think:
+                time.sleep(self.think)
+
+    def request(self, route, method, path, body=None, headers=None):
+        """ Send one request and record its latency under route. Returns the status and the response """
+        headers = dict(headers or {}, API_KEY=self.token)
+        if body is not None and "Content-Type" not in headers:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        started = time.time()
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            response.read()
+            status = response.status
+        except Exception:
+            self.connection.close()
+            response = None
+            status = 0
+        finished = time.time()
+        if started >= self.measure_from and finished <= self.deadline:
+            self.samples.setdefault(route, []).append((finished - started, status))
+        return status, response
+
+    def status(self):
+        """ A status screen: poll the vitals with the ETag of the last answer, then the position """
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        status, response = self.request("GET /machinekit/status", "GET",
+                                        "/machinekit/status", headers=headers)
+        if response is not None and response.getheader("ETag"):
+            self.etag = response.getheader("ETag")
+        self.request("GET /machinekit/position", "GET", "/machinekit/position")
+
+    def jog(self):
+        """ A burst of incremental moves like a held jog button """
+        axis = self.random.randint(0, 2)
+        direction = self.random.choice((-1, 1))
+        for _ in range(5):
+            self.request("POST /machinekit/position/manual", "POST",
+                         "/machinekit/position/manual",
+                         {"axes": axis, "speed": 10.0, "increment": direction})
+
+    def override(self):
+        """ Dragging the feed, spindle and max velocity sliders sends a value for every step """
+        for step in range(10):
+            self.request("POST /machinekit/feed", "POST", "/machinekit/feed",
+                         {"command": step / 10.0})
+        for step in range(5):
+            self.request("POST /machinekit/spindle/override", "POST",
+                         "/machinekit/spindle/override",
+                         {"command": step / 5.0})
+        self.request("POST /machinekit/maxvel", "POST", "/machinekit/maxvel",
+                     {"command": 3000.0})
+
+    def files(self):
+        """ Open the file browser """
+        self.request("GET /server/files", "GET", "/server/files")
+
+    def upload(self):
+        """ Upload a small program with a name nobody used before """
+        self.uploads += 1
+        name = "bench-%d-%d.ngc" % (self.number, self.uploads)
+        body = ("--%s\r\nContent-Disposition: form-data; name=\"file\"; filename=\"%s\"\r\n"
+                "Content-Type: application/octet-stream\r\n\r\n%s\r\n--%s--\r\n") % (
+                    BOUNDARY, name, PROGRAM, BOUNDARY)
+        self.request("POST /server/file_upload", "POST", "/server/file_upload",
+                     body.encode("utf-8"),
+                     {"Content-Type": "multipart/form-data; boundary=%s" % BOUNDARY})
+
+
+def bench_config(folder):
+    """ The server configuration with the mock controller, a scratch upload folder and no jog port """
+    config = configparser.ConfigParser()
+    config.read_dict(CONFIG)
+    config.set("server", "mock", "true")
+    config.set("server", "jog_port", "")
+    config.set("storage", "upload_folder", folder)
+    config.set("storage", "recording_folder", os.path.join(folder, ".recordings"))
+    return config
+
+
+def start_server(application, kind, threads):
+    """ Serve the app on a free local port. Returns the port, the server and the server name """
+    if kind == "cheroot":
+        try:
+            from cheroot.wsgi import Server
+        except ImportError:
+            print("cheroot is not installed, falling back to the threaded development server")
+            kind = "werkzeug"
+    if kind == "cheroot":
+        server = Server(("127.0.0.1", 0), application, numthreads=threads)
+        server.prepare()
+        port = server.bind_addr[1]
+        thread = threading.Thread(target=server.serve)
+    else:
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args):
+                pass
+
+        server = make_server("127.0.0.1", 0, application, threaded=True,
+                             request_handler=QuietHandler)
+        port = server.server_port
+        thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return port, server, kind
+
+
+def commit():
+    """ The commit the tree is at, with a + when it has uncommitted changes """
+    try:
+        with open(os.devnull, "w") as quiet:
+            head = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                           stderr=quiet).decode().strip()
+            dirty = subprocess.check_output(
+                ["git", "status", "--porcelain", "--untracked-files=no"], stderr=quiet)
+        return head + ("+" if dirty.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(clients, duration):
+    """ Merge the samples of all clients into throughput and latency percentiles per route """
+    merged = {}
+    for client in clients:
+        for route, samples in client.samples.items():
+            merged.setdefault(route, []).extend(samples)
+    routes = {}
+    total = 0
+    failed = 0
+    for route, samples in sorted(merged.items()):
+        latencies = sorted(latency for latency, _ in samples)
+        errors = sum(1 for _, status in samples if status == 0 or status >= 400)
+        statuses = {}
+        for _, status in samples:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        routes[route] = {
+            "requests": len(samples),
+            "errors": errors,
+            "statuses": statuses,
+            "throughput": round(len(samples) / duration, 2),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "max_ms": round(latencies[-1] * 1000, 3)
+        }
+        total += len(samples)
+        failed += errors
+    return {
+        "requests": total,
+        "errors": failed,
+        "throughput": round(total / duration, 2)
+    }, routes
+
+
+def report(result, baseline=None):
+    """ Print the routes as table, with the change against a baseline run when given """
+    print("%-36s %9s %8s %9s %9s %9s %7s" % ("route", "req/s", "errors", "p50 ms",
+                                             "p95 ms", "p99 ms", "p95 +/-"))
+    for route, stats in sorted(result["routes"].items()):
+        change = ""
+        before = (baseline or {}).get("routes", {}).get(route)
+        if before and before["p95_ms"]:
+            change = "%+.0f%%" % ((stats["p95_ms"] / before["p95_ms"] - 1) * 100)
+        print("%-36s %9.1f %8d %9.2f %9.2f %9.2f %7s" % (
+            route, stats["throughput"], stats["errors"], stats["p50_ms"],
+            stats["p95_ms"], stats["p99_ms"], change))
+    total = result["total"]
+    line = "total: %d requests, %.1f req/s, %d errors" % (
+        total["requests"], total["throughput"], total["errors"])
+    if baseline:
+        line += " (baseline %s: %.1f req/s)" % (baseline.get("commit"),
+                                                 baseline["total"]["throughput"])
+    print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the API against the mock controller")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds before measuring")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="floor")
+    parser.add_argument("--think", type=float, default=0,
+                        help="seconds a client waits between scenarios")
+    parser.add_argument("--server", choices=("cheroot", "werkzeug"), default="cheroot")
+    parser.add_argument("--threads", type=int, default=int(CONFIG['server']['threads']))
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        if os.path.realpath(args.baseline) == os.path.realpath(args.output):
+            parser.error("--output would overwrite the --baseline results, pass another --output")
+        with open(args.baseline) as previous:
+            baseline = json.load(previous)
+
+    folder = tempfile.mkdtemp(prefix="webui-bench-")
+    try:
+        files_route.CONFIG.set("storage", "upload_folder", folder)
+        start_components(bench_config(folder))
+        port, server, kind = start_server(create_app(), args.server, args.threads)
+        started = time.time()
+        deadline = started + args.warmup + args.duration
+        clients = [
+            Client(number, port, CONFIG['security']['token'], MIXES[args.mix],
+                   started, args.warmup, deadline, args.think)
+            for number in range(args.clients)
+        ]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        if kind == "cheroot":
+            server.stop()
+        else:
+            server.shutdown()
+        stop_components()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    total, routes = summarize(clients, args.duration)
+    result = {
+        "commit": commit(),
+        "time": started,
+        "python": platform.python_version(),
+        "server": kind,
+        "threads": args.threads if kind == "cheroot" else None,
+        "clients": args.clients,
+        "mix": args.mix,
+        "duration": args.duration,
+        "think": args.think,
+        "total": total,
+        "routes": routes
+    }
+    with open(args.output, "w") as output:
+        json.dump(result, output, indent=2, sort_keys=True)
+    report(result, baseline)
+    return 1 if total["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import os
+import re
+import glob
+import time
+import uuid
+import hashlib
+import threading
+
+UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+CHUNK_SIZE = 64 * 1024
+UNKNOWN_SIZE = "unknown"
+
+
+class Upload(object):
+    """ A chunked upload in progress. The data is appended to a hidden part file in the upload folder """
+    def __init__(self, upload_id, name, path, size=None):
+        self.id = upload_id
+        self.name = name
+        self.path = path
+        self.size = size
+        self.offset = 0
+        self.sha256 = hashlib.sha256()
+        self.lock = threading.Lock()
+
+    def append(self, stream):
+        """ Copy the stream to the end of the part file with constant memory. Returns the new offset.
+        Raises ValueError before writing past the announced size, the data up to there is kept """
+        with open(self.path, "ab") as part:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if self.size is not None and self.offset + len(chunk) > self.size:
+                    raise ValueError(self.offset)
+                part.write(chunk)
+                self.sha256.update(chunk)
+                self.offset += len(chunk)
+        return self.offset
+
+    def rehash(self):
+        """ Rebuild the offset and checksum from the data already in the part file """
+        with open(self.path, "rb") as part:
+            while True:
+                chunk = part.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.sha256.update(chunk)
+                self.offset += len(chunk)
+
+    def as_dict(self):
+        """ Return the upload as dict """
+        return {
+            "upload_id": self.id,
+            "name": self.name,
+            "offset": self.offset,
+            "size": self.size
+        }
+
+
+class UploadManager(object):
+    """ Keeps track of the chunked uploads. Uploads survive a restart because they can be recovered from their part file """
+    def __init__(self, folder, max_age=None):
+        self.folder = folder
+        self.uploads = {}
+        self.lock = threading.Lock()
+        if max_age is not None:
+            self.expire(max_age)
+
+    def part_path(self, upload_id, name, size=None):
+        """ Hidden part files are ignored by the file catalog. The announced size is part of the name """
+        return os.path.join(self.folder, ".upload-%s-%s-%s.part" % (
+            upload_id, UNKNOWN_SIZE if size is None else size, name))
+
+    def expire(self, max_age):
+        """ Remove part files that haven't been written to for max_age seconds """
+        for path in glob.glob(os.path.join(self.folder, ".upload-*.part")):
+            try:
+                if time.time() - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def create(self, name, size=None):
+        """ Start a new upload with an empty part file """
+        upload_id = uuid.uuid4().hex
+        upload = Upload(upload_id, name, self.part_path(upload_id, name, size), size)
+        open(upload.path, "wb").close()
+        with self.lock:
+            self.uploads[upload_id] = upload
+        return upload
+
+    def get(self, upload_id):
+        """ Return an upload by id or None. Unknown uploads are recovered from their part file """
+        if not UPLOAD_ID.match(upload_id):
+            return None
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                upload = self.recover(upload_id)
+            return upload
+
+    def recover(self, upload_id):
+        """ Rebuild an upload from its part file after a restart """
+        prefix = os.path.join(self.folder, ".upload-%s-" % upload_id)
+        paths = glob.glob(prefix + "*.part")
+        if not paths:
+            return None
+
+        path = paths[0]
+        size, name = path[len(prefix):-len(".part")].split("-", 1)
+        upload = Upload(upload_id, name, path,
+                        None if size == UNKNOWN_SIZE else int(size))
+        upload.rehash()
+        self.uploads[upload_id] = upload
+        return upload
+
+    def finish(self, upload):
+        """ Move the finished part file to its final name """
+        with self.lock:
+            self.uploads.pop(upload.id, None)
+        path = os.path.join(self.folder, upload.name)
+        os.rename(upload.path, path)
+        return path
+
+    def discard(self, upload):
+        """ Cancel an upload and remove its part file """
+        with self.lock:
+            self.uploads.pop(upload.id, None)
+        if os.path.exists(upload.path):
+            os.remove(upload.path)
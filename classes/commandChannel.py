@@ -0,0 +1,24 @@
+from classes.metrics import timed
+
+
+class CommandChannel(object):
+    """ Wraps a linuxcnc command channel. Every call tells the controller that its stat snapshot is stale,
+    because sending a command is the only way the controller itself changes the machine state.
+    Calls are timed per method, so command.mode and command.wait_complete show up in /metrics """
+    def __init__(self, command, on_command):
+        self.command = command
+        self.on_command = on_command
+
+    def __getattr__(self, name):
+        func = getattr(self.command, name)
+        label = "command." + name
+
+        def call(*args):
+            try:
+                with timed(label):
+                    return func(*args)
+            finally:
+                self.on_command()
+
+        call.__name__ = name
+        return call
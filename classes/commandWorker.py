@@ -0,0 +1,112 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from classes import tracing
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+class Job(object):
+    """ A controller command that is queued on the command worker """
+    def __init__(self, func, args):
+        self.id = uuid.uuid4().hex
+        self.command = func.__name__
+        self.func = func
+        self.args = args
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+        # Stages of the command are added to the trace of the request that submitted it
+        self.trace = tracing.current()
+
+    def execute(self):
+        """ Run the command and store its result or the error it raised """
+        self.status = "running"
+        previous = tracing.current()
+        tracing.activate(self.trace)
+        tracing.record("queue", time.time() - self.created)
+        try:
+            self.result = self.func(*self.args)
+            self.status = "done"
+        except Exception as err:
+            self.error = err
+            self.status = "failed"
+        finally:
+            tracing.activate(previous)
+            self.finished = time.time()
+            self.done.set()
+
+    def wait(self, timeout=None):
+        """ Block until the command has been executed """
+        return self.done.wait(timeout)
+
+    def as_dict(self):
+        """ Return the job as dict. Errors are formatted like the errors decorator does """
+        job = {
+            "id": self.id,
+            "command": self.command,
+            "status": self.status,
+            "created": self.created,
+            "finished": self.finished
+        }
+        if self.result is not None:
+            job["result"] = self.result
+        if self.error is not None:
+            if len(self.error.args) == 3:
+                message, status, err_type = self.error.args
+            else:
+                message, status, err_type = str(self.error), 500, "InternalServerError"
+            job["errors"] = {
+                "message": message,
+                "status": status,
+                "type": err_type
+            }
+        return job
+
+
+class CommandWorker(threading.Thread):
+    """ Single worker thread that executes controller commands in the order they were submitted """
+    def __init__(self, history=100):
+        super(CommandWorker, self).__init__()
+        self.daemon = True
+        self.queue = Queue()
+        self.jobs = OrderedDict()
+        self.history = history
+        self.lock = threading.Lock()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            job.execute()
+
+    def submit(self, func, *args):
+        """ Queue a command. Runs it inline when the worker thread isn't running """
+        job = Job(func, args)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.evict()
+
+        if self.is_alive():
+            self.queue.put(job)
+        else:
+            job.execute()
+        return job
+
+    def evict(self):
+        """ Forget the oldest finished jobs above history. Queued and running jobs are always kept """
+        excess = len(self.jobs) - self.history
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.done.is_set()][:excess]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        """ Return the job with the given id or None when it is unknown or expired """
+        return self.jobs.get(job_id)
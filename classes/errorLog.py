@@ -0,0 +1,61 @@
+import time
+import threading
+from collections import deque, namedtuple
+from classes.metrics import timed
+
+ErrorRecord = namedtuple("ErrorRecord", ["seq", "kind", "type", "text", "timestamp"])
+
+
+class ErrorLog(threading.Thread):
+    """ Bounded ring buffer of error channel messages, filled by a background drain.
+    Only the drain appends records, readers copy the buffer without locking """
+    def __init__(self, channel, error_kinds, size=200, interval=0.1):
+        super(ErrorLog, self).__init__()
+        self.daemon = True
+        self.channel = channel
+        self.error_kinds = error_kinds
+        self.records = deque(maxlen=size)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.draining = False
+        self.last_seq = 0
+
+    def run(self):
+        """ Keep draining the error channel so errors raised during a program aren't lost """
+        self.draining = True
+        while self.draining:
+            try:
+                self.drain()
+            except Exception:
+                pass
+            time.sleep(self.interval)
+
+    def stop(self):
+        """ Stop the drain after the current cycle """
+        self.draining = False
+
+    def drain(self):
+        """ Move every pending message from the error channel into the ring buffer """
+        with self.lock:
+            error = self.poll()
+            while error:
+                kind, text = error
+                typus = "error" if kind in self.error_kinds else "info"
+                self.records.append(
+                    ErrorRecord(self.last_seq + 1, kind, typus, text,
+                                time.time()))
+                self.last_seq += 1
+                error = self.poll()
+
+    def poll(self):
+        with timed("error_channel.poll"):
+            return self.channel.poll()
+
+    def since(self, seq):
+        """ Return all buffered records with a sequence number higher than seq """
+        if not self.is_alive():
+            self.drain()
+        records = tuple(self.records)
+        if not records:
+            return records
+        return records[max(seq - records[0].seq + 1, 0):]
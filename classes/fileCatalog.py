@@ -0,0 +1,141 @@
+import os
+import time
+import threading
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+WATCH_FLAGS = 0
+if INotify is not None:
+    WATCH_FLAGS = (flags.CREATE | flags.DELETE | flags.CLOSE_WRITE
+                   | flags.MOVED_FROM | flags.MOVED_TO)
+
+
+class FileCatalog(threading.Thread):
+    """ In memory catalog of the upload folder. Seeded with one scan and then kept up to date
+    from inotify events, or by rescanning when the folder mtime changes if inotify isn't available.
+    Writers swap in new dicts so readers never need a lock """
+    def __init__(self, folder, interval=2):
+        super(FileCatalog, self).__init__()
+        self.daemon = True
+        self.folder = folder
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.listing = []
+        self.version = 0
+        self.epoch = "%x" % int(time.time() * 1000)
+        self.folder_mtime = None
+        self.watching = False
+        self.subscribers = []
+        self.scan()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def subscribe(self, callback):
+        """ Call callback with the entries by name now and after every change """
+        self.subscribers.append(callback)
+        callback(self.entries)
+
+    def get(self, name):
+        """ Return the catalog entry of a file or None """
+        return self.entries.get(name)
+
+    def files(self):
+        """ Return [name, path] of every file, sorted by name. Rescans on demand when the watcher isn't running """
+        if not self.is_alive():
+            self.scan_if_changed()
+        return self.listing
+
+    def entry(self, name):
+        """ Stat a file in the upload folder. Returns None for hidden files, folders and missing files """
+        if name.startswith("."):
+            return None
+        path = os.path.join(self.folder, name)
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        return {
+            "name": name,
+            "path": self.folder,
+            "size": info.st_size,
+            "mtime": info.st_mtime
+        }
+
+    def publish(self, entries):
+        """ Swap in a new set of entries and bump the version """
+        self.entries = entries
+        self.listing = [[name, entries[name]["path"]]
+                        for name in sorted(entries)]
+        self.version += 1
+        for callback in self.subscribers:
+            callback(entries)
+
+    def scan(self):
+        """ Read the complete upload folder """
+        with self.lock:
+            try:
+                self.folder_mtime = os.stat(self.folder).st_mtime
+                names = os.listdir(self.folder)
+            except OSError:
+                names = []
+            entries = {}
+            for name in names:
+                entry = self.entry(name)
+                if entry is not None:
+                    entries[name] = entry
+            if entries != self.entries or not self.version:
+                self.publish(entries)
+
+    def scan_if_changed(self):
+        """ Rescan when files were added, removed or renamed since the last scan """
+        try:
+            mtime = os.stat(self.folder).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self.folder_mtime:
+            self.scan()
+
+    def update(self, name):
+        """ Refresh a single file after it was created, changed, moved or deleted """
+        with self.lock:
+            entry = self.entry(name)
+            if entry == self.entries.get(name):
+                return
+            entries = dict(self.entries)
+            if entry is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = entry
+            self.publish(entries)
+
+    def run(self):
+        self.watching = True
+        if INotify is not None:
+            try:
+                self.watch()
+                return
+            except OSError:
+                pass
+        while self.watching:
+            self.scan_if_changed()
+            time.sleep(self.interval)
+
+    def watch(self):
+        """ Follow inotify events of the upload folder """
+        inotify = INotify()
+        inotify.add_watch(self.folder, WATCH_FLAGS)
+        self.scan()
+        while self.watching:
+            for event in inotify.read(timeout=int(self.interval * 1000)):
+                if event.name:
+                    self.update(event.name)
+
+    def stop(self):
+        """ Stop watching the upload folder """
+        self.watching = False
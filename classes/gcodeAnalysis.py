@@ -0,0 +1,406 @@
+import os
+import re
+import json
+import math
+import hashlib
+import threading
+import multiprocessing
+
+WORD = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+COMMENT = re.compile(r"\([^)]*\)|;.*")
+AXES = "XYZABCUVW"
+LINEAR_AXES = "XYZ"
+# These G-codes take axis words that aren't a move of the toolpath
+NON_MOTION = (10, 28, 30, 92)
+# Axes of the arc planes of G17, G18 and G19 in tenths as (first, second, normal).
+# Arcs turn counterclockwise from the first to the second axis seen from the normal
+PLANES = {170: ("X", "Y", "Z"), 180: ("Z", "X", "Y"), 190: ("Y", "Z", "X")}
+ARC_OFFSETS = {"X": "I", "Y": "J", "Z": "K"}
+CANNED_CYCLES = (73, 76, 81, 82, 83, 84, 85, 86, 87, 88, 89)
+# Canned cycles that feed back out of the hole instead of retracting with a rapid
+FEED_RETRACT = (84, 85, 89)
+HASH_CHUNK = 64 * 1024
+
+
+def file_hash(path):
+    """ Return the sha1 of a file """
+    digest = hashlib.sha1()
+    with open(path, "rb") as gcode:
+        while True:
+            chunk = gcode.read(HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def move_time(distance, velocity, acceleration):
+    """ Time of a trapezoidal move that starts and ends at rest """
+    if distance <= 0 or velocity <= 0:
+        return 0.0
+    if acceleration <= 0:
+        return distance / velocity
+    if distance < velocity * velocity / acceleration:
+        return 2 * math.sqrt(distance / acceleration)
+    return distance / velocity + velocity / acceleration
+
+
+def arc_geometry(start, target, arc, clockwise):
+    """ Center, radius, start angle and sweep of a G2/G3 arc in its plane """
+    first, second = arc["plane"][:2]
+    center_first, center_second = arc["center"]
+    radius = math.hypot(start[first] - center_first, start[second] - center_second)
+    begin = math.atan2(start[second] - center_second, start[first] - center_first)
+    end = math.atan2(target[second] - center_second, target[first] - center_first)
+    sweep = begin - end if clockwise else end - begin
+    if sweep <= 1e-9:
+        sweep += 2 * math.pi
+    return center_first, center_second, radius, begin, sweep
+
+
+def arc_length(start, target, arc, clockwise):
+    """ Length of a G2/G3 arc, including the helical part along the normal of its plane """
+    radius, begin, sweep = arc_geometry(start, target, arc, clockwise)[2:]
+    normal = arc["plane"][2]
+    return math.hypot(radius * sweep, target[normal] - start[normal])
+
+
+def radius_center(start, target, radius, clockwise, plane):
+    """ Center of an arc given with R. A positive radius takes the short way round, a negative one the long way """
+    first, second = plane[:2]
+    delta_first = target[first] - start[first]
+    delta_second = target[second] - start[second]
+    chord = math.hypot(delta_first, delta_second)
+    if chord == 0:
+        raise ValueError("Arc with R ends where it starts")
+    height = math.sqrt(max(radius * radius - chord * chord / 4, 0.0))
+    side = height / chord if clockwise == (radius > 0) else -height / chord
+    return (start[first] + delta_first / 2 + side * delta_second,
+            start[second] + delta_second / 2 - side * delta_first)
+
+
+def unit_scale(units, linear_units):
+    """ Factor that converts program units to machine units """
+    if units == "inch" and linear_units in ("mm", "metric"):
+        return 25.4
+    if units == "mm" and linear_units in ("inch", "imperial"):
+        return 1 / 25.4
+    return 1.0
+
+
+class GcodeReader(object):
+    """ Reads a G-code file line by line and yields its moves. Keeps the modal state while reading """
+    def __init__(self, gcode):
+        self.gcode = gcode
+        self.lines = 0
+        self.units = None
+        self.tools = set()
+        self.feed = 0.0
+        self.motion = 0
+        self.absolute = True
+        self.arc_absolute = False
+        self.plane = PLANES[170]
+        self.retract_initial = True
+        # Sticky R and Z words and the height the running canned cycle started at
+        self.cycle = {}
+
+    def moves(self):
+        """ Yield (motion, start, target, arc, named axes) for every move of the tool. Motion is 0 for rapids,
+        1 for feeds and 2 or 3 for arcs, which get their plane and center in arc. Canned cycles are split up """
+        position = dict.fromkeys(AXES, 0.0)
+        for raw in self.gcode:
+            self.lines += 1
+            words = WORD.findall(COMMENT.sub("", raw.decode("latin-1")).upper())
+            if not words:
+                continue
+
+            axes = {}
+            params = {}
+            non_motion = False
+            for letter, value in words:
+                number = float(value)
+                if letter == "G":
+                    # In tenths, so G91.1 isn't taken for G91
+                    non_motion = self.modal(int(round(number * 10))) or non_motion
+                elif letter == "T":
+                    self.tools.add(int(number))
+                elif letter == "F":
+                    self.feed = number
+                elif letter in AXES:
+                    axes[letter] = number
+                else:
+                    params[letter] = number
+
+            if not axes or non_motion or self.motion is None:
+                continue
+            if self.motion in CANNED_CYCLES:
+                moves = self.canned_cycle(position, axes, params)
+            else:
+                moves = [self.move(position, axes, params)]
+            for move in moves:
+                yield move
+                position = move[2]
+
+    def modal(self, code):
+        """ Apply a G-code given in tenths. Returns True when the axis words of the line aren't a move """
+        if code in (0, 10, 20, 30):
+            self.motion = code // 10
+        elif code % 10 == 0 and code // 10 in CANNED_CYCLES:
+            if self.motion not in CANNED_CYCLES:
+                self.cycle = {}
+            self.motion = code // 10
+        elif code == 800:
+            self.motion = None
+        elif code in PLANES:
+            self.plane = PLANES[code]
+        elif code == 200:
+            self.units = "inch"
+        elif code == 210:
+            self.units = "mm"
+        elif code == 900:
+            self.absolute = True
+        elif code == 910:
+            self.absolute = False
+        elif code == 901:
+            self.arc_absolute = True
+        elif code == 911:
+            self.arc_absolute = False
+        elif code == 980:
+            self.retract_initial = True
+        elif code == 990:
+            self.retract_initial = False
+        elif code // 10 in NON_MOTION:
+            return True
+        return False
+
+    def move(self, position, axes, params):
+        """ A straight move or an arc to the axis words of a line """
+        target = dict(position)
+        for axis, value in axes.items():
+            target[axis] = value if self.absolute else position[axis] + value
+        arc = None
+        if self.motion in (2, 3):
+            if "R" in params:
+                center = radius_center(position, target, params["R"],
+                                       self.motion == 2, self.plane)
+            else:
+                center = tuple(params.get(ARC_OFFSETS[axis], 0.0) +
+                               (0.0 if self.arc_absolute else position[axis])
+                               for axis in self.plane[:2])
+            arc = {"plane": self.plane, "center": center}
+        return self.motion, position, target, arc, set(axes)
+
+    def canned_cycle(self, position, axes, params):
+        """ Split a canned cycle into its moves: over the hole, down to R, feed to Z and back out to the initial
+        height (G98) or R (G99), L times. Pecks and dwells aren't modelled, G76 threading is one pass and back """
+        if self.motion == 76:
+            end = self.move(position, axes, params)[2]
+            return [(1, position, end, None, set(axes)),
+                    (0, end, position, None, set(axes))]
+
+        self.cycle.setdefault("clear", position["Z"])
+        if "Z" in axes:
+            self.cycle["Z"] = axes["Z"]
+        if "R" in params:
+            self.cycle["R"] = params["R"]
+        if "Z" not in self.cycle or "R" not in self.cycle:
+            raise ValueError("Canned cycle G%d without R or Z" % self.motion)
+        if self.absolute:
+            retract = self.cycle["R"]
+            bottom = self.cycle["Z"]
+        else:
+            retract = position["Z"] + self.cycle["R"]
+            bottom = retract + self.cycle["Z"]
+        clear = max(self.cycle["clear"], retract) if self.retract_initial else retract
+
+        moves = []
+        current = position
+        for repeat in range(int(params.get("L", 1))):
+            hole = {}
+            for axis in ("X", "Y"):
+                hole[axis] = current[axis]
+                if axis in axes:
+                    hole[axis] = axes[axis] if self.absolute else current[axis] + axes[axis]
+            steps = [(0, {"Z": max(current["Z"], retract)}), (0, hole),
+                     (0, {"Z": retract}), (1, {"Z": bottom}),
+                     (1 if self.motion in FEED_RETRACT else 0, {"Z": clear})]
+            for motion, change in steps:
+                target = dict(current, **change)
+                if target != current:
+                    moves.append((motion, current, target, None, set(change)))
+                    current = target
+        return moves
+
+
+def analyse_file(path, max_velocity, max_acceleration, linear_units):
+    """ Parse a G-code file and return line count, units, tools, bounding box, distances, the estimated cycle time
+    and the line of the last move.
+    Runs in a worker process so it only takes plain values """
+    try:
+        max_velocity = float(max_velocity)
+        max_acceleration = float(max_acceleration)
+        bounds = {}
+        cut = 0.0
+        rapid = 0.0
+        cycle_time = 0.0
+        last_line = 0
+
+        with open(path, "rb") as gcode:
+            reader = GcodeReader(gcode)
+            for motion, start, target, arc, named in reader.moves():
+                last_line = reader.lines
+                if motion in (2, 3):
+                    distance = arc_length(start, target, arc, motion == 2)
+                else:
+                    distance = math.sqrt(
+                        sum((target[axis] - start[axis])**2
+                            for axis in LINEAR_AXES))
+
+                scale = unit_scale(reader.units, linear_units)
+                if motion == 0:
+                    rapid += distance
+                    velocity = max_velocity
+                else:
+                    cut += distance
+                    velocity = min(reader.feed * scale / 60., max_velocity)
+                cycle_time += move_time(distance * scale, velocity,
+                                        max_acceleration)
+
+                for axis in AXES:
+                    if axis in named or axis in bounds:
+                        low, high = bounds.get(axis, (target[axis], target[axis]))
+                        bounds[axis] = (min(low, target[axis]),
+                                        max(high, target[axis]))
+
+        return {
+            "lines": reader.lines,
+            "units": reader.units,
+            "tools": sorted(reader.tools),
+            "bounds": dict((axis.lower(), [round(low, 3), round(high, 3)])
+                           for axis, (low, high) in bounds.items()),
+            "cut_distance": round(cut, 3),
+            "rapid_distance": round(rapid, 3),
+            "cycle_time": round(cycle_time, 1),
+            "last_line": last_line
+        }
+    except Exception as err:
+        return {"errors": str(err)}
+
+
+def hash_file(path):
+    """ Hash a file in a worker process. Returns None when the file can't be read """
+    try:
+        return file_hash(path)
+    except (IOError, OSError):
+        return None
+
+
+class GcodeAnalyzer(object):
+    """ Analyses the files in the upload folder off the request path with a process pool.
+    Results are cached by content hash in a hidden json file, so unchanged files are never parsed twice """
+    def __init__(self, folder, max_velocity, max_acceleration, linear_units="mm"):
+        self.folder = folder
+        self.params = (float(max_velocity), float(max_acceleration),
+                       linear_units)
+        self.cache_path = os.path.join(folder, ".analysis.json")
+        self.lock = threading.Lock()
+        self.pool = None
+        # results by content hash, files by name: {"size", "mtime", "hash"}
+        self.results = {}
+        self.files = {}
+        self.pending = 0
+        self.version = 0
+        self.load()
+
+    def start(self, processes=None):
+        """ Start the process pool, defaults to one process per core """
+        self.pool = multiprocessing.Pool(processes)
+
+    def load(self):
+        """ Read the cache of an earlier run """
+        try:
+            with open(self.cache_path) as cache:
+                data = json.load(cache)
+            self.results = data["results"]
+            self.files = data["files"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        """ Write the cache next to the files. Results of files that are gone are dropped """
+        with self.lock:
+            hashes = set(info["hash"] for info in self.files.values())
+            self.results = dict((digest, result)
+                                for digest, result in self.results.items()
+                                if digest in hashes)
+            data = json.dumps({"results": self.results, "files": self.files})
+        try:
+            with open(self.cache_path, "w") as cache:
+                cache.write(data)
+        except (IOError, OSError):
+            pass
+
+    def result(self, name):
+        """ Return the analysis of a file, or its status while it is being analysed """
+        info = self.files.get(name)
+        if info is not None and "errors" in info:
+            return {"errors": info["errors"]}
+        if info is None or info.get("hash") is None:
+            return {"status": "pending"}
+        return self.results.get(info["hash"], {"status": "pending"})
+
+    def sync(self, entries):
+        """ Analyse every catalog entry that is new or changed since it was last seen. Takes the catalog entries by name """
+        for name in list(self.files):
+            if name not in entries:
+                with self.lock:
+                    self.files.pop(name, None)
+                    self.version += 1
+
+        for name, entry in entries.items():
+            info = self.files.get(name)
+            if info and info["size"] == entry["size"] and info["mtime"] == entry["mtime"]:
+                continue
+            with self.lock:
+                self.files[name] = {
+                    "size": entry["size"],
+                    "mtime": entry["mtime"],
+                    "hash": None
+                }
+                self.pending += 1
+            path = os.path.join(self.folder, name)
+            self.run(hash_file, (path, ),
+                     lambda digest, name=name, path=path: self.hashed(name, path, digest))
+
+    def run(self, func, args, callback):
+        """ Run on the process pool, or inline when the pool isn't started """
+        if self.pool is None:
+            callback(func(*args))
+        else:
+            self.pool.apply_async(func, args, callback=callback)
+
+    def hashed(self, name, path, digest):
+        """ Only files with unknown contents are parsed. A file that can't be read gets an error instead """
+        if digest is None:
+            self.analysed(name, None, {"errors": "File could not be read"})
+            return
+        if digest not in self.results:
+            self.run(analyse_file, (path, ) + self.params,
+                     lambda result: self.analysed(name, digest, result))
+            return
+        self.analysed(name, digest, None)
+
+    def analysed(self, name, digest, result):
+        """ Store the result of a file """
+        with self.lock:
+            if digest is not None and result is not None:
+                self.results[digest] = result
+            if name in self.files:
+                self.files[name]["hash"] = digest
+                if digest is None:
+                    self.files[name]["errors"] = result["errors"]
+            self.pending -= 1
+            self.version += 1
+            done = self.pending == 0
+        if done:
+            self.save()
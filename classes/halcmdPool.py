@@ -0,0 +1,166 @@
+import time
+import threading
+import subprocess
+from classes.metrics import timed, observe_call
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+class HalcmdSession(object):
+    """ Long running halcmd process that reads commands from stdin in keep-going mode.
+    stdout and stderr are merged and line buffered so the output stays in order """
+    def __init__(self, binary="halcmd"):
+        self.process = subprocess.Popen(
+            ["stdbuf", "-oL", "-eL", binary, "-k", "-f"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            bufsize=1)
+        self.lines = Queue()
+        self.markers = 0
+        self.reader = threading.Thread(target=self.read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read(self):
+        """ Move the output of halcmd into the line queue. None marks the end of the process """
+        for line in iter(self.process.stdout.readline, ""):
+            self.lines.put(line)
+        self.lines.put(None)
+
+    def alive(self):
+        """ Return if the halcmd process is still running """
+        return self.process.poll() is None
+
+    def send(self, commands):
+        """ Write commands to halcmd without waiting for their output. Returns the end marker of each command.
+        A getp of a pin that doesn't exist marks the end of the output """
+        markers = []
+        lines = []
+        for command in commands:
+            self.markers += 1
+            marker = "webui.end-of-output.%d.done" % self.markers
+            markers.append(marker)
+            lines.append("%s\ngetp %s\n" % (command, marker))
+        self.process.stdin.write("".join(lines))
+        self.process.stdin.flush()
+        return markers
+
+    def execute(self, command, timeout):
+        """ Send one command and yield its output lines """
+        marker = self.send([command])[0]
+        return self.output(marker, timeout)
+
+    def output(self, marker, timeout):
+        """ Yield output lines until the given end marker. halcmd may stay silent for at most timeout seconds """
+        while True:
+            try:
+                line = self.lines.get(timeout=timeout)
+            except Empty:
+                raise RuntimeError("halcmd did not respond within %s seconds" % timeout,
+                                   504, "RuntimeError")
+            if line is None:
+                raise RuntimeError("halcmd exited unexpectedly", 502,
+                                   "RuntimeError")
+            if marker in line:
+                return
+            yield line
+
+    def close(self):
+        """ Stop the halcmd process """
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class HalcmdPool(object):
+    """ Small pool of halcmd sessions. Sessions are started on demand and reused between requests """
+    def __init__(self, size=2, timeout=5):
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Wait for a free slot and return an idle session or start a new one """
+        self.slots.acquire()
+        try:
+            with self.lock:
+                while self.idle:
+                    session = self.idle.pop()
+                    if session.alive():
+                        return session
+                    session.close()
+            return HalcmdSession()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, session, healthy=True):
+        """ Return a session to the pool. Sessions with unread output or a dead process are closed """
+        if healthy and session.alive():
+            with self.lock:
+                self.idle.append(session)
+        else:
+            session.close()
+        self.slots.release()
+
+    def stream(self, command, timeout=None):
+        """ Run a command and yield the output lines as halcmd produces them. Only the time spent waiting for halcmd
+        is observed, not the time the caller takes between lines """
+        self.check(command)
+        session = self.acquire()
+        finished = False
+        waited = 0.0
+        try:
+            lines = session.execute(command, timeout or self.timeout)
+            while True:
+                started = time.time()
+                line = next(lines, None)
+                waited += time.time() - started
+                if line is None:
+                    break
+                yield line
+            finished = True
+        finally:
+            observe_call("halcmd", waited)
+            self.release(session, finished)
+
+    def execute(self, command, timeout=None):
+        """ Run a command and return the complete output """
+        return "".join(self.stream(command, timeout))
+
+    def execute_many(self, commands, timeout=None):
+        """ Run a list of commands on one session. All commands are written at once, returns a list of outputs """
+        for command in commands:
+            self.check(command)
+
+        session = self.acquire()
+        finished = False
+        try:
+            with timed("halcmd"):
+                markers = session.send(commands)
+                outputs = [
+                    "".join(session.output(marker, timeout or self.timeout))
+                    for marker in markers
+                ]
+            finished = True
+            return outputs
+        finally:
+            self.release(session, finished)
+
+    @staticmethod
+    def check(command):
+        """ A newline would smuggle a second command into the session """
+        if "\n" in command or "\r" in command:
+            raise ValueError("Not allowed to chain multiple commands", 400,
+                             "ValueError")
+
+    def close(self):
+        """ Stop all idle sessions """
+        with self.lock:
+            while self.idle:
+                self.idle.pop().close()
@@ -0,0 +1,260 @@
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+import threading
+from werkzeug.utils import secure_filename
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"WUIREC01"
+# magic, header size, record size, capacity, record count
+HEADER = struct.Struct("<8sIIIQ")
+HEADER_SIZE = 1024
+COUNT_OFFSET = 20
+COUNT = struct.Struct("<Q")
+EXTENSION = ".rec"
+FLUSH_INTERVAL = 5
+INTERP_STATES = ["INTERP_IDLE", "INTERP_READING", "INTERP_PAUSED", "INTERP_WAITING"]
+TASK_MODES = ["MODE_MANUAL", "MODE_AUTO", "MODE_MDI"]
+# Bits of the flags field
+ENABLED = 1
+ESTOP = 2
+SPINDLE_ENABLED = 4
+SPINDLE_BRAKE = 8
+LOG = logging.getLogger("webui.recorder")
+
+
+def record_fields(axes):
+    """ Name and struct code of every field of a record, in file order """
+    return [("time", "d")] + [(axis, "d") for axis in axes] + [
+        ("spindle_speed", "d"), ("spindlerate", "d"), ("feedrate", "d"),
+        ("velocity", "d"), ("current_line", "i"), ("motion_line", "i"),
+        ("interp_state", "B"), ("task_mode", "B"), ("spindle_direction", "b"),
+        ("flags", "B")
+    ]
+
+
+def record_struct(axes):
+    """ The packed little endian layout of one record """
+    return struct.Struct("<" + "".join(code for _, code in record_fields(axes)))
+
+
+def record_dtype(axes):
+    """ The NumPy structured dtype of one record, same layout as record_struct """
+    return numpy.dtype([(name, "<" + code) for name, code in record_fields(axes)])
+
+
+def read_header(path):
+    """ Return the header of a recording as dict. Raises ValueError when the file isn't a recording """
+    with open(path, "rb") as recording:
+        head = recording.read(HEADER_SIZE)
+    if len(head) < HEADER.size:
+        raise ValueError(path)
+    magic, header_size, record_size, capacity, count = HEADER.unpack_from(head)
+    if magic != MAGIC:
+        raise ValueError(path)
+    header = json.loads(head[HEADER.size:header_size].rstrip(b"\0").decode("utf-8"))
+    header.update({
+        "header_size": header_size,
+        "record_size": record_size,
+        "capacity": capacity,
+        "records": count
+    })
+    return header
+
+
+def read_recording(path):
+    """ Open a recording as a read only NumPy structured array, one row per record. The array maps the file,
+    nothing is copied until it is used. Records written after opening aren't included """
+    header = read_header(path)
+    dtype = record_dtype(header["axes"])
+    if header["records"] == 0:
+        return header, numpy.zeros(0, dtype=dtype)
+    return header, numpy.memmap(path, dtype=dtype, mode="r",
+                                offset=header["header_size"],
+                                shape=(header["records"], ))
+
+
+class Recording(object):
+    """ One preallocated, memory mapped segment. Records are packed into the map and the record count in the
+    header is updated after each one, so readers never see a half written record """
+    def __init__(self, path, axes, capacity, meta):
+        self.path = path
+        self.record = record_struct(axes)
+        self.capacity = capacity
+        self.count = 0
+        meta = json.dumps(dict(meta, axes=list(axes))).encode("utf-8")
+        if HEADER.size + len(meta) > HEADER_SIZE:
+            raise ValueError("Recording header too long")
+        self.file = open(path, "w+b")
+        self.file.truncate(HEADER_SIZE + capacity * self.record.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        HEADER.pack_into(self.map, 0, MAGIC, HEADER_SIZE, self.record.size,
+                         capacity, 0)
+        self.map[HEADER.size:HEADER.size + len(meta)] = meta
+        self.flushed = time.time()
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def append(self, values):
+        self.record.pack_into(self.map,
+                              HEADER_SIZE + self.count * self.record.size,
+                              *values)
+        self.count += 1
+        COUNT.pack_into(self.map, COUNT_OFFSET, self.count)
+        if time.time() - self.flushed > FLUSH_INTERVAL:
+            self.map.flush()
+            self.flushed = time.time()
+
+    def close(self):
+        """ Write the map back and cut off the unused records """
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(HEADER_SIZE + self.count * self.record.size)
+        self.file.close()
+
+
+class JobRecorder(threading.Thread):
+    """ Records every vitals snapshot published while a program runs in auto mode into binary files, one set per job.
+    MDI commands and jogs aren't jobs and aren't recorded.
+    A segment holds a fixed number of records, when it is full the next segment is started.
+    Only the newest keep segments are kept on disk """
+    def __init__(self, poller, axes, folder, capacity=65536, keep=50):
+        super(JobRecorder, self).__init__()
+        self.daemon = True
+        self.poller = poller
+        self.axes = list(axes)
+        self.folder = folder
+        self.capacity = capacity
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.recording = None
+        self.job = None
+        self.segment = 0
+        self.watching = False
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def run(self):
+        self.watching = True
+        version = 0
+        while self.watching:
+            snapshot = self.poller.wait_for_change(version, 1)
+            if snapshot is None or snapshot.version == version:
+                continue
+            version = snapshot.version
+            self.update(snapshot)
+        self.finish()
+
+    def stop(self):
+        """ Stop following the machine and close the running recording """
+        self.watching = False
+
+    def update(self, snapshot):
+        """ Record a snapshot. A job that can't be recorded is closed, the next one starts over """
+        try:
+            self.check(snapshot)
+        except Exception:
+            LOG.exception("Recording the job failed")
+            try:
+                self.finish()
+            except (IOError, OSError, ValueError):
+                pass
+
+    def check(self, snapshot):
+        """ Start a job when a program starts, record while it runs and close it when the interpreter is idle again """
+        program = snapshot.vitals["program"]
+        if program["interp_state"] == "INTERP_IDLE" or program["task_mode"] != "MODE_AUTO":
+            self.finish()
+            return
+        with self.lock:
+            if self.job is None:
+                self.begin(program["file"], snapshot.timestamp)
+            elif self.recording.full():
+                self.recording.close()
+                self.segment += 1
+                self.open_segment()
+            self.recording.append(self.row(snapshot))
+
+    def begin(self, program, started):
+        name = secure_filename(os.path.splitext(os.path.basename(program or ""))[0])
+        self.job = {
+            "name": "%s-%s" % (time.strftime("%Y%m%d-%H%M%S", time.localtime(started)),
+                               name or "program"),
+            "program": (program or "")[-512:],
+            "started": started
+        }
+        self.segment = 0
+        self.open_segment()
+
+    def open_segment(self):
+        path = os.path.join(self.folder, "%s-%03d%s" % (self.job["name"], self.segment, EXTENSION))
+        self.recording = Recording(path, self.axes, self.capacity,
+                                   dict(self.job, segment=self.segment))
+        self.prune()
+
+    def finish(self):
+        """ Close the recording of the running job """
+        with self.lock:
+            try:
+                if self.recording is not None:
+                    self.recording.close()
+            finally:
+                self.recording = None
+                self.job = None
+
+    def prune(self):
+        """ Delete the oldest segments above keep """
+        names = sorted(self.list_names())
+        for name in names[:max(len(names) - self.keep, 0)]:
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+
+    def list_names(self):
+        return [name for name in os.listdir(self.folder) if name.endswith(EXTENSION)]
+
+    def row(self, snapshot):
+        """ The record values of a snapshot in file order """
+        vitals = snapshot.vitals
+        position = vitals["position"]
+        spindle = vitals["spindle"]
+        program = vitals["program"]
+        flags = (ENABLED if vitals["power"]["enabled"] else 0) | (
+            ESTOP if vitals["power"]["estop"] else 0) | (
+                SPINDLE_ENABLED if spindle["spindle_enabled"] else 0) | (
+                    SPINDLE_BRAKE if spindle["spindle_brake"] else 0)
+        return [snapshot.timestamp] + [position[axis]["pos"] for axis in self.axes] + [
+            spindle["spindle_speed"], spindle["spindlerate"], program["feedrate"],
+            vitals["values"]["velocity"], program["current_line"] or 0,
+            program["motion_line"] or 0,
+            INTERP_STATES.index(program["interp_state"]) + 1,
+            TASK_MODES.index(program["task_mode"]) + 1,
+            spindle["spindle_direction"], flags
+        ]
+
+    def recordings(self):
+        """ Return the headers of the recordings on disk, newest first """
+        result = []
+        for name in sorted(self.list_names(), reverse=True):
+            try:
+                header = read_header(os.path.join(self.folder, name))
+            except (IOError, OSError, ValueError):
+                continue
+            header["name"] = name
+            result.append(header)
+        return result
+
+    def path(self, name):
+        """ Return the path of a recording, None when it doesn't exist """
+        if name != secure_filename(name) or not name.endswith(EXTENSION):
+            return None
+        path = os.path.join(self.folder, name)
+        return path if os.path.isfile(path) else None
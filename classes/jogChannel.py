@@ -0,0 +1,187 @@
+import json
+import time
+import select
+import socket
+import threading
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+from classes import websocket
+
+FRAME_TIMEOUT = 5
+
+with open("./jsonFiles/errorMessages.json") as f:
+    MESSAGE = json.load(f)
+
+
+class JogSession(threading.Thread):
+    """ One jog pendant connection. Frames are json arrays:
+    ["start", axis, velocity] jogs continuously, the sign of velocity is the direction
+    ["stop", axis] or ["stop"] stops one or all axes
+    ["inc", axis, velocity, distance] jogs an increment
+    ["ping"] only keeps the dead-man alive
+    While an axis jogs every message has to be complete within the dead-man timeout of the one before, or all axes
+    are stopped. Websocket control frames and fragments don't count. An invalid frame stops all axes too """
+    def __init__(self, server, sock, ip):
+        super(JogSession, self).__init__()
+        self.daemon = True
+        self.server = server
+        self.controller = server.controller
+        self.sock = sock
+        self.ip = ip
+        self.ws = websocket.WebSocket(sock)
+        self.jogging = set()
+        self.received = time.time()
+
+    def run(self):
+        try:
+            accepted = self.handshake()
+        except (websocket.WebSocketError, IOError, OSError):
+            accepted = False
+        if not accepted:
+            self.sock.close()
+            return
+
+        try:
+            while True:
+                if self.jogging:
+                    deadline = self.received + self.server.deadman
+                else:
+                    select.select([self.sock], [], [])
+                    deadline = time.time() + FRAME_TIMEOUT
+                try:
+                    message = self.ws.receive(deadline)
+                except socket.timeout:
+                    if not self.jogging:
+                        raise
+                    self.stop_all()
+                    self.reply({"errors": MESSAGE['jog-deadman']})
+                    # A frame that stopped halfway can't be told apart from the next one
+                    if self.ws.partial:
+                        break
+                    continue
+                if message is None:
+                    break
+                self.received = time.time()
+                self.reply(self.handle(message))
+        except (websocket.WebSocketError, IOError, OSError):
+            pass
+        finally:
+            self.stop_all()
+            self.ws.close()
+            self.sock.close()
+
+    def handshake(self):
+        """ Authenticate once for the whole connection. Returns False when the upgrade was refused """
+        self.sock.settimeout(FRAME_TIMEOUT)
+        path, headers = websocket.read_request(self.sock)
+        query = parse_qs(urlparse(path).query)
+        token = headers.get("api_key") or query.get("token", [None])[0]
+        if self.server.allowed is not None and not self.server.allowed(
+                self.ip, True):
+            websocket.reject(self.sock, 403, "Forbidden",
+                             json.dumps({"errors": MESSAGE['whitelist-error']}))
+            return False
+        if token != self.server.token:
+            websocket.reject(self.sock, 401, "Unauthorized",
+                             json.dumps({"errors": MESSAGE['authorization']}))
+            return False
+        websocket.accept(self.sock, headers)
+        self.sock.settimeout(None)
+        return True
+
+    def reply(self, result):
+        self.ws.send(json.dumps(result, separators=(",", ":")))
+
+    def handle(self, message):
+        """ Run one frame and return the reply """
+        try:
+            frame = json.loads(message.decode("utf-8"))
+            if not isinstance(frame, list) or not frame:
+                raise ValueError()
+            command = frame[0]
+            if command == "ping":
+                return {"success": "pong"}
+            if command == "stop" and len(frame) == 1:
+                self.stop_all()
+                return {"success": "stop"}
+
+            axis = self.axis(frame[1])
+            if command == "stop" and len(frame) == 2:
+                self.jogging.discard(axis)
+                self.controller.jog_stop(axis)
+            elif command == "start" and len(frame) == 3:
+                self.controller.jog_start(axis, self.velocity(frame[2]))
+                self.jogging.add(axis)
+            elif command == "inc" and len(frame) == 4:
+                distance = float(frame[3])
+                self.controller.jog_increment(axis, self.velocity(frame[2]),
+                                              distance)
+            else:
+                raise ValueError()
+            return {"success": command}
+        except (ValueError, TypeError, IndexError, UnicodeDecodeError):
+            self.stop_all()
+            return {"errors": MESSAGE['invalid-jog-frame']}
+        except RuntimeError as err:
+            self.stop_all()
+            message, status, err_type = err.args
+            return {"errors": {
+                "message": message,
+                "status": status,
+                "type": err_type
+            }}
+
+    def axis(self, value):
+        if isinstance(value, bool) or not isinstance(value, int) or not (
+                0 <= value < len(self.controller.axes)):
+            raise ValueError()
+        return value
+
+    def velocity(self, value):
+        """ Jog velocity in machine units per second, limited to the max velocity of the machine """
+        velocity = float(value)
+        limit = float(self.controller.max_velocity or 0)
+        if limit and abs(velocity) > limit:
+            velocity = limit if velocity > 0 else -limit
+        return velocity
+
+    def stop_all(self):
+        """ Stop every axis this session is jogging """
+        for axis in list(self.jogging):
+            try:
+                self.controller.jog_stop(axis)
+            except RuntimeError:
+                pass
+        self.jogging.clear()
+
+
+class JogServer(threading.Thread):
+    """ Websocket listener for jog pendants on its own port. Clients authenticate once in the handshake with the
+    API_KEY header, or ?token= since browsers can't set websocket headers """
+    def __init__(self, controller, host, port, token, deadman=0.3, allowed=None):
+        super(JogServer, self).__init__()
+        self.daemon = True
+        self.controller = controller
+        self.token = token
+        self.deadman = deadman
+        self.allowed = allowed
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (IOError, OSError):
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            JogSession(self, sock, address[0]).start()
+
+    def close(self):
+        """ Stop accepting pendants """
+        self.listener.close()
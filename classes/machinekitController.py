@@ -1,41 +1,85 @@
 #!/usr/bin/python
 import os
 import sys
+import time
+import threading
 import linuxcnc
+from classes.errorLog import ErrorLog
+from classes.commandChannel import CommandChannel
+from classes.halcmdPool import HalcmdPool
+from classes.metrics import timed
+from classes.tracing import stage, traced
+
+TOOLCHANGE_PIN = "hal_manualtoolchange.change_button"
+TOOLCHANGE_PULSE = 1.0
+AXIS_LETTERS = "XYZABCUVW"
+
+
+def serialized(func):
+    """ Decorator that runs a command under the controller lock, so commands never interleave on the shared channels"""
+    name = "controller." + func.__name__
+
+    def wrapper(self, *args, **kwargs):
+        with stage(name), self.lock:
+            return func(self, *args, **kwargs)
+
+    wrapper.__name__ = func.__name__
+    return wrapper
 
 
 def checkerrors(func):
     """ Decorator that checks if the machine returned any errors."""
-    def wrapper(*args, **kwargs):
-        errors = func(*args, **kwargs)
+    name = "controller." + func.__name__
+
+    def wrapper(self, *args, **kwargs):
+        with stage(name), self.lock:
+            self.error_cursor = self.error_log.last_seq
+            errors = func(self, *args, **kwargs)
         if 'errors' in errors:
             raise RuntimeError(errors['errors'], 502, "RuntimeError")
         else:
             return {"success": "Command executed"}
 
+    wrapper.__name__ = func.__name__
     return wrapper
 
 
 class MachinekitController():
     """ The Machinekit python interface in a class """
-    def __init__(self, ini):
-        """ Construct the class. Read values from passed .ini file"""
+    def __init__(self, ini, stat_freshness=0.02, halcmd=None):
+        """ Construct the class. Read values from passed .ini file.
+        A stat snapshot is reused for stat_freshness seconds as long as no command was sent.
+        HAL pins are set through the halcmd pool, this process isn't a HAL component """
         self.s = linuxcnc.stat()
-        self.c = linuxcnc.command()
+        self.c = CommandChannel(linuxcnc.command(), self.invalidate)
         self.e = linuxcnc.error_channel()
+        self.stat_freshness = stat_freshness
+        self.polled_at = None
+        # Commands normally arrive one by one from the command worker, the lock keeps any other caller in line
+        self.lock = threading.RLock()
 
         self.axes = self.set_axes()
         self.axes_with_cords = {}
         self.ini = linuxcnc.ini(ini)
-        self.error_list = []
+        self.error_log = ErrorLog(
+            self.e, (linuxcnc.NML_ERROR, linuxcnc.OPERATOR_ERROR))
+        self.error_cursor = 0
+        self.toolchange_request = None
+        self.toolchange_release = None
+        self.halcmd = halcmd or HalcmdPool(1)
+        # The jog channel has its own NML channels so jogging never waits behind the command worker
+        self.jog_stat = linuxcnc.stat()
+        self.jog_command = CommandChannel(linuxcnc.command(), self.invalidate)
+        self.jog_lock = threading.Lock()
 
         self.max_feed_override = self.ini.find("DISPLAY", "MAX_FEED_OVERRIDE")
         self.max_spindle_override = self.ini.find("DISPLAY", "MAX_SPINDLE_OVERRIDE")
         self.max_velocity = self.ini.find("TRAJ", "MAX_VELOCITY")
+        self.linear_units = self.ini.find("TRAJ", "LINEAR_UNITS") or "mm"
 
     def set_axes(self):
         """Turn axe numbers into alphabetic values"""
-        self.s.poll()
+        self.poll()
         axes_dict = {
             0: "x",
             1: "y",
@@ -54,90 +98,108 @@ class MachinekitController():
             i += 1
         return axes_in_machine
 
-    def interp_state(self):
+    def poll(self):
+        """ Poll the stat channel, unless the last snapshot is younger than the freshness window """
+        now = time.time()
+        if self.polled_at is None or now - self.polled_at > self.stat_freshness:
+            with timed("stat.poll"):
+                self.s.poll()
+            self.polled_at = now
+
+    def invalidate(self):
+        """ Called after every command, the next poll() reads the new state """
+        self.polled_at = None
+
+    def create_stat(self):
+        """ Return a new status channel for the background status poller """
+        return linuxcnc.stat()
+
+    def interp_state(self, stat=None):
         """Return current interp state of machine. Ex: INTERP_IDLE"""
+        stat = stat or self.s
         modes = [
             "INTERP_IDLE", "INTERP_READING", "INTERP_PAUSED", "INTERP_WAITING"
         ]
-        state = self.s.interp_state
+        state = stat.interp_state
         return modes[state - 1]
 
-    def task_mode(self):
+    def task_mode(self, stat=None):
         """Return machine task mode"""
+        stat = stat or self.s
         modes = ["MODE_MANUAL", "MODE_AUTO", "MODE_MDI"]
-        return modes[self.s.task_mode - 1]
+        return modes[stat.task_mode - 1]
 
-    def axes_position(self):
+    def axes_position(self, stat=None):
         """ Loop over axes and return position: {"[axe]": {"homed": bool, "pos": float}} """
+        stat = stat or self.s
+        axes_with_cords = {}
         i = 0
         while i < len(self.axes):
-            homed = bool(self.s.axis[i]["homed"])
-            pos = round(self.s.axis[i]['input'], 3)
-            self.axes_with_cords[self.axes[i]] = {"pos": pos, "homed": homed}
+            homed = bool(stat.axis[i]["homed"])
+            pos = round(stat.axis[i]['input'], 3)
+            axes_with_cords[self.axes[i]] = {"pos": pos, "homed": homed}
             i += 1
-        return self.axes_with_cords
+        self.axes_with_cords = axes_with_cords
+        return axes_with_cords
 
     def errors(self):
-        """Read the error channel, return latest error as response and create an error list with all errors."""
-        error = self.e.poll()
-        if error:
-            kind, text = error
-            if kind in (linuxcnc.NML_ERROR, linuxcnc.OPERATOR_ERROR):
-                typus = "error"
-            else:
-                typus = "info"
-                typus, text
-
-        if error is not None:
-            if len(self.error_list) >= 50:
-                self.error_list = []
-
-            self.error_list.append(error[1])
-            return {"errors": error[1]}
-        else:
-            return {}
-
+        """Drain the error channel and return the latest error raised since the current command started"""
+        self.error_log.drain()
+        for record in reversed(self.error_log.since(self.error_cursor)):
+            if record.type == "error":
+                return {"errors": record.text}
+        return {}
+
+    @serialized
     def ready_for_mdi_commands(self):
         """ Returns bool that represents if the machine is ready for MDI commands """
-        self.s.poll()
+        self.poll()
         return not self.s.estop and self.s.enabled and self.s.homed and (
             self.s.interp_state == linuxcnc.INTERP_IDLE)
 
-    def rcs_state(self):
+    def rcs_state(self, stat=None):
         """ Return current rcs-state of the machine as string. Ex: RCS_DONE"""
+        stat = stat or self.s
         modes = ["RCS_DONE", "RCS_EXEC", "RCS_ERROR"]
-        return modes[self.s.state - 1]
+        return modes[stat.state - 1]
 
-    def get_all_vitals(self):
-        """Return most important machine values as dict"""
-        self.s.poll()
+    def get_all_vitals(self, stat=None):
+        """Return most important machine values as dict. Polls the given status channel, defaults to self.s"""
+        if stat is None:
+            stat = self.s
+            self.poll()
+        else:
+            with timed("stat.poll"):
+                stat.poll()
         return {
             "power": {
-                "enabled": self.s.enabled,
-                "estop": bool(self.s.estop)
+                "enabled": stat.enabled,
+                "estop": bool(stat.estop)
             },
-            "position": self.axes_position(),
+            "position": self.axes_position(stat),
             "spindle": {
-                "spindle_speed": self.s.spindle_speed,
-                "spindle_enabled": self.s.spindle_enabled,
-                "spindle_brake": self.s.spindle_brake,
-                "spindle_direction": self.s.spindle_direction,
-                "spindle_increasing": self.s.spindle_increasing,
-                "spindle_override_enabled": self.s.spindle_override_enabled,
-                "spindlerate": self.s.spindlerate,
-                "tool_in_spindle": self.s.tool_in_spindle
+                "spindle_speed": stat.spindle_speed,
+                "spindle_enabled": stat.spindle_enabled,
+                "spindle_brake": stat.spindle_brake,
+                "spindle_direction": stat.spindle_direction,
+                "spindle_increasing": stat.spindle_increasing,
+                "spindle_override_enabled": stat.spindle_override_enabled,
+                "spindlerate": stat.spindlerate,
+                "tool_in_spindle": stat.tool_in_spindle
             },
             "program": {
-                "file": self.s.file,
-                "interp_state": self.interp_state(),
-                "task_mode": self.task_mode(),
-                "feedrate": self.s.feedrate,
-                "rcs_state": self.rcs_state(),
-                "tool_change": self.s.pocket_prepped
+                "file": stat.file,
+                "interp_state": self.interp_state(stat),
+                "task_mode": self.task_mode(stat),
+                "feedrate": stat.feedrate,
+                "rcs_state": self.rcs_state(stat),
+                "tool_change": stat.pocket_prepped,
+                "current_line": stat.current_line,
+                "motion_line": stat.motion_line
             },
             "values": {
-                "velocity": self.s.max_velocity,
-                "max_acceleration": self.s.max_acceleration,
+                "velocity": stat.max_velocity,
+                "max_acceleration": stat.max_acceleration,
                 "max_feed_override": self.max_feed_override,
                 "max_spindle_override": self.max_spindle_override
             }
@@ -147,7 +209,7 @@ class MachinekitController():
     @checkerrors
     def machine_status(self, command):
         """ Toggle power/estop. takes 'estop' or 'power' as command"""
-        self.s.poll()
+        self.poll()
         if command == "estop":
             if self.s.estop == linuxcnc.STATE_ESTOP:
                 self.c.state(linuxcnc.STATE_ESTOP_RESET)
@@ -174,7 +236,7 @@ class MachinekitController():
     def mdi_command(self, command):
         """ Send a MDI movement command to the machine, example "Y1 X1 Z-1" """
         # Check if the machine is ready for mdi commands
-        self.s.poll()
+        self.poll()
         if self.s.interp_state is not linuxcnc.INTERP_IDLE:
             return {
                 "errors":
@@ -187,10 +249,47 @@ class MachinekitController():
         self.c.mdi(str(mdi_command))
         return self.errors()
 
+    @serialized
+    def mdi_batch(self, commands):
+        """ Send MDI commands back to back after one idle check and at most one mode switch. Stops at the first
+        error. Commands that start with an axis word get a G0 like mdi_command. Returns the result per command """
+        self.error_cursor = self.error_log.last_seq
+        self.poll()
+        if self.s.interp_state is not linuxcnc.INTERP_IDLE:
+            raise RuntimeError(
+                "Cannot execute command when machine interp state isn't idle",
+                502, "RuntimeError")
+        self.ensure_mode(linuxcnc.MODE_MDI)
+
+        results = []
+        error = None
+        for command in commands:
+            if error is not None:
+                results.append({"command": command, "status": "skipped"})
+                continue
+            if command.lstrip()[:1].upper() in AXIS_LETTERS:
+                self.c.mdi(str("G0 " + command))
+            else:
+                self.c.mdi(str(command))
+            self.c.wait_complete()
+            error = self.errors().get("errors")
+            if error is None:
+                results.append({"command": command, "status": "done"})
+            else:
+                results.append({
+                    "command": command,
+                    "status": "failed",
+                    "error": error
+                })
+
+        if error is not None:
+            return {"errors": error, "results": results}
+        return {"success": "Commands executed", "results": results}
+
     @checkerrors
     def manual_control(self, axes, speed, increment):
         """ Manual continious transmission. axes=int speed=int in mm increment=int in mm"""
-        self.s.poll()
+        self.poll()
         if self.s.interp_state is not linuxcnc.INTERP_IDLE:
             raise RuntimeError(
                 "Cannot execute command when machine interp state isn't idle",
@@ -201,6 +300,51 @@ class MachinekitController():
         self.c.jog(linuxcnc.JOG_INCREMENT, axes, speed, increment)
         return self.errors()
 
+    def prepare_jog(self):
+        """ Switch to manual mode for jogging. Skips the error poll so a jog frame only costs one stat poll """
+        with timed("stat.poll"):
+            self.jog_stat.poll()
+        if self.jog_stat.interp_state is not linuxcnc.INTERP_IDLE:
+            raise RuntimeError(
+                "Cannot execute command when machine interp state isn't idle",
+                502, "RuntimeError")
+        if self.jog_stat.task_mode != linuxcnc.MODE_MANUAL:
+            self.jog_command.mode(linuxcnc.MODE_MANUAL)
+            self.jog_command.wait_complete()
+
+    def lock_for_jog(self):
+        """ Take the command lock without waiting. A jog is refused while another command runs, so the mode
+        switch can't go in between its steps and the pendant doesn't queue up behind it """
+        if not self.lock.acquire(False):
+            raise RuntimeError("Machine is busy with another command", 409,
+                               "RuntimeError")
+
+    def jog_start(self, axis, velocity):
+        """ Jog an axis until jog_stop. The sign of velocity is the direction """
+        with self.jog_lock:
+            self.lock_for_jog()
+            try:
+                self.prepare_jog()
+                self.jog_command.jog(linuxcnc.JOG_CONTINUOUS, axis, velocity)
+            finally:
+                self.lock.release()
+
+    def jog_increment(self, axis, velocity, distance):
+        """ Jog an axis over distance """
+        with self.jog_lock:
+            self.lock_for_jog()
+            try:
+                self.prepare_jog()
+                self.jog_command.jog(linuxcnc.JOG_INCREMENT, axis, velocity,
+                                     distance)
+            finally:
+                self.lock.release()
+
+    def jog_stop(self, axis):
+        """ Stop jogging an axis. Never checks the machine state or takes the command lock so a stop always goes out """
+        with self.jog_lock:
+            self.jog_command.jog(linuxcnc.JOG_STOP, axis)
+
     @checkerrors
     def home_all_axes(self, command):
         """ Return all axes to the home position """
@@ -220,6 +364,7 @@ class MachinekitController():
         self.c.wait_complete()
         return self.errors()
 
+    @serialized
     def run_program(self, command):
         """ Run the current file. Takes command as start || pause || stop || default=resume"""
         self.ensure_mode(linuxcnc.MODE_AUTO, linuxcnc.MODE_MDI)
@@ -236,7 +381,7 @@ class MachinekitController():
     @checkerrors
     def task_run(self):
         """ Run program from line 0"""
-        self.s.poll()
+        self.poll()
         if self.s.task_mode not in (
                 linuxcnc.MODE_AUTO,
                 linuxcnc.MODE_MDI) or self.s.interp_state in (
@@ -254,7 +399,7 @@ class MachinekitController():
     @checkerrors
     def task_pause(self):
         """ Pause current program """
-        self.s.poll()
+        self.poll()
         if self.s.interp_state is linuxcnc.INTERP_PAUSED:
             return {"errors": "Machine is already paused."}
         if self.s.task_mode not in (
@@ -273,7 +418,7 @@ class MachinekitController():
     @checkerrors
     def task_resume(self):
         """ Resume current program """
-        self.s.poll()
+        self.poll()
         if self.s.task_mode not in (
                 linuxcnc.MODE_AUTO, linuxcnc.MODE_MDI
         ) or self.s.interp_state is not linuxcnc.INTERP_PAUSED:
@@ -294,9 +439,10 @@ class MachinekitController():
 
         return self.errors()
 
+    @traced("ensure_mode")
     def ensure_mode(self, m, *p):
         """ Ensure that the machine is in given mode. If not switch the mode """
-        self.s.poll()
+        self.poll()
         if self.s.task_mode == m or self.s.task_mode in p:
             return True
         if self.running(do_poll=False):
@@ -307,13 +453,13 @@ class MachinekitController():
 
     def running(self, do_poll=True):
         if do_poll:
-            self.s.poll()
+            self.poll()
         return self.s.task_mode == linuxcnc.MODE_AUTO and self.s.interp_state is not linuxcnc.INTERP_IDLE
 
     @checkerrors
     def spindle_brake(self, command):
         """ Engage the spindle brake"""
-        self.s.poll()
+        self.poll()
         brake_command = None
         if "brake_engage" in command:
             brake_command = linuxcnc.BRAKE_ENGAGE
@@ -334,7 +480,7 @@ class MachinekitController():
     @checkerrors
     def spindle_direction(self, command):
         """ Command takes parameters spindle_forward and spindle_reverse"""
-        self.s.poll()
+        self.poll()
         commands = {
             "spindle_forward": linuxcnc.SPINDLE_FORWARD,
             "spindle_reverse": linuxcnc.SPINDLE_REVERSE,
@@ -353,7 +499,7 @@ class MachinekitController():
     @checkerrors
     def spindle_speed(self, command):
         """ Command takes parameters spindle_increase and spindle_decrease """
-        self.s.poll()
+        self.poll()
 
         if not self.s.spindle_enabled:
             return {
@@ -406,7 +552,7 @@ class MachinekitController():
     @checkerrors
     def open_file(self, path, file_name):
         """ Open file in the /files dir on the beagleboi """
-        self.s.poll()
+        self.poll()
 
         if self.s.interp_state is not linuxcnc.INTERP_IDLE:
             return {"errors": "Cannot execute command when interp is not idle"}
@@ -426,7 +572,7 @@ class MachinekitController():
     @checkerrors
     def set_offset(self):
         """Set offset"""
-        self.s.poll()
+        self.poll()
 
         if self.s.interp_state is not linuxcnc.INTERP_IDLE:
             return {"errors": "Cannot execute command when interp is not idle"}
@@ -434,3 +580,59 @@ class MachinekitController():
         #jointnum, home_pos, home_offset, home_final_velocity, home_search_velocity, home_final_velocity, use_index, ignore_limits, is_shared, home_sequence, volatile_home, locking_indexer
         self.c.set_home_parameters(0, 0, 0, 10, 10, 10, 10, 10, 1, 1, 2, 1)
         return self.errors()
+
+    @serialized
+    def tool_change(self):
+        """ Pulse the manual toolchange button without blocking. A timer releases the pin,
+        a new pulse replaces the pending release """
+        self.poll()
+        if self.toolchange_release is not None:
+            self.toolchange_release.cancel()
+        self.toolchange_request = {
+            "requested": time.time(),
+            "tool_in_spindle": self.s.tool_in_spindle,
+            "pocket_prepped": self.s.pocket_prepped
+        }
+        self.set_toolchange_button("true")
+        release = threading.Timer(TOOLCHANGE_PULSE, self.release_toolchange,
+                                  (self.toolchange_request, ))
+        release.daemon = True
+        self.toolchange_release = release
+        release.start()
+        return {"success": "Toolchange requested"}
+
+    def set_toolchange_button(self, value):
+        """ Set the toolchange button pin with halcmd. halcmd prints nothing when setp succeeds """
+        output = self.halcmd.execute("setp %s %s" % (TOOLCHANGE_PIN, value))
+        if output.strip():
+            raise RuntimeError(output.strip(), 502, "RuntimeError")
+
+    def release_toolchange(self, request):
+        """ Release the toolchange button. Runs on the timer, a failure is reported by toolchange_status """
+        try:
+            self.set_toolchange_button("false")
+        except Exception as err:
+            request["errors"] = err.args[0] if err.args else str(err)
+
+    def toolchange_status(self, vitals):
+        """ Return if the last toolchange request has been acknowledged according to the given vitals. A request
+        without a prepped tool can't be acknowledged and isn't pending either """
+        tool_in_spindle = vitals["spindle"]["tool_in_spindle"]
+        pocket_prepped = vitals["program"]["tool_change"]
+        request = self.toolchange_request
+        prepped = request is not None and request["pocket_prepped"] != -1
+        acknowledged = request is None or (prepped and (
+            tool_in_spindle != request["tool_in_spindle"]
+            or pocket_prepped != request["pocket_prepped"]))
+        status = {
+            "acknowledged": acknowledged,
+            "pending": not acknowledged and prepped,
+            "requested": request["requested"] if request else None,
+            "tool_in_spindle": tool_in_spindle,
+            "pocket_prepped": pocket_prepped
+        }
+        if request is not None and not prepped:
+            status["message"] = "No tool prepped"
+        if request and "errors" in request:
+            status["errors"] = request["errors"]
+        return status
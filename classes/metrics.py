@@ -0,0 +1,193 @@
+import time
+import bisect
+import weakref
+import threading
+from flask import g, request
+from classes.tracing import record
+
+# Upper bounds in seconds, from a cached stat poll to a slow mode switch
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=""):
+    labels = ",".join('%s="%s"' % (name, escape(value))
+                      for name, value in zip(names, values))
+    if extra:
+        labels = labels + "," + extra if labels else extra
+    return "{%s}" % labels if labels else ""
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class ShardOwner(object):
+    """ Lives in the thread local of a metric, so it goes away with its thread """
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__(self):
+        self.shard = {}
+
+
+class Metric(object):
+    """ A metric family with one set of cells per label values. Every thread writes its own shard, so updates
+    never take a lock and never race. The shards are only added together when the metrics are read.
+    The shard of a thread that ended is added to the retired cells, so short lived threads don't pile up """
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.local = threading.local()
+        # Shards of the running threads by a weak reference to their owner
+        self.shards = {}
+        self.retired = {}
+        self.lock = threading.Lock()
+
+    def cells(self, labels):
+        """ The cells of the current thread for the given label values """
+        owner = getattr(self.local, "owner", None)
+        if owner is None:
+            owner = self.local.owner = ShardOwner()
+            with self.lock:
+                self.shards[weakref.ref(owner, self.retire)] = owner.shard
+        cells = owner.shard.get(labels)
+        if cells is None:
+            cells = owner.shard[labels] = self.empty()
+        return cells
+
+    def retire(self, reference):
+        """ Called with the weak reference to the owner when the thread of a shard ended """
+        with self.lock:
+            self.add(self.retired, self.shards.pop(reference))
+
+    def add(self, total, shard):
+        for labels, cells in list(shard.items()):
+            merged = total.setdefault(labels, self.empty())
+            for index, value in enumerate(cells):
+                merged[index] += value
+
+    def collect(self):
+        """ Add the shards of all threads and the retired cells together """
+        total = {}
+        with self.lock:
+            shards = list(self.shards.values())
+            self.add(total, self.retired)
+        for shard in shards:
+            self.add(total, shard)
+        return total
+
+    def expose(self):
+        """ Return the family in the Prometheus text format """
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for labels, cells in sorted(self.collect().items()):
+            lines.extend(self.samples(labels, cells))
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def empty(self):
+        return [0]
+
+    def inc(self, labels=(), amount=1):
+        self.cells(labels)[0] += amount
+
+    def samples(self, labels, cells):
+        return ["%s%s %s" % (self.name, format_labels(self.labels, labels),
+                             format_value(cells[0]))]
+
+
+class Histogram(Metric):
+    """ Histogram with fixed bucket bounds. The cells are the count per bucket, the count above the last bound
+    and the sum of all observed values, allocated once per label values """
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.bounds = tuple(buckets)
+
+    def empty(self):
+        return [0] * (len(self.bounds) + 2)
+
+    def observe(self, labels, value):
+        cells = self.cells(labels)
+        cells[bisect.bisect_left(self.bounds, value)] += 1
+        cells[-1] += value
+
+    def samples(self, labels, cells):
+        samples = []
+        count = 0
+        for bound, observed in zip(self.bounds + ("+Inf", ), cells[:-1]):
+            count += observed
+            samples.append("%s_bucket%s %d" % (self.name, format_labels(
+                self.labels, labels, 'le="%s"' % bound), count))
+        samples.append("%s_sum%s %s" % (self.name, format_labels(
+            self.labels, labels), format_value(float(cells[-1]))))
+        samples.append("%s_count%s %d" % (self.name, format_labels(
+            self.labels, labels), count))
+        return samples
+
+
+REQUEST_DURATION = Histogram("webui_request_duration_seconds",
+                             "Time spent handling a request",
+                             ("blueprint", "endpoint", "method"))
+RESPONSES = Counter("webui_responses_total", "Responses sent",
+                    ("blueprint", "endpoint", "status"))
+CONTROLLER_DURATION = Histogram(
+    "webui_controller_call_duration_seconds",
+    "Time spent in calls into linuxcnc and halcmd", ("call", ))
+METRICS = [REQUEST_DURATION, RESPONSES, CONTROLLER_DURATION]
+
+
+class timed(object):
+    """ Context manager that observes the duration of a controller call. Traced requests get it as stage too """
+    __slots__ = ("call", "started")
+
+    def __init__(self, call):
+        self.call = call
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, *exc):
+        observe_call(self.call, time.time() - self.started)
+
+
+def observe_call(call, duration):
+    """ Observe the duration of a controller call that can't be timed in one block """
+    CONTROLLER_DURATION.observe((call, ), duration)
+    record(call, duration)
+
+
+def exposition():
+    """ Return all metrics in the Prometheus text format """
+    return "".join(metric.expose() for metric in METRICS)
+
+
+def instrument(app):
+    """ Count and time every request of the app by blueprint and endpoint """
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.time()
+
+    @app.after_request
+    def observe_request(response):
+        started = getattr(g, "request_started", None)
+        if started is not None:
+            endpoint = request.endpoint or "unmatched"
+            blueprint = request.blueprint or ""
+            REQUEST_DURATION.observe((blueprint, endpoint, request.method),
+                                     time.time() - started)
+            RESPONSES.inc((blueprint, endpoint, response.status_code))
+        return response
+
+    return app
@@ -0,0 +1,177 @@
+import os
+import mmap
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+READ_CHUNK = 1024 * 1024
+OFFSET = struct.Struct("<Q")
+
+
+def newline_offsets(chunk, base):
+    """ Return the offset of the byte after every newline in a chunk """
+    if numpy is not None:
+        found = numpy.flatnonzero(
+            numpy.frombuffer(chunk, dtype=numpy.uint8) == 10)
+        return (found.astype("<u8") + (base + 1)).tobytes()
+    offsets = []
+    position = chunk.find(b"\n")
+    while position != -1:
+        offsets.append(base + position + 1)
+        position = chunk.find(b"\n", position + 1)
+    return struct.pack("<%dQ" % len(offsets), *offsets)
+
+
+def build_index(path, index_path):
+    """ Write the start offset of every line of a program as little endian uint64, followed by the file size.
+    The file is read in chunks so memory stays flat for programs of any size """
+    size = os.path.getsize(path)
+    with open(path, "rb") as program, open(index_path + ".tmp", "wb") as index:
+        index.write(OFFSET.pack(0))
+        base = 0
+        while True:
+            chunk = program.read(READ_CHUNK)
+            if not chunk:
+                break
+            index.write(newline_offsets(chunk, base))
+            base += len(chunk)
+    # A trailing newline doesn't start another line, its offset is the file size sentinel
+    with open(index_path + ".tmp", "r+b") as index:
+        index.seek(0, os.SEEK_END)
+        entries = index.tell() // OFFSET.size
+        if size == 0 or (entries > 1 and last_offset(index) == size):
+            index.seek(-OFFSET.size, os.SEEK_END)
+            index.truncate()
+        index.seek(0, os.SEEK_END)
+        index.write(OFFSET.pack(size))
+    os.rename(index_path + ".tmp", index_path)
+
+
+def last_offset(index):
+    """ Read the last entry of an open index file """
+    index.seek(-OFFSET.size, os.SEEK_END)
+    return OFFSET.unpack(index.read(OFFSET.size))[0]
+
+
+class LineIndex(object):
+    """ A program and its memory mapped line index. The program is read with plain reads, so a file that is
+    truncated meanwhile returns short lines instead of faulting like a mapping would """
+    def __init__(self, path, index_path, info):
+        self.size = info.st_size
+        self.mtime = info.st_mtime
+        with open(index_path, "rb") as index:
+            self.offsets = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        self.total = len(self.offsets) // OFFSET.size - 1
+        self.program = open(path, "rb")
+
+    def offset(self, entry):
+        return OFFSET.unpack_from(self.offsets, entry * OFFSET.size)[0]
+
+    def matches(self, info):
+        """ Return True when the index was built for this version of the program """
+        return (info.st_size == self.size and info.st_mtime == self.mtime
+                and self.offset(self.total) == self.size)
+
+    def lines(self, first, last):
+        """ Return lines first to last, counting from 1 """
+        if not self.size or first > last:
+            return []
+        start = self.offset(first - 1)
+        self.program.seek(start)
+        data = self.program.read(self.offset(last) - start)
+        return [line.rstrip(b"\r").decode("utf-8", "replace")
+                for line in data.split(b"\n")[:last - first + 1]]
+
+    def close(self):
+        self.offsets.close()
+        self.program.close()
+
+
+class ProgramWindow(object):
+    """ Lines around the current line of the loaded program. Line indexes are built once per file version
+    in a hidden folder of the upload folder, and the most recently used ones are kept open by path """
+    def __init__(self, folder, memory=4):
+        self.index_dir = os.path.join(folder, ".lines")
+        self.memory = memory
+        self.indexes = OrderedDict()
+        self.building = set()
+        self.background = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Build indexes on a background thread, the window reports that it is indexing meanwhile """
+        self.background = True
+
+    def index_path(self, path, info):
+        prefix = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.index_dir, "%s-%d-%d.idx" % (
+            prefix, info.st_size, int(info.st_mtime * 1000)))
+
+    def window(self, path, line, context):
+        """ Return lines line-context to line+context of a program, or None while its index is being built.
+        The size and mtime of the program are checked before every read, a changed program is indexed again.
+        Raises OSError when the program doesn't exist """
+        info = os.stat(path)
+        with self.lock:
+            index = self.indexes.pop(path, None)
+            if index is not None and not index.matches(info):
+                index.close()
+                index = None
+            if index is None:
+                index_path = self.index_path(path, info)
+                if not os.path.exists(index_path):
+                    if self.build(path, index_path):
+                        return None
+                index = LineIndex(path, index_path, info)
+                if not index.matches(info):
+                    # The program changed while it was indexed
+                    index.close()
+                    try:
+                        os.remove(index_path)
+                    except OSError:
+                        pass
+                    return None
+                while len(self.indexes) >= self.memory:
+                    self.indexes.popitem(last=False)[1].close()
+            self.indexes[path] = index
+
+            line = min(max(line, 1), max(index.total, 1))
+            first = max(line - context, 1)
+            last = min(line + context, index.total)
+            return {
+                "line": line,
+                "first": first,
+                "total": index.total,
+                "lines": index.lines(first, last)
+            }
+
+    def build(self, path, index_path):
+        """ Build an index inline, or on a thread when started. Returns True while the index isn't ready """
+        if not os.path.isdir(self.index_dir):
+            os.makedirs(self.index_dir)
+        if not self.background:
+            self.replace(path, index_path)
+            return False
+        if index_path not in self.building:
+            self.building.add(index_path)
+            thread = threading.Thread(target=self.replace,
+                                      args=(path, index_path))
+            thread.daemon = True
+            thread.start()
+        return True
+
+    def replace(self, path, index_path):
+        """ Build the index of the current version of a file and remove the indexes of older versions """
+        try:
+            build_index(path, index_path)
+            prefix = os.path.basename(index_path).split("-")[0] + "-"
+            for name in os.listdir(self.index_dir):
+                if name.startswith(prefix) and name != os.path.basename(index_path):
+                    os.remove(os.path.join(self.index_dir, name))
+        finally:
+            self.building.discard(index_path)
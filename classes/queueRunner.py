@@ -0,0 +1,231 @@
+import os
+import time
+import threading
+
+READ_CHUNK = 1024 * 1024
+# Start time of a program the controller hasn't accepted yet, no snapshot is newer
+STARTING = float("inf")
+
+
+class QueueRunner(threading.Thread):
+    """ Runs the file queue. When a program runs to its end without errors the next queued file is opened and
+    started on the command worker, or held until the operator confirms. Estop, turning the machine off and
+    aborting a program stop the queue. The file after the running one is staged while the machine cuts,
+    so the changeover only has to open and start it """
+    def __init__(self, poller, worker, controller, folder, queue, catalog=None,
+                 analyzer=None, program_window=None, confirm=False):
+        super(QueueRunner, self).__init__()
+        self.daemon = True
+        self.poller = poller
+        self.worker = worker
+        self.controller = controller
+        self.folder = folder
+        # The queue is shared with the routes and changed in place
+        self.queue = queue
+        self.catalog = catalog
+        self.analyzer = analyzer
+        self.program_window = program_window
+        self.confirm = confirm
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.state = "stopped"
+        self.current = None
+        self.staged = None
+        self.last_error = None
+        self.interp_state = None
+        # Highest motion line of the running program
+        self.reached = 0
+        # Time the running program started, None while no program runs
+        self.run_started = None
+        self.error_cursor = 0
+        self.watching = False
+
+    def run(self):
+        self.watching = True
+        version = 0
+        while self.watching:
+            snapshot = self.poller.wait_for_change(version, 1)
+            if snapshot is None:
+                continue
+            version = snapshot.version
+            try:
+                self.check(snapshot.vitals, snapshot.timestamp)
+            except Exception as err:
+                self.fail(err)
+
+    def stop(self):
+        """ Stop following the machine """
+        self.watching = False
+
+    def status(self):
+        """ Return the state of the runner as dict """
+        return {
+            "enabled": self.enabled,
+            "confirm": self.confirm,
+            "state": self.state,
+            "current": self.current,
+            "next": self.staged,
+            "queue": list(self.queue),
+            "last_error": self.last_error
+        }
+
+    def check(self, vitals, polled=None):
+        """ Follow the interpreter. A program has finished when the machine is idle in a snapshot polled after it
+        started, so programs that start and end between two polls are not missed. It only ran to its end when
+        the machine is still on in auto mode and, if any of its moves was seen, the last move was reached """
+        program = vitals["program"]
+        power = vitals["power"]
+        self.interp_state = program["interp_state"]
+        if self.enabled and (power["estop"] or not power["enabled"]):
+            self.fail(RuntimeError("Machine is in estop" if power["estop"] else "Machine is off"))
+        if self.interp_state != "INTERP_IDLE":
+            if self.run_started is None:
+                self.started(program["file"])
+            self.reached = max(self.reached, program["motion_line"] or 0)
+            return
+        if self.run_started is None or (polled is not None and polled <= self.run_started):
+            return
+
+        self.reached = max(self.reached, program["motion_line"] or 0)
+        completed = (program["task_mode"] == "MODE_AUTO" and power["enabled"]
+                     and not power["estop"] and (not self.reached or self.ran_to_end(self.current)))
+        failed = [record for record in
+                  self.controller.error_log.since(self.error_cursor)
+                  if record.type == "error"]
+        with self.lock:
+            self.current = None
+            self.run_started = None
+            if failed:
+                self.enabled = False
+                self.state = "error"
+                self.last_error = failed[-1].text
+                return
+            if not self.enabled:
+                return
+            if not completed:
+                self.enabled = False
+                self.state = "stopped"
+                return
+            if not self.queue:
+                self.state = "finished"
+                return
+            if self.confirm:
+                self.state = "waiting-confirm"
+                return
+        self.advance()
+
+    def ran_to_end(self, name):
+        """ Return True when the last move of a program was reached. Without its analysis this can't be told
+        and the program counts as finished """
+        analysis = self.analyzer.result(name) if self.analyzer is not None and name else {}
+        last_line = analysis.get("last_line")
+        return last_line is None or self.reached >= last_line
+
+    def started(self, path, at=0):
+        """ A program started, stage the next file while it runs. Programs started elsewhere are noticed in a
+        snapshot and count from the first idle one after it """
+        if not at:
+            self.error_cursor = self.controller.error_log.last_seq
+            self.reached = 0
+        self.run_started = at
+        with self.lock:
+            self.current = os.path.basename(path) if path else None
+            if self.enabled:
+                self.state = "running"
+        self.stage()
+
+    def stage(self):
+        """ Validate the next file and pull it into the page cache so opening it doesn't wait on the disk """
+        if not self.queue:
+            self.staged = None
+            return
+        name = self.queue[0]
+        if self.staged is not None and self.staged["name"] == name:
+            return
+        staged = {"name": name, "ready": False, "errors": None}
+        path = os.path.join(self.folder, name)
+        analysis = self.analyzer.result(name) if self.analyzer is not None else {}
+        if self.catalog is not None and name not in self.catalog:
+            staged["errors"] = "File not found"
+        elif "errors" in analysis:
+            staged["errors"] = analysis["errors"]
+        else:
+            try:
+                with open(path, "rb") as program:
+                    while program.read(READ_CHUNK):
+                        pass
+                if self.program_window is not None:
+                    self.program_window.window(path, 1, 0)
+                staged["ready"] = True
+            except (IOError, OSError) as err:
+                staged["errors"] = str(err)
+        self.staged = staged
+
+    def enable(self, confirm=None):
+        """ Enable the runner. Starts the first file right away when the machine is idle """
+        if confirm is not None:
+            self.confirm = confirm
+        with self.lock:
+            self.enabled = True
+            self.last_error = None
+            self.state = "waiting"
+        vitals = self.poller.snapshot().vitals
+        if vitals["program"]["interp_state"] == "INTERP_IDLE":
+            return self.advance()
+        return self.status()
+
+    def disable(self):
+        """ Stop starting files. The running program is not interrupted """
+        with self.lock:
+            self.enabled = False
+            self.state = "stopped"
+        return self.status()
+
+    def waiting(self):
+        """ Return True when the next file waits for the operator """
+        return self.state == "waiting-confirm"
+
+    def advance(self):
+        """ Open and start the next file on the command worker. It stays in the queue until it runs """
+        self.stage()
+        with self.lock:
+            if not self.queue:
+                self.state = "finished"
+                return self.status()
+            staged = self.staged
+            if staged["errors"]:
+                self.enabled = False
+                self.state = "error"
+                self.last_error = "%s: %s" % (staged["name"], staged["errors"])
+                return self.status()
+            name = staged["name"]
+            self.state = "starting"
+        self.worker.submit(self.run_file, name).wait()
+        return self.status()
+
+    def run_file(self, name):
+        """ Open and start a file. Runs on the command worker. The run counts as started once the controller
+        accepted it, snapshots polled before that are ignored """
+        self.error_cursor = self.controller.error_log.last_seq
+        self.reached = 0
+        self.run_started = STARTING
+        try:
+            self.controller.open_file(self.folder, name)
+            result = self.controller.run_program("start")
+        except Exception as err:
+            self.run_started = None
+            self.fail(err)
+            raise
+        with self.lock:
+            if self.queue and self.queue[0] == name:
+                self.queue.pop(0)
+            self.staged = None
+        self.started(name, time.time())
+        return result
+
+    def fail(self, err):
+        """ Stop the queue after a failed changeover """
+        with self.lock:
+            self.enabled = False
+            self.state = "error"
+            self.last_error = err.args[0] if err.args else str(err)
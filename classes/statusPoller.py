@@ -0,0 +1,125 @@
+import time
+import threading
+from collections import namedtuple
+
+VitalsSnapshot = namedtuple("VitalsSnapshot", ["version", "timestamp", "vitals"])
+
+
+def diff_vitals(old, new):
+    """ Return the keys of new that differ from old. Nested dicts only contain their changed keys """
+    delta = {}
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            nested = diff_vitals(old[key], value)
+            if nested:
+                delta[key] = nested
+        elif key not in old or old[key] != value:
+            delta[key] = value
+    return delta
+
+
+def parse_fields(fields):
+    """ Turn "position,program.interp_state" into a selection tree: {"position": True, "program": {"interp_state": True}}.
+    Raises ValueError for empty names """
+    selection = {}
+    for field in fields.split(","):
+        names = field.strip().split(".")
+        if not all(names):
+            raise ValueError(field)
+        node = selection
+        for name in names[:-1]:
+            if node.get(name) is True:
+                break
+            node = node.setdefault(name, {})
+        else:
+            node[names[-1]] = True
+    return selection
+
+
+def select_fields(vitals, selection):
+    """ Copy only the selected subtrees of the vitals. Raises KeyError for unknown fields """
+    selected = {}
+    for name, nested in selection.items():
+        value = vitals[name]
+        if nested is True:
+            selected[name] = value
+        elif isinstance(value, dict):
+            selected[name] = select_fields(value, nested)
+        else:
+            raise KeyError(name)
+    return selected
+
+
+class StatusPoller(threading.Thread):
+    """ Background thread that owns the status channel and publishes versioned vitals snapshots.
+    Snapshots are shared between all requests and must never be mutated """
+    def __init__(self, controller, interval=0.05, idle_interval=0.5):
+        super(StatusPoller, self).__init__()
+        self.daemon = True
+        self.controller = controller
+        self.stat = controller.create_stat()
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.condition = threading.Condition()
+        self.polling = False
+        self.latest = None
+        # Selections of the latest snapshot by fields, so clients that poll the same fields share one result
+        self.selections = {}
+        # Versions restart with the server, the epoch keeps ETags from older runs from matching
+        self.epoch = "%x" % int(time.time() * 1000)
+
+    def run(self):
+        """ Poll fast while the interpreter is busy and slow down when the machine is idle """
+        self.polling = True
+        while self.polling:
+            try:
+                snapshot = self.refresh()
+                idle = snapshot.vitals["program"]["interp_state"] == "INTERP_IDLE"
+            except Exception:
+                idle = True
+            time.sleep(self.idle_interval if idle else self.interval)
+
+    def stop(self):
+        """ Stop the poller after the current cycle """
+        self.polling = False
+
+    def refresh(self):
+        """ Poll the machine once. Publish a new version only when the vitals changed. Snapshots are stamped with
+        the time the poll began, so nothing that happened after it is attributed to them """
+        with self.condition:
+            polled = time.time()
+            vitals = self.controller.get_all_vitals(self.stat)
+            if self.latest is None or vitals != self.latest.vitals:
+                version = self.latest.version + 1 if self.latest else 1
+                self.latest = VitalsSnapshot(version, polled, vitals)
+                self.condition.notify_all()
+            return self.latest
+
+    def snapshot(self):
+        """ Return the latest snapshot. Polls on demand when the background thread isn't running """
+        snapshot = self.latest
+        if snapshot is None or not self.is_alive():
+            return self.refresh()
+        return snapshot
+
+    def select(self, fields, snapshot=None):
+        """ Return the given fields of a snapshot, defaults to the latest. Raises ValueError/KeyError for invalid fields """
+        snapshot = snapshot or self.snapshot()
+        key = (snapshot.version, fields)
+        selected = self.selections.get(key)
+        if selected is None:
+            selected = select_fields(snapshot.vitals, parse_fields(fields))
+            if len(self.selections) > 32:
+                self.selections = {}
+            self.selections[key] = selected
+        return selected
+
+    def wait_for_change(self, version, timeout=None):
+        """ Block until a snapshot newer than version is published or the timeout expires """
+        if not self.is_alive():
+            time.sleep(self.interval)
+            return self.refresh()
+        with self.condition:
+            if self.latest is None or self.latest.version <= version:
+                self.condition.wait(timeout)
+            return self.latest
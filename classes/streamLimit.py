@@ -0,0 +1,54 @@
+import threading
+
+
+class StreamLimit(object):
+    """ Caps the number of open event streams. A stream keeps a server thread for as long as the client listens,
+    so without a cap streams could take every thread of the pool and starve the short requests """
+    def __init__(self, limit):
+        self.limit = limit
+        self.open = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Take a slot. Returns False when all slots are taken """
+        with self.lock:
+            if self.open >= self.limit:
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.open -= 1
+
+    def hold(self, body):
+        """ Wrap a response body so its slot is given back when the server closes the response """
+        return HeldStream(body, self.release)
+
+
+class HeldStream(object):
+    """ Response body that releases its stream slot once when it is closed, also when it was never iterated """
+    def __init__(self, body, release):
+        self.body = body
+        self.iterator = iter(body)
+        self.release = release
+        self.released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+    next = __next__
+
+    def close(self):
+        if self.released:
+            return
+        self.released = True
+        try:
+            close = getattr(self.body, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self.release()
@@ -0,0 +1,127 @@
+import time
+import threading
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INTERP_STATES = ["INTERP_IDLE", "INTERP_READING", "INTERP_PAUSED", "INTERP_WAITING"]
+TASK_MODES = ["MODE_MANUAL", "MODE_AUTO", "MODE_MDI"]
+
+
+class TelemetryHistory(threading.Thread):
+    """ Samples the latest vitals snapshot at a fixed rate into a preallocated ring buffer, one column per channel.
+    States are stored as their linuxcnc number. Queries are downsampled to min/max/mean per time bucket """
+    def __init__(self, poller, axes, rate=10, seconds=3600):
+        super(TelemetryHistory, self).__init__()
+        self.daemon = True
+        self.poller = poller
+        self.rate = rate
+        self.channels = list(axes) + [
+            "spindle_speed", "feedrate", "spindlerate", "interp_state",
+            "task_mode"
+        ]
+        self.capacity = int(rate * seconds)
+        self.times = numpy.zeros(self.capacity)
+        self.values = numpy.zeros((self.capacity, len(self.channels)))
+        self.axes = list(axes)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.sampling = False
+
+    def run(self):
+        self.sampling = True
+        interval = 1.0 / self.rate
+        next_sample = time.time()
+        while self.sampling:
+            try:
+                self.sample()
+            except Exception:
+                pass
+            next_sample += interval
+            delay = next_sample - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_sample = time.time()
+
+    def stop(self):
+        """ Stop sampling """
+        self.sampling = False
+
+    def row(self, vitals):
+        """ The channel values of a vitals dict in column order """
+        position = vitals["position"]
+        spindle = vitals["spindle"]
+        program = vitals["program"]
+        return [position[axis]["pos"] for axis in self.axes] + [
+            spindle["spindle_speed"], program["feedrate"],
+            spindle["spindlerate"],
+            INTERP_STATES.index(program["interp_state"]) + 1,
+            TASK_MODES.index(program["task_mode"]) + 1
+        ]
+
+    def sample(self):
+        """ Store the latest snapshot. Doesn't poll the machine, the status poller does that """
+        snapshot = self.poller.latest or self.poller.snapshot()
+        row = self.row(snapshot.vitals)
+        with self.lock:
+            index = self.count % self.capacity
+            self.times[index] = time.time()
+            self.values[index] = row
+            self.count += 1
+
+    def window(self, start, end):
+        """ Return copies of the samples between start and end, oldest first """
+        with self.lock:
+            if self.count <= self.capacity:
+                segments = [(0, self.count)]
+            else:
+                split = self.count % self.capacity
+                segments = [(split, self.capacity), (0, split)]
+            times = []
+            values = []
+            # Every segment is sorted by time, only the part inside the window is copied
+            for begin, stop in segments:
+                first = begin + numpy.searchsorted(self.times[begin:stop], start, side="left")
+                last = begin + numpy.searchsorted(self.times[begin:stop], end, side="right")
+                times.append(self.times[first:last])
+                values.append(self.values[first:last])
+            return numpy.concatenate(times), numpy.concatenate(values)
+
+    def query(self, start, end, points):
+        """ Downsample the samples between start and end to at most points buckets of equal duration.
+        Empty buckets are left out """
+        if not self.is_alive():
+            self.sample()
+        times, values = self.window(start, end)
+        result = {
+            "from": start,
+            "to": end,
+            "rate": self.rate,
+            "time": [],
+            "series": dict((channel, {"min": [], "max": [], "mean": []})
+                           for channel in self.channels)
+        }
+        if not len(times):
+            return result
+
+        span = max(end - start, 1e-9)
+        buckets = numpy.minimum(((times - start) / span * points).astype(int),
+                                points - 1)
+        # Times are sorted so every bucket is one contiguous run of samples
+        starts = numpy.flatnonzero(
+            numpy.concatenate(([True], buckets[1:] != buckets[:-1])))
+        counts = numpy.diff(numpy.append(starts, len(times)))
+        minimum = numpy.minimum.reduceat(values, starts)
+        maximum = numpy.maximum.reduceat(values, starts)
+        mean = numpy.add.reduceat(values, starts) / counts[:, None]
+
+        result["time"] = (start + (buckets[starts] + 0.5) * span / points).round(3).tolist()
+        for column, channel in enumerate(self.channels):
+            result["series"][channel] = {
+                "min": minimum[:, column].round(4).tolist(),
+                "max": maximum[:, column].round(4).tolist(),
+                "mean": mean[:, column].round(4).tolist()
+            }
+        return result
@@ -0,0 +1,227 @@
+import os
+import json
+import math
+import array
+import threading
+from collections import OrderedDict
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from classes.gcodeAnalysis import GcodeReader, arc_geometry, file_hash
+
+# Tolerance of every level of detail as fraction of the toolpath diagonal. Level 0 has the most detail
+LOD_TOLERANCES = (0.0001, 0.0005, 0.002, 0.01)
+ARC_STEP = math.radians(5)
+
+
+def arc_points(start, target, arc, clockwise, axes):
+    """ Interpolate a G2/G3 arc in its plane. The other axes move linearly """
+    first, second = arc["plane"][:2]
+    center_first, center_second, radius, begin, sweep = arc_geometry(
+        start, target, arc, clockwise)
+    steps = max(int(sweep / ARC_STEP), 1)
+    direction = -1 if clockwise else 1
+
+    points = []
+    for step in range(1, steps + 1):
+        fraction = float(step) / steps
+        angle = begin + direction * sweep * fraction
+        point = []
+        for axis in axes:
+            if axis == first:
+                point.append(center_first + radius * math.cos(angle))
+            elif axis == second:
+                point.append(center_second + radius * math.sin(angle))
+            else:
+                point.append(start[axis] + (target[axis] - start[axis]) * fraction)
+        points.append(point)
+    points[-1] = [target[axis] for axis in axes]
+    return points
+
+
+def read_toolpath(path, axes):
+    """ Read a program as runs of rapid or cutting moves. Returns [(rapid, flat array of points)] """
+    runs = []
+    with open(path, "rb") as gcode:
+        rapid = None
+        points = None
+        for motion, start, target, arc, named in GcodeReader(gcode).moves():
+            if (motion == 0) is not rapid:
+                rapid = motion == 0
+                points = array.array("d", [start[axis] for axis in axes])
+                runs.append((rapid, points))
+            if motion in (2, 3):
+                for point in arc_points(start, target, arc, motion == 2, axes):
+                    points.extend(point)
+            else:
+                points.extend([target[axis] for axis in axes])
+    return runs
+
+
+def douglas_peucker(points, tolerance):
+    """ Vectorized Douglas-Peucker on an (n, axes) array. Returns the indices of the points to keep """
+    count = len(points)
+    keep = numpy.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        offsets = points[first + 1:last] - points[first]
+        direction = points[last] - points[first]
+        length = direction.dot(direction)
+        if length > 0:
+            offsets = offsets - numpy.outer(offsets.dot(direction) / length,
+                                            direction)
+        distances = numpy.sqrt((offsets * offsets).sum(axis=1))
+        index = int(distances.argmax())
+        if distances[index] > tolerance:
+            middle = first + 1 + index
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return numpy.flatnonzero(keep)
+
+
+def tile_path(cache_dir, digest, lod):
+    """ Path of a cached level of detail """
+    return os.path.join(cache_dir, "%s-%d.json" % (digest, lod))
+
+
+def build_preview(path, cache_dir, digest, axes):
+    """ Parse a program once and write every level of detail to the cache. Runs in a worker process """
+    runs = [(rapid, numpy.frombuffer(points, dtype=float).reshape(-1, len(axes)))
+            for rapid, points in read_toolpath(path, axes)]
+    if runs:
+        every_point = numpy.concatenate([points for rapid, points in runs])
+        diagonal = float(numpy.linalg.norm(every_point.max(axis=0) - every_point.min(axis=0)))
+    else:
+        diagonal = 0.0
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    for lod, fraction in enumerate(LOD_TOLERANCES):
+        tolerance = diagonal * fraction
+        paths = [{
+            "rapid": rapid,
+            "points": points[douglas_peucker(points, tolerance)].round(4).tolist()
+        } for rapid, points in runs]
+        tile = {
+            "axes": [axis.lower() for axis in axes],
+            "lod": lod,
+            "tolerance": round(tolerance, 6),
+            "paths": paths
+        }
+        with open(tile_path(cache_dir, digest, lod) + ".tmp", "w") as cache:
+            json.dump(tile, cache, separators=(",", ":"))
+        os.rename(tile_path(cache_dir, digest, lod) + ".tmp",
+                  tile_path(cache_dir, digest, lod))
+
+
+class ToolpathPreview(object):
+    """ Decimated toolpath polylines of the uploaded programs, lined up with the axes of the machine.
+    Levels of detail are cached on disk per content hash and the most recent ones are kept in memory.
+    Only the newest keep programs stay in the disk cache """
+    def __init__(self, folder, axes, analyzer=None, memory=8, keep=64):
+        self.folder = folder
+        self.cache_dir = os.path.join(folder, ".preview")
+        self.axes = [axis.upper() for axis in axes]
+        self.analyzer = analyzer
+        self.memory = memory
+        self.keep = keep
+        self.tiles = OrderedDict()
+        # Set when the build of a content hash is done, by content hash
+        self.building = {}
+        self.lock = threading.Lock()
+
+    def digest(self, name):
+        """ Content hash of a file. Known hashes come from the analyzer """
+        if self.analyzer is not None:
+            info = self.analyzer.files.get(name)
+            if info and info.get("hash"):
+                return info["hash"]
+        return file_hash(os.path.join(self.folder, name))
+
+    def get(self, name, lod):
+        """ Return the toolpath of a file at the given level of detail. A file that changed while it was built
+        or tiles that were pruned before they were read are tried once more. Raises IOError/OSError when the
+        file can't be read """
+        try:
+            return self.load(name, lod)
+        except (IOError, OSError):
+            return self.load(name, lod)
+
+    def load(self, name, lod):
+        """ Look up, build or read the tile. The lock is only held for the lookups, so other files are served
+        while one is built """
+        key = (self.digest(name), lod)
+        with self.lock:
+            tile = self.tiles.get(key)
+        if tile is not None:
+            return tile
+
+        path = tile_path(self.cache_dir, key[0], lod)
+        if not os.path.exists(path):
+            self.build_once(name, key[0])
+        with open(path) as cache:
+            tile = json.load(cache)
+        with self.lock:
+            self.tiles[key] = tile
+            while len(self.tiles) > self.memory:
+                self.tiles.popitem(last=False)
+        return tile
+
+    def build_once(self, name, digest):
+        """ Build a content hash unless it is built already. Concurrent requests for it wait for the first one """
+        with self.lock:
+            if os.path.exists(tile_path(self.cache_dir, digest, len(LOD_TOLERANCES) - 1)):
+                return
+            done = self.building.get(digest)
+            if done is None:
+                done = self.building[digest] = threading.Event()
+                building = True
+            else:
+                building = False
+        if not building:
+            done.wait()
+            return
+
+        try:
+            self.build(name, digest)
+        finally:
+            with self.lock:
+                self.building.pop(digest, None)
+            done.set()
+        self.prune()
+
+    def build(self, name, digest):
+        """ Build on the analyzer process pool when it runs, so parsing doesn't compete with the web server """
+        args = (os.path.join(self.folder, name), self.cache_dir, digest,
+                self.axes)
+        pool = self.analyzer.pool if self.analyzer is not None else None
+        if pool is None:
+            build_preview(*args)
+        else:
+            pool.apply(build_preview, args)
+
+    def prune(self):
+        """ Delete the tiles of the oldest content hashes above keep. Hashes that are being built are kept """
+        built = {}
+        for name in os.listdir(self.cache_dir):
+            try:
+                mtime = os.path.getmtime(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            digest = name.split("-", 1)[0]
+            built[digest] = max(built.get(digest, 0), mtime)
+        oldest = sorted(built, key=built.get, reverse=True)[self.keep:]
+        with self.lock:
+            oldest = set(oldest) - set(self.building)
+        for name in os.listdir(self.cache_dir):
+            if name.split("-", 1)[0] in oldest:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
@@ -0,0 +1,145 @@
+import json
+import time
+import random
+import logging
+import threading
+import configparser
+from collections import OrderedDict
+from logging.handlers import RotatingFileHandler
+from flask import request
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("default.ini")
+
+# Trace every request, otherwise only requests with the trace header and the sampled ones are traced
+TRACE_ALL = CONFIG['server'].get('trace') == 'true'
+TRACE_HEADER = "X-Trace"
+TRACE_LOG = CONFIG['server'].get('trace_log')
+TRACE_SAMPLE = float(CONFIG['server'].get('trace_sample') or 0)
+LOCAL = threading.local()
+LOG = logging.getLogger("webui.trace")
+
+
+class Trace(object):
+    """ Durations of the stages of one request. A stage that runs more than once is added up and counted """
+    def __init__(self, sampled=False):
+        self.started = time.time()
+        self.sampled = sampled
+        self.authorized = False
+        self.stages = OrderedDict()
+
+    def add(self, name, duration):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [duration, 1]
+        else:
+            stage[0] += duration
+            stage[1] += 1
+
+    def server_timing(self):
+        """ Format the stages as Server-Timing header value, durations in milliseconds """
+        timings = []
+        for name, (duration, count) in list(self.stages.items()):
+            timing = "%s;dur=%.3f" % (name, duration * 1000)
+            if count > 1:
+                timing += ';desc="%d calls"' % count
+            timings.append(timing)
+        return ", ".join(timings)
+
+    def as_dict(self):
+        return OrderedDict((name, {"ms": round(duration * 1000, 3), "calls": count})
+                           for name, (duration, count) in list(self.stages.items()))
+
+
+def current():
+    """ Return the trace of the request the current thread works for, None when it isn't traced """
+    return getattr(LOCAL, "trace", None)
+
+
+def activate(trace):
+    """ Make the current thread record into a trace, None stops recording """
+    LOCAL.trace = trace
+
+
+def authorize():
+    """ Mark the trace of the current request as one of an authenticated client """
+    trace = getattr(LOCAL, "trace", None)
+    if trace is not None:
+        trace.authorized = True
+
+
+def record(name, duration):
+    """ Add a stage to the current trace. Costs one attribute lookup when the request isn't traced """
+    trace = getattr(LOCAL, "trace", None)
+    if trace is not None:
+        trace.add(name, duration)
+
+
+class stage(object):
+    """ Context manager that records the duration of a stage into the current trace """
+    __slots__ = ("name", "trace", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = current()
+        if self.trace is not None:
+            self.started = time.time()
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.name, time.time() - self.started)
+
+
+def traced(name):
+    """ Decorator that records every call of a function as stage """
+    def real_decorator(func):
+        def traced_wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        traced_wrapper.__name__ = func.__name__
+        return traced_wrapper
+
+    return real_decorator
+
+
+def instrument(app):
+    """ Trace the requests of the app and return the stages in the Server-Timing header. The header is only sent to
+    authenticated clients, unless every request is traced """
+    if TRACE_LOG and not LOG.handlers:
+        handler = RotatingFileHandler(TRACE_LOG, maxBytes=1024 * 1024, backupCount=3)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        LOG.addHandler(handler)
+        LOG.setLevel(logging.INFO)
+        LOG.propagate = False
+
+    @app.before_request
+    def start_trace():
+        sampled = bool(TRACE_LOG) and random.random() < TRACE_SAMPLE
+        if TRACE_ALL or sampled or TRACE_HEADER in request.headers:
+            activate(Trace(sampled))
+        else:
+            activate(None)
+
+    @app.after_request
+    def finish_trace(response):
+        trace = current()
+        if trace is None:
+            return response
+        activate(None)
+        trace.add("total", time.time() - trace.started)
+        if trace.authorized or TRACE_ALL:
+            response.headers["Server-Timing"] = trace.server_timing()
+        if trace.sampled:
+            LOG.info(json.dumps({
+                "time": trace.started,
+                "method": request.method,
+                "endpoint": request.endpoint,
+                "status": response.status_code,
+                "stages": trace.as_dict()
+            }))
+        return response
+
+    return app
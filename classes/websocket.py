@@ -0,0 +1,164 @@
+import time
+import socket
+import struct
+import base64
+import hashlib
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_HEADER = 8192
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+class WebSocketError(Exception):
+    """ The peer broke the protocol or went away """
+
+
+def read_request(sock):
+    """ Read the HTTP upgrade request. Returns (path, headers) with lower case header names """
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = sock.recv(1024)
+        if not chunk:
+            raise WebSocketError("Connection closed during handshake")
+        data += chunk
+        if len(data) > MAX_HEADER:
+            raise WebSocketError("Handshake too large")
+
+    lines = data.split(b"\r\n\r\n")[0].decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3 or parts[0] != "GET":
+        raise WebSocketError("Not a websocket upgrade")
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return parts[1], headers
+
+
+def accept(sock, headers):
+    """ Complete the handshake of a valid upgrade request """
+    key = headers.get("sec-websocket-key")
+    if not key or "websocket" not in headers.get("upgrade", "").lower():
+        raise WebSocketError("Not a websocket upgrade")
+    digest = hashlib.sha1((key + GUID).encode("latin-1")).digest()
+    sock.sendall(("HTTP/1.1 101 Switching Protocols\r\n"
+                  "Upgrade: websocket\r\n"
+                  "Connection: Upgrade\r\n"
+                  "Sec-WebSocket-Accept: %s\r\n\r\n" %
+                  base64.b64encode(digest).decode("latin-1")).encode("latin-1"))
+
+
+def reject(sock, status, reason, body):
+    """ Refuse the upgrade with a plain HTTP response """
+    body = body.encode("utf-8")
+    sock.sendall(("HTTP/1.1 %d %s\r\n"
+                  "Content-Type: application/json\r\n"
+                  "Content-Length: %d\r\n"
+                  "Connection: close\r\n\r\n" %
+                  (status, reason, len(body))).encode("latin-1") + body)
+
+
+class WebSocket(object):
+    """ Server side of an accepted websocket connection. Only small messages are accepted """
+    def __init__(self, sock, max_size=4096):
+        self.sock = sock
+        self.max_size = max_size
+        self.closed = False
+        self.deadline = None
+        # True while a frame is read only in part
+        self.partial = False
+
+    def read_exact(self, size):
+        data = b""
+        while len(data) < size:
+            if self.deadline is not None:
+                remaining = self.deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("Deadline passed")
+                self.sock.settimeout(remaining)
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise WebSocketError("Connection closed")
+            data += chunk
+        return data
+
+    def read_frame(self):
+        """ Read one frame. Returns (fin, opcode, payload) """
+        first, second = struct.unpack("!BB", self.read_exact(2))
+        self.partial = True
+        if not second & 0x80:
+            raise WebSocketError("Client frames must be masked")
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self.read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self.read_exact(8))[0]
+        if length > self.max_size:
+            raise WebSocketError("Message too large")
+        mask = bytearray(self.read_exact(4))
+        payload = bytearray(self.read_exact(length))
+        for index in range(length):
+            payload[index] ^= mask[index % 4]
+        self.partial = False
+        return bool(first & 0x80), first & 0x0F, bytes(payload)
+
+    def receive(self, deadline=None):
+        """ Return the next text or binary message. Answers pings and returns None when the peer closes.
+        Raises socket.timeout when the message isn't complete by deadline, control frames don't extend it """
+        self.deadline = deadline
+        try:
+            return self.read_message()
+        finally:
+            if deadline is not None:
+                self.deadline = None
+                self.sock.settimeout(None)
+
+    def read_message(self):
+        """ Read frames up to the last one of a message """
+        message = b""
+        while True:
+            fin, opcode, payload = self.read_frame()
+            if opcode == OP_PING:
+                self.send_frame(OP_PONG, payload)
+            elif opcode == OP_PONG:
+                continue
+            elif opcode == OP_CLOSE:
+                self.close()
+                return None
+            else:
+                message += payload
+                if len(message) > self.max_size:
+                    raise WebSocketError("Message too large")
+                if fin:
+                    return message
+
+    def send_frame(self, opcode, payload):
+        """ Server frames are never masked """
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        self.sock.sendall(header + payload)
+
+    def send(self, text):
+        """ Send a text message """
+        self.send_frame(OP_TEXT, text.encode("utf-8"))
+
+    def close(self, code=1000):
+        """ Send a close frame once """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.send_frame(OP_CLOSE, struct.pack("!H", code))
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,124 @@
+import sys
+import settings
+from classes.statusPoller import StatusPoller
+from classes.commandWorker import CommandWorker
+from classes.halcmdPool import HalcmdPool
+from classes.fileCatalog import FileCatalog
+from classes.chunkedUpload import UploadManager
+from classes.gcodeAnalysis import GcodeAnalyzer
+from classes.toolpathPreview import ToolpathPreview
+from classes.programWindow import ProgramWindow
+from classes.queueRunner import QueueRunner
+from classes.jogChannel import JogServer
+from classes.jobRecorder import JobRecorder
+from classes.streamLimit import StreamLimit
+from classes import telemetryHistory
+from decorators.auth import ip_allowed
+
+
+def start_components(config, jog=True):
+    """ Create the shared components in settings from the configuration and start their threads.
+    The jog server only starts when jog is set and a jog_port is configured """
+    folder = config['storage']['upload_folder']
+    settings.init()
+    settings.catalog = FileCatalog(folder)
+    # Well below the threads of the server, the other threads stay free for the short requests
+    settings.streams = StreamLimit(int(config['server']['max_streams']))
+    settings.uploads = UploadManager(folder,
+                                     int(config['storage']['upload_expiry']))
+    # Sessions start on first use, the controller sets the toolchange pin through the pool
+    settings.halcmd = HalcmdPool(int(config['server']['halcmd_sessions']),
+                                 float(config['server']['halcmd_timeout']))
+
+    if config['server']['mock'] == 'true':
+        from mock.machinekitController import MachinekitController
+        settings.controller = MachinekitController(
+            float(config['server']['stat_freshness']), settings.halcmd)
+        settings.machinekit_running = True
+    else:
+        import linuxcnc
+        from classes.machinekitController import MachinekitController
+
+        try:
+            settings.controller = MachinekitController(
+                config["server"]["axis_config"],
+                float(config["server"]["stat_freshness"]), settings.halcmd)
+            settings.machinekit_running = True
+        except (linuxcnc.error) as err:
+            print(
+                "Machinekit is down please start machinekit and then restart the server"
+            )
+        except Exception as err:
+            sys.exit({"errors": [err]})
+
+    if settings.machinekit_running:
+        settings.poller = StatusPoller(
+            settings.controller, float(config['server']['status_interval']),
+            float(config['server']['status_idle_interval']))
+        settings.worker = CommandWorker()
+        values = settings.poller.snapshot().vitals["values"]
+        settings.analyzer = GcodeAnalyzer(
+            folder, settings.controller.max_velocity or values["velocity"],
+            values["max_acceleration"], settings.controller.linear_units)
+        # Fork the analysis processes before any thread runs, a child could inherit a lock one of them holds
+        settings.analyzer.start()
+
+    settings.catalog.start()
+    if not settings.machinekit_running:
+        return
+    settings.poller.start()
+    settings.controller.error_log.start()
+    settings.worker.start()
+    settings.catalog.subscribe(settings.analyzer.sync)
+    settings.preview = ToolpathPreview(folder, settings.controller.axes,
+                                       settings.analyzer)
+    settings.program_window = ProgramWindow(folder)
+    settings.program_window.start()
+    settings.queue_runner = QueueRunner(
+        settings.poller,
+        settings.worker,
+        settings.controller,
+        folder,
+        settings.file_queue,
+        settings.catalog,
+        settings.analyzer,
+        settings.program_window,
+        confirm=config['server'].get('queue_confirm') == 'true')
+    settings.queue_runner.start()
+    if telemetryHistory.numpy is not None:
+        settings.history = telemetryHistory.TelemetryHistory(
+            settings.poller, settings.controller.axes,
+            float(config['server']['history_rate']),
+            float(config['server']['history_seconds']))
+        settings.history.start()
+    settings.recorder = JobRecorder(settings.poller, settings.controller.axes,
+                                    config['storage']['recording_folder'],
+                                    int(config['server']['recording_records']),
+                                    int(config['server']['recording_keep']))
+    settings.recorder.start()
+    if jog and config['server'].get('jog_port'):
+        settings.jog_server = JogServer(settings.controller,
+                                        config['server']['host'],
+                                        int(config['server']['jog_port']),
+                                        config['security']['token'],
+                                        float(config['server']['jog_deadman']),
+                                        ip_allowed)
+        settings.jog_server.start()
+
+
+def stop_components():
+    """ Stop the background threads so the interpreter doesn't shut down under them, and the analysis processes """
+    if settings.jog_server is not None:
+        settings.jog_server.close()
+    threads = [thread for thread in (settings.queue_runner, settings.recorder,
+                                     settings.history, settings.poller,
+                                     settings.catalog) if thread is not None]
+    if settings.controller is not None and settings.machinekit_running:
+        threads.append(settings.controller.error_log)
+    for thread in threads:
+        thread.stop()
+    for thread in threads:
+        thread.join(2)
+    if settings.analyzer is not None and settings.analyzer.pool is not None:
+        settings.analyzer.pool.terminate()
+        settings.analyzer.pool.join()
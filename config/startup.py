@@ -6,6 +6,10 @@ from routes.status.status import status
 from routes.program.program import program
 from routes.spindle.spindle import spindle
 from routes.files.files import files
+from routes.jobs.jobs import jobs
+from routes.metrics.metrics import metrics
+from classes import metrics as collected
+from classes import tracing
 
 
 def app():
@@ -17,4 +21,7 @@ def app():
     app.register_blueprint(spindle)
     app.register_blueprint(program)
     app.register_blueprint(files)
-    return app
+    app.register_blueprint(jobs)
+    app.register_blueprint(metrics)
+    collected.instrument(app)
+    return tracing.instrument(app)
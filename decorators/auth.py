@@ -1,6 +1,7 @@
 import json
 import configparser
 from flask import request
+from classes.tracing import stage, authorize
 CONFIG = configparser.ConfigParser()
 CONFIG.read("default.ini")
 
@@ -13,34 +14,45 @@ IP_AUTH_ENABLED = (CONFIG['security'].get('ip_authentication_enabled') ==
                    'true') if True else False
 
 
+def ip_allowed(ip, write):
+    """ Check an address against the black- and whitelist. Only whitelisted addresses may write """
+    if not IP_AUTH_ENABLED:
+        return True
+    if ip in BLACKLIST:
+        return False
+    return not write or ip in WHITELIST
+
+
+def check_request():
+    """ Return the error response for a request that isn't allowed, None when it is """
+    if not ip_allowed(request.remote_addr,
+                      request.method in ["POST", "UPDATE", "PUT"]):
+        return {
+            "errors": MESSAGE['whitelist-error']
+        }, MESSAGE['whitelist-error']['status']
+
+    headers = request.headers
+    if not "API_KEY" in headers:
+        return {
+            "errors": MESSAGE['authorization']
+        }, MESSAGE['authorization']['status']
+
+    authentication = headers.get("API_KEY")
+    if authentication != CONFIG['security']['token']:
+        return {
+            "errors": MESSAGE['authorization']
+        }, MESSAGE['authorization']['status']
+    return None
+
+
 def auth(func):
     """ Decorator that checks if the machine returned any errors."""
     def wrapper(*args, **kwargs):
-        if IP_AUTH_ENABLED:
-            ip = request.remote_addr
-            if ip in BLACKLIST:
-                return {
-                    "errors": MESSAGE['whitelist-error']
-                }, MESSAGE['whitelist-error']['status']
-
-            if request.method in ["POST", "UPDATE", "PUT"]:
-                if ip not in WHITELIST:
-                    return {
-                        "errors": MESSAGE['whitelist-error']
-                    }, MESSAGE['whitelist-error']['status']
-
-        headers = request.headers
-        if not "API_KEY" in headers:
-            return {
-                "errors": MESSAGE['authorization']
-            }, MESSAGE['authorization']['status']
-
-        authentication = headers.get("API_KEY")
-        if authentication != CONFIG['security']['token']:
-            return {
-                "errors": MESSAGE['authorization']
-            }, MESSAGE['authorization']['status']
-
+        with stage("auth"):
+            denied = check_request()
+        if denied is not None:
+            return denied
+        authorize()
         return func(*args, **kwargs)
 
     wrapper.__name__ = func.__name__
@@ -0,0 +1,31 @@
+from flask import request, make_response
+from decorators.negotiate import response_format, JSON
+from classes.tracing import stage
+
+
+def conditional(etag_func):
+    """Answers requests with a matching If-None-Match header with 304 before the route runs"""
+    def real_decorator(func):
+        def conditional_wrapper(*args, **kwargs):
+            """Compare the current ETag with the one the client has"""
+            with stage("etag"):
+                etag = etag_func()
+            mimetype = response_format()
+            if mimetype != JSON:
+                etag = "%s-%s" % (etag, mimetype.split("/")[-1])
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"
+            response.vary.add("Accept")
+            return response
+
+        conditional_wrapper.__name__ = func.__name__
+        return conditional_wrapper
+
+    return real_decorator
@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from flask import request, Response
+from classes.tracing import stage
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+ENCODERS = OrderedDict([(JSON, None)])
+if msgpack is not None:
+    ENCODERS[MSGPACK] = lambda value: msgpack.packb(value, use_bin_type=True)
+    ENCODERS["application/x-msgpack"] = ENCODERS[MSGPACK]
+if cbor2 is not None:
+    ENCODERS[CBOR] = cbor2.dumps
+# Encoded bodies of the most recent results. Snapshots are shared and never mutated, so they are encoded once
+CACHE_SIZE = 16
+CACHE = OrderedDict()
+CACHE_LOCK = threading.Lock()
+
+
+def response_format():
+    """ Return the mimetype the client prefers. JSON when it has no preference or asks for something we can't encode """
+    return request.accept_mimetypes.best_match(list(ENCODERS), default=JSON)
+
+
+def ordered(value):
+    """ Copy a result with the keys of every dict sorted and text as unicode, so the encoding is always the same """
+    if isinstance(value, dict):
+        return OrderedDict((ordered(key), ordered(value[key]))
+                           for key in sorted(value))
+    if isinstance(value, (list, tuple)):
+        return [ordered(item) for item in value]
+    if isinstance(value, bytes) and not isinstance(value, type(u"")):
+        return value.decode("utf-8", "replace")
+    return value
+
+
+def encode(value, mimetype):
+    """ Encode a result, reusing the body when the same result object was encoded before """
+    key = (id(value), mimetype)
+    with CACHE_LOCK:
+        cached = CACHE.get(key)
+        if cached is not None and cached[0] is value:
+            return cached[1]
+    body = ENCODERS[mimetype](ordered(value))
+    with CACHE_LOCK:
+        # The result is kept in the cache so its id can't be reused by another object
+        CACHE[key] = (value, body)
+        while len(CACHE) > CACHE_SIZE:
+            CACHE.popitem(last=False)
+    return body
+
+
+def negotiate(func):
+    """Decorator that encodes the result as MessagePack or CBOR when the Accept header asks for it. JSON stays the default"""
+    def negotiate_wrapper(*args, **kwargs):
+        mimetype = response_format()
+        result = func(*args, **kwargs)
+        if mimetype == JSON:
+            return result
+
+        rest = ()
+        if isinstance(result, tuple):
+            result, rest = result[0], result[1:]
+        if not isinstance(result, (dict, list)):
+            return (result, ) + rest if rest else result
+        with stage("encode"):
+            body = encode(result, mimetype)
+        response = Response(body, mimetype=mimetype)
+        return (response, ) + rest if rest else response
+
+    negotiate_wrapper.__name__ = func.__name__
+    return negotiate_wrapper
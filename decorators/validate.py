@@ -1,5 +1,6 @@
 from flask import request
 from marshmallow import ValidationError
+from classes.tracing import stage
 
 
 def validate(schema):
@@ -7,8 +8,9 @@ def validate(schema):
     def real_decorator(func):
         def validate_wrapper(*args, **kwargs):
             """Validate marshmallow schema"""
-            req = request.json
-            errors = schema().load(req)
+            with stage("validate"):
+                req = request.json
+                errors = schema().load(req)
 
             if errors.errors:
                 raise ValidationError(errors.errors)
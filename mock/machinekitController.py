@@ -1,13 +1,40 @@
 #!/usr/bin/python
+import os
+import time
+import threading
+from classes.errorLog import ErrorLog
+from classes.commandChannel import CommandChannel
+from classes.metrics import timed
+from classes.tracing import stage, traced
+
+AXIS_LETTERS = "XYZABCUVW"
+
+
+def serialized(func):
+    """ Decorator that runs a command under the controller lock, so commands never interleave"""
+    name = "controller." + func.__name__
+
+    def wrapper(self, *args, **kwargs):
+        with stage(name), self.lock:
+            return func(self, *args, **kwargs)
+
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
 def checkerrors(func):
     """ Decorator that checks if the machine returned any errors."""
-    def wrapper(*args, **kwargs):
-        errors = func(*args, **kwargs)
+    name = "controller." + func.__name__
+
+    def wrapper(self, *args, **kwargs):
+        with stage(name), self.lock:
+            errors = func(self, *args, **kwargs)
         if 'errors' in errors:
             raise RuntimeError(errors['errors'], 502, "RuntimeError")
         else:
             return {"success": "Command executed"}
 
+    wrapper.__name__ = func.__name__
     return wrapper
 
 
@@ -44,6 +71,9 @@ class linuxcnc():
     BRAKE_ENGAGE = 1
     BRAKE_RELEASE = 0
 
+    NML_ERROR = 1
+    OPERATOR_ERROR = 11
+
     class Stat():
         """Simulates machinekit stat class"""
         def __init__(self):
@@ -74,6 +104,8 @@ class linuxcnc():
             self.max_velocity = 50
             self.max_acceleration = 5000
             self.pocket_prepped = -1
+            self.current_line = 0
+            self.motion_line = 0
 
         def poll(self):
             return True
@@ -91,7 +123,12 @@ class linuxcnc():
     class Command():
         """Simulates machinekit command class"""
         def __init__(self):
-            """"""
+            self.sent = []
+
+        def mdi(self, command):
+            """Records the MDI commands it was sent"""
+            self.sent.append(command)
+
         def wait_complete(self):
             return True
 
@@ -103,17 +140,26 @@ class linuxcnc():
         def __init__(self):
             """"""
         def poll(self):
-            return True
+            return None
 
 
 class MachinekitController():
     """ The Machinekit python interface in a class """
-    def __init__(self):
+    def __init__(self, stat_freshness=0.02, halcmd=None):
         self.s = linuxcnc.Stat()
-        self.c = linuxcnc.Command()
+        self.c = CommandChannel(linuxcnc.Command(), self.invalidate)
         self.e = linuxcnc.ErrorChannel()
+        self.stat_freshness = stat_freshness
+        self.polled_at = None
+        self.lock = threading.RLock()
+        self.error_log = ErrorLog(
+            self.e, (linuxcnc.NML_ERROR, linuxcnc.OPERATOR_ERROR))
         self.axes = self.set_axes()
         self.axes_with_cords = {}
+        self.toolchange_request = None
+        self.jogging = {}
+        self.max_velocity = self.s.max_velocity
+        self.linear_units = "mm"
 
     # Class is split up in getters and setters
 
@@ -137,76 +183,103 @@ class MachinekitController():
             i += 1
         return axes_in_machine
 
-    def interp_state(self):
+    def poll(self):
+        """ Poll the stat channel, unless the last snapshot is younger than the freshness window """
+        now = time.time()
+        if self.polled_at is None or now - self.polled_at > self.stat_freshness:
+            with timed("stat.poll"):
+                self.s.poll()
+            self.polled_at = now
+
+    def invalidate(self):
+        """ Called after every command, the next poll() reads the new state """
+        self.polled_at = None
+
+    def create_stat(self):
+        """ Return the status channel for the background poller. The mock shares its simulated state"""
+        return self.s
+
+    def interp_state(self, stat=None):
         """Return machine interp state"""
-        self.s.poll()
+        stat = stat or self.s
+        stat.poll()
         modes = [
             "INTERP_IDLE", "INTERP_READING", "INTERP_PAUSED", "INTERP_WAITING"
         ]
-        state = self.s.interp_state
+        state = stat.interp_state
         return modes[state - 1]
 
-    def task_mode(self):
+    def task_mode(self, stat=None):
         """Return machine task mode"""
+        stat = stat or self.s
         modes = ["MODE_MANUAL", "MODE_AUTO", "MODE_MDI"]
-        return modes[self.s.task_mode - 1]
+        return modes[stat.task_mode - 1]
 
-    def axes_position(self):
+    def axes_position(self, stat=None):
         """ Loop over axes and return position: {"[axe]": {"homed": bool, "pos": float}} """
+        stat = stat or self.s
+        axes_with_cords = {}
         i = 0
         while i < len(self.axes):
-            homed = bool(self.s.axis[i]["homed"])
-            pos = round(self.s.axis[i]['pos'], 3)
-            self.axes_with_cords[self.axes[i]] = {"pos": pos, "homed": homed}
+            homed = bool(stat.axis[i]["homed"])
+            pos = round(stat.axis[i]['pos'], 3)
+            axes_with_cords[self.axes[i]] = {"pos": pos, "homed": homed}
             i += 1
 
-        return self.axes_with_cords
+        self.axes_with_cords = axes_with_cords
+        return axes_with_cords
 
     def errors(self):
         """ Read the machine error channel. Dummy function in mock"""
         return {}
 
+    @serialized
     def ready_for_mdi_commands(self):
         """ Returns bool that represents if the machine is ready for MDI commands """
-        self.s.poll()
+        self.poll()
         return not self.s.estop and self.s.enabled and self.s.homed and (
             self.s.interp_state == linuxcnc.INTERP_IDLE)
 
-    def rcs_state(self):
+    def rcs_state(self, stat=None):
         """Return machines rcs state"""
+        stat = stat or self.s
         modes = ["RCS_DONE", "RCS_EXEC", "RCS_ERROR"]
-        return modes[self.s.state - 1]
+        return modes[stat.state - 1]
 
-    def get_all_vitals(self):
+    def get_all_vitals(self, stat=None):
         """Return all vital machine information"""
-        self.s.poll()
+        stat = stat or self.s
+        with timed("stat.poll"):
+            stat.poll()
         return {
             "power": {
-                "enabled": self.s.enabled,
-                "estop": bool(self.s.estop)
+                "enabled": stat.enabled,
+                "estop": bool(stat.estop)
             },
-            "position": self.axes_position(),
+            "position": self.axes_position(stat),
             "spindle": {
-                "spindle_speed": self.s.spindle_speed,
-                "spindle_enabled": self.s.spindle_enabled,
-                "spindle_brake": self.s.spindle_brake,
-                "spindle_direction": self.s.spindle_direction,
-                "spindle_increasing": self.s.spindle_increasing,
-                "spindle_override_enabled": self.s.spindle_override_enabled,
-                "spindlerate": self.s.spindlerate,
-                "tool_in_spindle": self.s.tool_in_spindle
+                "spindle_speed": stat.spindle_speed,
+                "spindle_enabled": stat.spindle_enabled,
+                "spindle_brake": stat.spindle_brake,
+                "spindle_direction": stat.spindle_direction,
+                "spindle_increasing": stat.spindle_increasing,
+                "spindle_override_enabled": stat.spindle_override_enabled,
+                "spindlerate": stat.spindlerate,
+                "tool_in_spindle": stat.tool_in_spindle
             },
             "program": {
-                "file": self.s.file,
-                "interp_state": self.interp_state(),
-                "task_mode": self.task_mode(),
-                "feedrate": self.s.feedrate,
-                "rcs_state": self.rcs_state(),
-                "tool_change": self.s.pocket_prepped
+                "file": stat.file,
+                "interp_state": self.interp_state(stat),
+                "task_mode": self.task_mode(stat),
+                "feedrate": stat.feedrate,
+                "rcs_state": self.rcs_state(stat),
+                "tool_change": stat.pocket_prepped,
+                "current_line": stat.current_line,
+                "motion_line": stat.motion_line
             },
             "values": {
-                "velocity": self.s.velocity,
-                "max_acceleration": self.s.max_acceleration
+                "velocity": stat.velocity,
+                "max_acceleration": stat.max_acceleration
             }
         }
 
@@ -214,7 +287,7 @@ class MachinekitController():
     @checkerrors
     def machine_status(self, command):
         """ Toggle estop and power with command estop || power"""
-        self.s.poll()
+        self.poll()
         if command == "estop":
             if self.s.estop == linuxcnc.STATE_ESTOP:
                 self.s.estop = linuxcnc.STATE_ESTOP_RESET
@@ -242,7 +315,7 @@ class MachinekitController():
     def mdi_command(self, command):
         """ Send a MDI movement command to the machine, example "Y1 X1 Z-1" """
         # Check if the machine is ready for mdi commands
-        self.s.poll()
+        self.poll()
         if self.s.interp_state is not linuxcnc.INTERP_IDLE:
             return {
                 "errors":
@@ -268,10 +341,46 @@ class MachinekitController():
 
         return self.errors()
 
+    @serialized
+    def mdi_batch(self, commands):
+        """ Send MDI commands one after the other and stop at the first error. Commands that start with an axis
+        word get a G0 and move the axes. Returns the result per command """
+        self.poll()
+        if self.s.interp_state is not linuxcnc.INTERP_IDLE:
+            raise RuntimeError(
+                "Cannot execute command when machine interp state isn't idle",
+                502, "RuntimeError")
+        self.s.task_mode = linuxcnc.MODE_MDI
+
+        results = []
+        error = None
+        for command in commands:
+            if error is not None:
+                results.append({"command": command, "status": "skipped"})
+                continue
+            try:
+                if command.lstrip()[:1].upper() in AXIS_LETTERS:
+                    self.mdi_command(command)
+                    self.c.mdi(str("G0 " + command))
+                else:
+                    self.c.mdi(str(command))
+                results.append({"command": command, "status": "done"})
+            except (RuntimeError, ValueError) as err:
+                error = str(err.args[0])
+                results.append({
+                    "command": command,
+                    "status": "failed",
+                    "error": error
+                })
+
+        if error is not None:
+            return {"errors": error, "results": results}
+        return {"success": "Commands executed", "results": results}
+
     @checkerrors
     def manual_control(self, axes, speed, increment):
         """ Manual continious transmission. axes=int speed=int in mm increment=int in mm"""
-        self.s.poll()
+        self.poll()
         if self.s.interp_state is not linuxcnc.INTERP_IDLE:
             raise RuntimeError(
                 "Cannot execute command when machine interp state isn't idle",
@@ -280,6 +389,42 @@ class MachinekitController():
         self.s.axis[int(axes)]['pos'] += int(increment)
         return self.errors()
 
+    def lock_for_jog(self):
+        """ Take the command lock without waiting like the controller"""
+        if not self.lock.acquire(False):
+            raise RuntimeError("Machine is busy with another command", 409,
+                               "RuntimeError")
+
+    def jog_start(self, axis, velocity):
+        """ Simulate a continuous jog. Only remembers the velocity"""
+        self.lock_for_jog()
+        try:
+            if self.s.interp_state is not linuxcnc.INTERP_IDLE:
+                raise RuntimeError(
+                    "Cannot execute command when machine interp state isn't idle",
+                    502, "RuntimeError")
+            self.s.task_mode = linuxcnc.MODE_MANUAL
+            self.jogging[axis] = velocity
+        finally:
+            self.lock.release()
+
+    def jog_increment(self, axis, velocity, distance):
+        """ Simulate an incremental jog"""
+        self.lock_for_jog()
+        try:
+            if self.s.interp_state is not linuxcnc.INTERP_IDLE:
+                raise RuntimeError(
+                    "Cannot execute command when machine interp state isn't idle",
+                    502, "RuntimeError")
+            self.s.task_mode = linuxcnc.MODE_MANUAL
+            self.s.axis[axis]['pos'] += distance
+        finally:
+            self.lock.release()
+
+    def jog_stop(self, axis):
+        """ Stop a simulated jog"""
+        self.jogging.pop(axis, None)
+
     @checkerrors
     def home_all_axes(self, command):
         """ Set all axes home """
@@ -301,6 +446,7 @@ class MachinekitController():
         self.c.wait_complete()
         return self.errors()
 
+    @serialized
     def run_program(self, command):
         """ Command = start || pause || stop || resume = default"""
         self.ensure_mode(linuxcnc.MODE_AUTO, linuxcnc.MODE_MDI)
@@ -321,7 +467,7 @@ class MachinekitController():
     @checkerrors
     def task_run(self, start_line=0):
         """ Run program from line """
-        self.s.poll()
+        self.poll()
         if self.s.task_mode not in (
                 linuxcnc.MODE_AUTO,
                 linuxcnc.MODE_MDI) or self.s.interp_state in (
@@ -337,7 +483,7 @@ class MachinekitController():
     @checkerrors
     def task_pause(self):
         """ Pause current program """
-        self.s.poll()
+        self.poll()
         if self.s.interp_state is linuxcnc.INTERP_PAUSED:
             return {"errors": "Machine is already paused."}
         if self.s.task_mode not in (
@@ -355,7 +501,7 @@ class MachinekitController():
     @checkerrors
     def task_resume(self):
         """ Resume current program """
-        self.s.poll()
+        self.poll()
         if self.s.task_mode not in (
                 linuxcnc.MODE_AUTO, linuxcnc.MODE_MDI
         ) or self.s.interp_state is not linuxcnc.INTERP_PAUSED:
@@ -375,9 +521,10 @@ class MachinekitController():
 
         return self.errors()
 
+    @traced("ensure_mode")
     def ensure_mode(self, m, *p):
         """ Ensure that the machine is in given mode. If not switch the mode """
-        self.s.poll()
+        self.poll()
         if self.s.task_mode == m or self.s.task_mode in p:
             return True
         if self.running(do_poll=False):
@@ -389,13 +536,13 @@ class MachinekitController():
     def running(self, do_poll=True):
         """Check if machine is running"""
         if do_poll:
-            self.s.poll()
+            self.poll()
         return self.s.task_mode == linuxcnc.MODE_AUTO and self.s.interp_state is not linuxcnc.INTERP_IDLE
 
     @checkerrors
     def spindle_brake(self, command):
         """ Engage the spindle brake"""
-        self.s.poll()
+        self.poll()
         brake_command = None
 
         if "brake_engage" in command:
@@ -418,7 +565,7 @@ class MachinekitController():
     @checkerrors
     def spindle_direction(self, command):
         """ Command takes parameters spindle_forward and spindle_reverse"""
-        self.s.poll()
+        self.poll()
         commands = {
             "spindle_forward": linuxcnc.SPINDLE_FORWARD,
             "spindle_reverse": linuxcnc.SPINDLE_REVERSE,
@@ -437,7 +584,7 @@ class MachinekitController():
     @checkerrors
     def spindle_speed(self, command):
         """ Command takes parameters spindle_increase and spindle_decrease """
-        self.s.poll()
+        self.poll()
 
         if not self.s.spindle_enabled:
             return {
@@ -478,25 +625,25 @@ class MachinekitController():
     @checkerrors
     def feedoverride(self, value):
         """ Feed override float between 0 and 1.2"""
-        self.s.poll()
+        self.poll()
         self.s.feedrate = value
         return self.errors()
 
     @checkerrors
-    def open_file(self, path):
+    def open_file(self, path, file_name):
         """ Open file in the /files dir on the beagleboi """
-        self.s.poll()
+        self.poll()
 
         if self.s.interp_state is not linuxcnc.INTERP_IDLE:
             return {"errors": "Cannot execute command when interp is not idle"}
 
-        self.s.file = path
+        self.s.file = os.path.join(path + "/" + file_name) if file_name else ""
         return self.errors()
 
     @checkerrors
     def set_offset(self):
         """Set machine offset"""
-        self.s.poll()
+        self.poll()
 
         if self.s.interp_state is not linuxcnc.INTERP_IDLE:
             return {"errors": "Cannot execute command when interp is not idle"}
@@ -504,3 +651,39 @@ class MachinekitController():
         # toolno, z_offset,  x_offset, diameter, frontangle, backangle, orientation
         # self.s.tool_offset(int, float, float, float, float, float, int)
         return self.errors()
+
+    @serialized
+    def tool_change(self):
+        """ Simulate an acknowledged toolchange"""
+        self.toolchange_request = {
+            "requested": time.time(),
+            "tool_in_spindle": self.s.tool_in_spindle,
+            "pocket_prepped": self.s.pocket_prepped
+        }
+        if self.s.pocket_prepped != -1:
+            self.s.tool_in_spindle = self.s.pocket_prepped
+            self.s.pocket_prepped = -1
+        return {"success": "Toolchange requested"}
+
+    def toolchange_status(self, vitals):
+        """ Return if the last toolchange request has been acknowledged according to the given vitals. A request
+        without a prepped tool can't be acknowledged and isn't pending either """
+        tool_in_spindle = vitals["spindle"]["tool_in_spindle"]
+        pocket_prepped = vitals["program"]["tool_change"]
+        request = self.toolchange_request
+        prepped = request is not None and request["pocket_prepped"] != -1
+        acknowledged = request is None or (prepped and (
+            tool_in_spindle != request["tool_in_spindle"]
+            or pocket_prepped != request["pocket_prepped"]))
+        status = {
+            "acknowledged": acknowledged,
+            "pending": not acknowledged and prepped,
+            "requested": request["requested"] if request else None,
+            "tool_in_spindle": tool_in_spindle,
+            "pocket_prepped": pocket_prepped
+        }
+        if request is not None and not prepped:
+            status["message"] = "No tool prepped"
+        if request and "errors" in request:
+            status["errors"] = request["errors"]
+        return status
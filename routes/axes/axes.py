@@ -1,11 +1,12 @@
 import json
 import settings
 from decorators.auth import auth
+from routes.jobs.jobs import run_command
 from decorators.errors import errors
 from decorators.validate import validate
 from flask import Blueprint, request, escape
 from marshmallow import Schema
-from schemas.schemas import HomeSchema, CommandSchema, ManualControlSchema
+from schemas.schemas import HomeSchema, CommandSchema, ManualControlSchema, MdiBatchSchema
 
 axes = Blueprint('axes', __name__)
 with open("./jsonFiles/errorMessages.json") as f:
@@ -25,7 +26,7 @@ def set_home_axes():
     """ Reset all axes to the home position """
     data = request.sanitizedRequest
     command = escape(data['command'])
-    return settings.controller.home_all_axes(command)
+    return run_command(settings.controller.home_all_axes, command)
 
 
 @axes.route("/machinekit/position/mdi",
@@ -38,7 +39,23 @@ def send_command():
     """ Send an MDI command to control individual axes """
     data = request.sanitizedRequest
     command = escape(data["command"])
-    return settings.controller.mdi_command(command)
+    return run_command(settings.controller.mdi_command, command)
+
+
+@axes.route("/machinekit/position/mdi/batch",
+            endpoint='send_commands',
+            methods=["POST"])
+@auth
+@errors
+@validate(MdiBatchSchema)
+def send_commands():
+    """ Send a list of MDI commands in one request. Execution stops at the first failing command """
+    data = request.sanitizedRequest
+    # The schema only lets G-code words through, escaping would break #<named> parameters
+    result = run_command(settings.controller.mdi_batch, data["commands"])
+    if isinstance(result, dict) and "errors" in result:
+        return result, 502
+    return result
 
 
 @axes.route("/machinekit/position/manual", endpoint='manual', methods=["POST"])
@@ -48,5 +65,5 @@ def send_command():
 def manual():
     """ Manually control individual axe """
     data = request.sanitizedRequest
-    return settings.controller.manual_control(data['axes'], data['speed'],
-                                              data['increment'])
+    return run_command(settings.controller.manual_control, data['axes'],
+                       data['speed'], data['increment'])
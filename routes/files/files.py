@@ -1,14 +1,18 @@
 import os
-import csv
 import json
+import hashlib
 import settings
 import configparser
 from decorators.auth import auth
+from routes.jobs.jobs import run_command
 from decorators.errors import errors
+from decorators.negotiate import negotiate
 from decorators.validate import validate
-from flask import Blueprint, request, escape
-from schemas.schemas import UpdateQueueSchema, OpenFileSchema, HalcmdSchema
+from decorators.conditional import conditional
+from flask import Blueprint, Response, request, escape, stream_with_context
+from schemas.schemas import UpdateQueueSchema, OpenFileSchema, HalcmdSchema, HalBatchSchema, UploadInitSchema, UploadFinalizeSchema
 from werkzeug.utils import secure_filename
+from classes import toolpathPreview
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read("default.ini")
@@ -16,27 +20,64 @@ files = Blueprint('files', __name__)
 with open("./jsonFiles/errorMessages.json") as f:
     MESSAGE = json.load(f)
 
-FILES_ON_SERVER = []
+
+def files_etag():
+    """ ETag of the file list. Built from the catalog and analysis versions and the queue """
+    catalog = settings.catalog
+    catalog.files()
+    queue = hashlib.sha1(json.dumps(settings.file_queue).encode("utf-8"))
+    return "%s-%d-%d-%s" % (catalog.epoch, catalog.version,
+                            settings.analyzer.version,
+                            queue.hexdigest()[:12])
 
 
 @files.route("/server/files", endpoint='return_files', methods=["GET"])
 @auth
 @errors
+@conditional(files_etag)
+@negotiate
 def return_files():
-    """ Return all machinekit files from the server """
+    """ Return all machinekit files from the server with their analysis """
+    files_on_server = settings.catalog.files()
+    return {
+        "result": files_on_server,
+        "analysis": dict((name, settings.analyzer.result(name))
+                         for name, path in files_on_server),
+        "file_queue": settings.file_queue
+    }
+
+
+@files.route("/server/files/<name>/preview",
+             endpoint='preview_file',
+             methods=["GET"])
+@auth
+@errors
+@negotiate
+def preview_file(name):
+    """ Return the toolpath of a file as polylines per axis. ?lod=0 has the most detail, higher levels are decimated more """
+    if toolpathPreview.numpy is None:
+        raise RuntimeError(MESSAGE['numpy-missing']['message'],
+                           MESSAGE['numpy-missing']['status'],
+                           MESSAGE['numpy-missing']['type'])
+    if name not in settings.catalog:
+        raise NameError(MESSAGE['file-not-found']['message'],
+                        MESSAGE['file-not-found']['status'],
+                        MESSAGE['file-not-found']['type'])
     try:
-        global FILES_ON_SERVER
-        FILES_ON_SERVER = []
-        with open("./routes/files/files.csv") as csv_file:
-            reader = csv.DictReader(csv_file)
-            for row in reader:
-                FILES_ON_SERVER.append([row['name'], row['path']])
-
-        return {"result": FILES_ON_SERVER, "file_queue": settings.file_queue}
-    except Exception:
-        return {
-            "errors": MESSAGE['internal-server-error']
-        }, MESSAGE['internal-server-error']['status']
+        lod = int(request.args.get("lod", 1))
+        if lod < 0 or lod >= len(toolpathPreview.LOD_TOLERANCES):
+            raise ValueError()
+    except ValueError:
+        raise ValueError(MESSAGE['invalid-query-parameter']['message'],
+                         MESSAGE['invalid-query-parameter']['status'],
+                         MESSAGE['invalid-query-parameter']['type'])
+
+    try:
+        return settings.preview.get(name, lod)
+    except (IOError, OSError):
+        raise NameError(MESSAGE['file-not-found']['message'],
+                        MESSAGE['file-not-found']['status'],
+                        MESSAGE['file-not-found']['type'])
 
 
 @files.route("/server/update_file_queue",
@@ -51,13 +92,12 @@ def update_file_queue():
     new_queue = data["new_queue"]
 
     for item in new_queue:
-        if not os.path.isfile(CONFIG['storage']['upload_folder'] + "/" +
-                              escape(item)):
+        if escape(item) not in settings.catalog:
             raise NameError(MESSAGE['file-not-found']['message'],
                             MESSAGE['file-not-found']['status'],
                             MESSAGE['file-not-found']['type'])
 
-    settings.file_queue = new_queue
+    settings.file_queue[:] = new_queue
     return {"success": settings.file_queue}
 
 
@@ -68,8 +108,8 @@ def update_file_queue():
 def open_file():
     """ Open a file """
     data = request.sanitizedRequest
-    return settings.controller.open_file(CONFIG['storage']['upload_folder'],
-                                         escape(data["name"]))
+    return run_command(settings.controller.open_file,
+                       CONFIG['storage']['upload_folder'], escape(data["name"]))
 
 
 @files.route("/server/file_upload", endpoint='upload', methods=["POST"])
@@ -84,28 +124,15 @@ def upload():
 
         file = request.files["file"]
         filename = secure_filename(file.filename)
-        file_exists = False
-
-        for item in FILES_ON_SERVER:
-            if item[0] == filename:
-                file_exists = True
-                break
 
-        if file_exists:
+        if filename in settings.catalog:
             raise ValueError(MESSAGE['file-exists']['message'],
                              MESSAGE['file-exists']['status'],
                              MESSAGE['file-exists']['type'])
 
-        with open('./routes/files/files.csv', "a") as csvfile:
-            fieldnames = ['name', 'path']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writerow({
-                'name': filename,
-                'path': CONFIG['storage']['upload_folder']
-            })
-
         file.save(
             os.path.join(CONFIG['storage']['upload_folder'] + "/" + filename))
+        settings.catalog.update(filename)
 
         return {"success": "file added"}, 201
     except ValueError as err:
@@ -123,14 +150,215 @@ def upload():
         }, MESSAGE['internal-server-error']['status']
 
 
+def find_upload(upload_id):
+    """ Return the chunked upload with the given id or raise a 404 """
+    upload = settings.uploads.get(upload_id)
+    if upload is None:
+        raise NameError(MESSAGE['upload-not-found']['message'],
+                        MESSAGE['upload-not-found']['status'],
+                        MESSAGE['upload-not-found']['type'])
+    return upload
+
+
+@files.route("/server/file_upload/chunked",
+             endpoint='upload_init',
+             methods=["POST"])
+@auth
+@errors
+@validate(UploadInitSchema)
+def upload_init():
+    """ Start a chunked upload. Send the chunks with PUT and finish with finalize """
+    data = request.sanitizedRequest
+    filename = secure_filename(data["name"])
+    if not filename:
+        raise NameError(MESSAGE['file-not-found']['message'],
+                        MESSAGE['file-not-found']['status'],
+                        MESSAGE['file-not-found']['type'])
+    if filename in settings.catalog:
+        raise ValueError(MESSAGE['file-exists']['message'],
+                         MESSAGE['file-exists']['status'],
+                         MESSAGE['file-exists']['type'])
+
+    upload = settings.uploads.create(filename, data.get("size"))
+    return upload.as_dict(), 201
+
+
+@files.route("/server/file_upload/chunked/<upload_id>",
+             endpoint='upload_offset',
+             methods=["GET"])
+@auth
+@errors
+@negotiate
+def upload_offset(upload_id):
+    """ Return how much of an upload has been received, resume from this offset """
+    return find_upload(upload_id).as_dict()
+
+
+@files.route("/server/file_upload/chunked/<upload_id>",
+             endpoint='upload_chunk',
+             methods=["PUT"])
+@auth
+@errors
+def upload_chunk(upload_id):
+    """ Append the raw request body at ?offset=. The offset has to match the data received so far """
+    upload = find_upload(upload_id)
+    try:
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        raise ValueError(MESSAGE['invalid-query-parameter']['message'],
+                         MESSAGE['invalid-query-parameter']['status'],
+                         MESSAGE['invalid-query-parameter']['type'])
+
+    if not upload.lock.acquire(False):
+        raise ValueError(MESSAGE['upload-busy']['message'],
+                         MESSAGE['upload-busy']['status'],
+                         MESSAGE['upload-busy']['type'])
+    try:
+        if offset != upload.offset:
+            return {
+                "errors": {
+                    "message": MESSAGE['upload-offset-mismatch']['message'],
+                    "status": MESSAGE['upload-offset-mismatch']['status'],
+                    "type": MESSAGE['upload-offset-mismatch']['type']
+                },
+                "offset": upload.offset
+            }, MESSAGE['upload-offset-mismatch']['status']
+        # The size is checked up front when the length is known and while streaming when it isn't
+        try:
+            if upload.size is not None and request.content_length and (
+                    offset + request.content_length > upload.size):
+                raise ValueError(upload.offset)
+            upload.append(request.stream)
+        except ValueError:
+            return {
+                "errors": {
+                    "message": MESSAGE['upload-too-large']['message'],
+                    "status": MESSAGE['upload-too-large']['status'],
+                    "type": MESSAGE['upload-too-large']['type']
+                },
+                "offset": upload.offset
+            }, MESSAGE['upload-too-large']['status']
+        return upload.as_dict()
+    finally:
+        upload.lock.release()
+
+
+@files.route("/server/file_upload/chunked/<upload_id>",
+             endpoint='upload_discard',
+             methods=["DELETE"])
+@auth
+@errors
+def upload_discard(upload_id):
+    """ Cancel an upload and remove the data received so far, for example to restart after a checksum mismatch """
+    upload = find_upload(upload_id)
+    if not upload.lock.acquire(False):
+        raise ValueError(MESSAGE['upload-busy']['message'],
+                         MESSAGE['upload-busy']['status'],
+                         MESSAGE['upload-busy']['type'])
+    try:
+        settings.uploads.discard(upload)
+        return {"success": "upload discarded"}
+    finally:
+        upload.lock.release()
+
+
+@files.route("/server/file_upload/chunked/<upload_id>/finalize",
+             endpoint='upload_finalize',
+             methods=["POST"])
+@auth
+@errors
+@validate(UploadFinalizeSchema)
+def upload_finalize(upload_id):
+    """ Check the sha256 of the received data and move the upload into the upload folder """
+    data = request.sanitizedRequest
+    upload = find_upload(upload_id)
+    if not upload.lock.acquire(False):
+        raise ValueError(MESSAGE['upload-busy']['message'],
+                         MESSAGE['upload-busy']['status'],
+                         MESSAGE['upload-busy']['type'])
+    try:
+        if upload.size is not None and upload.offset != upload.size:
+            return {
+                "errors": {
+                    "message": MESSAGE['upload-incomplete']['message'],
+                    "status": MESSAGE['upload-incomplete']['status'],
+                    "type": MESSAGE['upload-incomplete']['type']
+                },
+                "offset": upload.offset
+            }, MESSAGE['upload-incomplete']['status']
+        if upload.sha256.hexdigest() != data["sha256"].lower():
+            return {
+                "errors": {
+                    "message": MESSAGE['checksum-mismatch']['message'],
+                    "status": MESSAGE['checksum-mismatch']['status'],
+                    "type": MESSAGE['checksum-mismatch']['type']
+                },
+                "offset": upload.offset
+            }, MESSAGE['checksum-mismatch']['status']
+        if upload.name in settings.catalog:
+            raise ValueError(MESSAGE['file-exists']['message'],
+                             MESSAGE['file-exists']['status'],
+                             MESSAGE['file-exists']['type'])
+
+        settings.uploads.finish(upload)
+        settings.catalog.update(upload.name)
+        return {"success": "file added"}, 201
+    finally:
+        upload.lock.release()
+
+
 @files.route("/machinekit/halcmd", endpoint='halcmd', methods=["POST"])
 @auth
 @errors
 @validate(HalcmdSchema)
 def halcmd():
-    """ Accepts whitelisted halcmds """
+    """ Accepts whitelisted halcmds. Runs them on a pooled halcmd session, ?stream=true streams the output """
     data = request.sanitizedRequest
     command = data["halcmd"]
-    os.system('halcmd ' + command + " > output.txt")
-    output = open("output.txt", "r")
-    return {"success": output.read()}
+    if request.args.get("stream") == "true":
+        return Response(stream_with_context(settings.halcmd.stream(command)),
+                        mimetype="text/plain")
+    return {"success": settings.halcmd.execute(command)}
+
+
+def hal_value(value):
+    """ Format a json value the way halcmd setp expects it """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def halcmd_failed(output):
+    """ halcmd reports errors with the script line it was reading or a HAL: ERROR prefix """
+    return output.startswith("<stdin>") or "ERROR" in output
+
+
+@files.route("/machinekit/hal", endpoint='hal_batch', methods=["POST"])
+@auth
+@errors
+@validate(HalBatchSchema)
+def hal_batch():
+    """ Set and read many HAL pins/params on one pooled halcmd session. Values are set before they are read """
+    data = request.sanitizedRequest
+    set_values = sorted(data.get("set", {}).items())
+    get_names = data.get("get", [])
+    commands = ["setp %s %s" % (name, hal_value(value))
+                for name, value in set_values]
+    commands += ["getp %s" % name for name in get_names]
+    outputs = settings.halcmd.execute_many(commands)
+
+    result = {}
+    changed = []
+    failed = {}
+    for (name, value), output in zip(set_values, outputs[:len(set_values)]):
+        if output.strip():
+            failed[name] = output.strip()
+        else:
+            changed.append(name)
+    for name, output in zip(get_names, outputs[len(set_values):]):
+        if halcmd_failed(output):
+            failed[name] = output.strip()
+        else:
+            result[name] = output.strip()
+
+    return {"result": result, "set": changed, "failed": failed}
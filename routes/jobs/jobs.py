@@ -0,0 +1,43 @@
+import json
+import settings
+from decorators.auth import auth
+from decorators.errors import errors
+from decorators.negotiate import negotiate
+from flask import Blueprint, request, url_for
+
+jobs = Blueprint('jobs', __name__)
+
+with open("./jsonFiles/errorMessages.json") as f:
+    MESSAGE = json.load(f)
+
+
+def run_command(func, *args):
+    """ Run a controller command on the command worker.
+    Returns 202 with a job handle right away when the client asks for async with Prefer: respond-async or ?async=true """
+    job = settings.worker.submit(func, *args)
+    if request.args.get("async") == "true" or "respond-async" in request.headers.get(
+            "Prefer", ""):
+        return {
+            "job": job.as_dict()
+        }, 202, {
+            "Location": url_for('jobs.get_job', job_id=job.id)
+        }
+
+    job.wait()
+    if job.error is not None:
+        raise job.error
+    return job.result
+
+
+@jobs.route("/machinekit/jobs/<job_id>", endpoint='get_job', methods=["GET"])
+@auth
+@errors
+@negotiate
+def get_job(job_id):
+    """ Return the status and result of an asynchronous command """
+    job = settings.worker.get(job_id)
+    if job is None:
+        raise NameError(MESSAGE['job-not-found']['message'],
+                        MESSAGE['job-not-found']['status'],
+                        MESSAGE['job-not-found']['type'])
+    return job.as_dict()
@@ -0,0 +1,14 @@
+from decorators.auth import auth
+from flask import Blueprint, Response
+from classes import metrics as collected
+
+metrics = Blueprint('metrics', __name__)
+EXPOSITION_FORMAT = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@metrics.route("/metrics", endpoint='metrics', methods=["GET"])
+@auth
+def get_metrics():
+    """ Request counts and latencies per endpoint and the duration of controller calls in the Prometheus text format.
+    Works while machinekit is down """
+    return Response(collected.exposition(), mimetype=EXPOSITION_FORMAT)
@@ -1,12 +1,16 @@
 import json
 import settings
+import os
 from decorators.auth import auth
+from routes.jobs.jobs import run_command
 from decorators.errors import errors
-from flask import Blueprint, request, escape
+from decorators.negotiate import negotiate
+from flask import Blueprint, request, escape, send_from_directory
 from marshmallow import Schema
-from schemas.schemas import ProgramSchema
+from schemas.schemas import ProgramSchema, QueueSchema
 from decorators.validate import validate
 program = Blueprint('program', __name__)
+MAX_CONTEXT = 500
 
 with open("./jsonFiles/errorMessages.json") as f:
     MESSAGE = json.load(f)
@@ -21,4 +25,99 @@ with open("./jsonFiles/errorMessages.json") as f:
 def control_program():
     data = request.sanitizedRequest
     command = escape(data['command'])
-    return settings.controller.run_program(command)
+    if command == "stop":
+        # An aborted program must not chain into the next file of the queue
+        settings.queue_runner.disable()
+    return run_command(settings.controller.run_program, command)
+
+
+@program.route("/machinekit/queue", endpoint='queue_status', methods=["GET"])
+@auth
+@errors
+@negotiate
+def queue_status():
+    """ Return the state of the file queue runner and the staged next file """
+    return settings.queue_runner.status()
+
+
+@program.route("/machinekit/queue", endpoint='control_queue', methods=["POST"])
+@auth
+@errors
+@validate(QueueSchema)
+def control_queue():
+    """ start runs the queue, optionally with "confirm": true to wait for the operator between files.
+    stop lets the running program finish and starts nothing after it. confirm starts the next file """
+    data = request.sanitizedRequest
+    runner = settings.queue_runner
+    if data["command"] == "start":
+        return runner.enable(data.get("confirm"))
+    if data["command"] == "stop":
+        return runner.disable()
+    if not runner.waiting():
+        raise RuntimeError(MESSAGE['queue-not-waiting']['message'],
+                           MESSAGE['queue-not-waiting']['status'],
+                           MESSAGE['queue-not-waiting']['type'])
+    return runner.advance()
+
+
+@program.route("/machinekit/program/lines",
+               endpoint='program_lines',
+               methods=["GET"])
+@auth
+@errors
+@negotiate
+def program_lines():
+    """ Return the lines around ?line= of the loaded program, ?context= lines on both sides.
+    Defaults to the line that is being executed """
+    program_status = settings.poller.snapshot().vitals["program"]
+    try:
+        line = int(request.args.get("line", program_status["motion_line"]
+                                    or program_status["current_line"]))
+        context = int(request.args.get("context", 10))
+        if context < 0 or context > MAX_CONTEXT:
+            raise ValueError()
+    except ValueError:
+        raise ValueError(MESSAGE['invalid-query-parameter']['message'],
+                         MESSAGE['invalid-query-parameter']['status'],
+                         MESSAGE['invalid-query-parameter']['type'])
+
+    try:
+        window = settings.program_window.window(program_status["file"], line,
+                                                context)
+    except (IOError, OSError):
+        raise NameError(MESSAGE['file-not-found']['message'],
+                        MESSAGE['file-not-found']['status'],
+                        MESSAGE['file-not-found']['type'])
+    if window is None:
+        return {"status": "indexing"}, 202
+    window["file"] = program_status["file"]
+    return window
+
+
+@program.route("/machinekit/recordings",
+               endpoint='recordings',
+               methods=["GET"])
+@auth
+@errors
+@negotiate
+def recordings():
+    """ Return the telemetry recordings of past jobs, newest first """
+    return {"result": settings.recorder.recordings()}
+
+
+@program.route("/machinekit/recordings/<name>",
+               endpoint='get_recording',
+               methods=["GET"])
+@auth
+@errors
+def get_recording(name):
+    """ Download a recording. Open it with classes.jobRecorder.read_recording """
+    path = settings.recorder.path(name)
+    if path is None:
+        raise NameError(MESSAGE['file-not-found']['message'],
+                        MESSAGE['file-not-found']['status'],
+                        MESSAGE['file-not-found']['type'])
+    return send_from_directory(os.path.dirname(path),
+                               os.path.basename(path),
+                               mimetype="application/octet-stream",
+                               as_attachment=True)
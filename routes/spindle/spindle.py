@@ -1,6 +1,7 @@
 import json
 import settings
 from decorators.auth import auth
+from routes.jobs.jobs import run_command
 from decorators.errors import errors
 from flask import Blueprint, request, escape
 from schemas.schemas import SpindleSpeedSchema, SpindleBrakeSchema, SpindleDirectionSchema, SpindleEnabledSchema, SpindleOverrideSchema
@@ -21,7 +22,7 @@ def set_machinekit_spindle_speed():
     """Control spindle speed"""
     data = request.sanitizedRequest
     command = escape(data["command"])
-    return settings.controller.spindle_speed(command)
+    return run_command(settings.controller.spindle_speed, command)
 
 
 @spindle.route("/machinekit/spindle/brake",
@@ -34,7 +35,7 @@ def set_machinekit_spindle_brake():
     """Enable/disable spindle brake"""
     data = request.sanitizedRequest
     command = escape(data["command"])
-    return settings.controller.spindle_brake(command)
+    return run_command(settings.controller.spindle_brake, command)
 
 
 @spindle.route("/machinekit/spindle/direction",
@@ -47,7 +48,7 @@ def set_machinekit_spindle_direction():
     """Control spindle direction"""
     data = request.sanitizedRequest
     command = escape(data['command'])
-    return settings.controller.spindle_direction(command)
+    return run_command(settings.controller.spindle_direction, command)
 
 
 @spindle.route("/machinekit/spindle/enabled",
@@ -60,7 +61,7 @@ def set_spindle_enabled():
     """Enable/disable spindle"""
     data = request.sanitizedRequest
     command = escape(data["command"])
-    return settings.controller.spindle_enabled(command)
+    return run_command(settings.controller.spindle_enabled, command)
 
 
 @spindle.route("/machinekit/spindle/override",
@@ -72,4 +73,4 @@ def set_spindle_enabled():
 def set_machinekit_spindle_override():
     """Control spindleoverride"""
     data = request.sanitizedRequest
-    return settings.controller.spindleoverride(data["command"])
+    return run_command(settings.controller.spindleoverride, data["command"])
@@ -1,12 +1,17 @@
-import os
-import time
 import json
+import math
+import time
 import settings
 from decorators.auth import auth
+from routes.jobs.jobs import run_command
 from decorators.errors import errors
+from decorators.negotiate import negotiate
+from decorators.conditional import conditional
 from decorators.validate import validate
-from flask import Blueprint, request, escape
+from flask import Blueprint, Response, request, escape, stream_with_context
 import configparser
+from classes.statusPoller import diff_vitals
+from classes import telemetryHistory
 from schemas.schemas import StatusSchema, FeedOverrideSchema, MaxvelOverrideSchema
 
 CONFIG = configparser.ConfigParser()
@@ -16,15 +21,53 @@ status = Blueprint('status', __name__)
 with open("./jsonFiles/errorMessages.json") as f:
     MESSAGE = json.load(f)
 
+STREAM_KEEPALIVE = 15
+HISTORY_POINTS = 500
+MAX_HISTORY_POINTS = 5000
+
+
+def snapshot_etag():
+    """ ETag of the latest vitals snapshot """
+    poller = settings.poller
+    return "%s-%d" % (poller.epoch, poller.snapshot().version)
+
+
+def requested_fields():
+    """ Return the ?fields= selector, checked against the latest snapshot. None selects all vitals """
+    fields = request.args.get("fields")
+    if fields:
+        try:
+            settings.poller.select(fields)
+        except (ValueError, KeyError):
+            raise ValueError(MESSAGE['invalid-query-parameter']['message'],
+                             MESSAGE['invalid-query-parameter']['status'],
+                             MESSAGE['invalid-query-parameter']['type'])
+    return fields
+
+
+def select_vitals(snapshot, fields):
+    """ The vitals of a snapshot, only the selected subtrees when fields are given """
+    if not fields:
+        return snapshot.vitals
+    return settings.poller.select(fields, snapshot)
+
+
+def server_sent_event(event, version, data):
+    """ Format data as a single server-sent event """
+    return "event: %s\nid: %d\ndata: %s\n\n" % (
+        event, version, json.dumps(data, separators=(",", ":")))
+
 
 @status.route("/machinekit/status",
               endpoint='get_machine_status',
               methods=["GET"])
 @auth
 @errors
+@conditional(snapshot_etag)
+@negotiate
 def get_machinekit_status():
-    """Returns machinekit vitals"""
-    return settings.controller.get_all_vitals()
+    """Returns machinekit vitals. ?fields=position,program.interp_state returns only those subtrees"""
+    return select_vitals(settings.poller.snapshot(), requested_fields())
 
 
 @status.route("/machinekit/position",
@@ -32,9 +75,106 @@ def get_machinekit_status():
               methods=["GET"])
 @auth
 @errors
+@conditional(snapshot_etag)
+@negotiate
 def get_machinekit_position():
     """Returns position of axes"""
-    return settings.controller.axes_position()
+    return settings.poller.snapshot().vitals["position"]
+
+
+@status.route("/machinekit/status/stream",
+              endpoint='stream_machinekit_status',
+              methods=["GET"])
+@auth
+@errors
+def stream_machinekit_status():
+    """Stream machinekit vitals as server-sent events. Full snapshot first, then only changed keys.
+    ?fields= limits the stream to those subtrees, changes elsewhere aren't sent. 503 when too many streams are open"""
+    poller = settings.poller
+    fields = requested_fields()
+    if not settings.streams.acquire():
+        raise RuntimeError(MESSAGE['too-many-streams']['message'],
+                           MESSAGE['too-many-streams']['status'],
+                           MESSAGE['too-many-streams']['type'])
+
+    def generate():
+        snapshot = poller.snapshot()
+        vitals = select_vitals(snapshot, fields)
+        yield server_sent_event("snapshot", snapshot.version, vitals)
+        sent = time.time()
+        while True:
+            latest = poller.wait_for_change(snapshot.version, STREAM_KEEPALIVE)
+            if latest.version != snapshot.version:
+                selected = select_vitals(latest, fields)
+                delta = diff_vitals(vitals, selected)
+                snapshot, vitals = latest, selected
+                if delta:
+                    yield server_sent_event("delta", snapshot.version, delta)
+                    sent = time.time()
+                    continue
+            if time.time() - sent >= STREAM_KEEPALIVE:
+                yield ": keepalive\n\n"
+                sent = time.time()
+
+    return Response(settings.streams.hold(stream_with_context(generate())),
+                    mimetype="text/event-stream",
+                    headers={
+                        "Cache-Control": "no-cache",
+                        "X-Accel-Buffering": "no"
+                    })
+
+
+@status.route("/machinekit/history",
+              endpoint='get_machinekit_history',
+              methods=["GET"])
+@auth
+@errors
+@negotiate
+def get_machinekit_history():
+    """Returns the sampled positions, spindle, feed and states between ?from= and ?to= (unix time, defaults to the
+    last 10 minutes) as min/max/mean of at most ?points= buckets"""
+    if telemetryHistory.numpy is None:
+        raise RuntimeError(MESSAGE['numpy-missing']['message'],
+                           MESSAGE['numpy-missing']['status'],
+                           MESSAGE['numpy-missing']['type'])
+    try:
+        end = float(request.args.get("to", time.time()))
+        start = float(request.args.get("from", end - 600))
+        points = int(request.args.get("points", HISTORY_POINTS))
+        if any(math.isnan(value) or math.isinf(value) for value in (start, end)):
+            raise ValueError()
+        if start >= end or points < 1 or points > MAX_HISTORY_POINTS:
+            raise ValueError()
+    except ValueError:
+        raise ValueError(MESSAGE['invalid-query-parameter']['message'],
+                         MESSAGE['invalid-query-parameter']['status'],
+                         MESSAGE['invalid-query-parameter']['type'])
+
+    return settings.history.query(start, end, points)
+
+
+@status.route("/machinekit/errors",
+              endpoint='get_machinekit_errors',
+              methods=["GET"])
+@auth
+@errors
+@negotiate
+def get_machinekit_errors():
+    """Returns the error channel messages after the given sequence number"""
+    try:
+        after = int(request.args.get("after", 0))
+    except ValueError:
+        raise ValueError(MESSAGE['invalid-query-parameter']['message'],
+                         MESSAGE['invalid-query-parameter']['status'],
+                         MESSAGE['invalid-query-parameter']['type'])
+
+    records = settings.controller.error_log.since(after)
+    dropped = records[0].seq - after - 1 if records else 0
+    return {
+        "result": [record._asdict() for record in records],
+        "last_seq": records[-1].seq if records else after,
+        "dropped": max(dropped, 0)
+    }
 
 
 @status.route("/machinekit/status",
@@ -47,7 +187,7 @@ def set_machinekit_status():
     """Power/Estop control"""
     data = request.sanitizedRequest
     command = escape(data['command'])
-    return settings.controller.machine_status(command)
+    return run_command(settings.controller.machine_status, command)
 
 
 @status.route("/machinekit/feed",
@@ -59,7 +199,7 @@ def set_machinekit_status():
 def set_machinekit_feedrate():
     """Control feedrate"""
     data = request.sanitizedRequest
-    return settings.controller.feedoverride(data["command"])
+    return run_command(settings.controller.feedoverride, data["command"])
 
 
 @status.route("/machinekit/maxvel", endpoint='maxvel', methods=["POST"])
@@ -69,7 +209,7 @@ def set_machinekit_feedrate():
 def maxvel():
     """Control maxvel"""
     data = request.sanitizedRequest
-    return settings.controller.maxvel(data["command"])
+    return run_command(settings.controller.maxvel, data["command"])
 
 
 @status.route("/machinekit/toolchange",
@@ -78,12 +218,17 @@ def maxvel():
 @auth
 @errors
 def tool_changer():
-    """Accept toolchange prompt"""
-    if CONFIG['server']['mock'] == 'true':
-        return {"success": "Command executed"}
-
-    # Dirty fix to bypass toolchange prompt
-    os.system("halcmd setp hal_manualtoolchange.change_button true")
-    time.sleep(3)
-    os.system("halcmd setp hal_manualtoolchange.change_button false")
-    return {"success": "Command executed"}
+    """Accept toolchange prompt. Returns right away, poll /machinekit/toolchange/status for the acknowledgement"""
+    return run_command(settings.controller.tool_change)
+
+
+@status.route("/machinekit/toolchange/status",
+              endpoint='tool_changer_status',
+              methods=["GET"])
+@auth
+@errors
+@negotiate
+def tool_changer_status():
+    """Returns if the last toolchange has been acknowledged"""
+    return settings.controller.toolchange_status(
+        settings.poller.snapshot().vitals)
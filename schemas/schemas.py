@@ -1,9 +1,20 @@
 from marshmallow import Schema, fields, validates, ValidationError
+import re
 import json
 
 with open("./jsonFiles/errorMessages.json") as f:
     MESSAGE = json.load(f)
 
+HAL_NAME = re.compile(r"^[A-Za-z0-9_.\-]+$")
+HAL_VALUE = re.compile(r"^[A-Za-z0-9_.+\-]+$")
+HAL_BATCH_LIMIT = 100
+MDI_VALUE = r"[-+]?(?:\d+\.?\d*|\.\d+|#\d+|#<\w+>|\[[^\]\r\n]*\])"
+MDI_LINE = re.compile(
+    r"^[ \t]*(?:(?:[A-Za-z][ \t]*%s|#(?:\d+|<\w+>)[ \t]*=[ \t]*%s|\([^()\r\n]*\))[ \t]*)+\Z" %
+    (MDI_VALUE, MDI_VALUE))
+MDI_LINE_LENGTH = 255
+MDI_BATCH_LIMIT = 50
+
 
 class CommandSchema(Schema):
     """Basic schema for commands"""
@@ -27,6 +38,20 @@ class HomeSchema(CommandSchema):
             raise ValidationError(MESSAGE['invalid-home-command'])
 
 
+class MdiBatchSchema(Schema):
+    """Schema that validates the input for the batched MDI API endpoint"""
+    commands = fields.List(fields.String(), required=True)
+
+    @validates('commands')
+    def validate_commands(self, value):
+        """Validate that every command is a single line of G-code words"""
+        if len(value) < 1 or len(value) > MDI_BATCH_LIMIT:
+            raise ValidationError(MESSAGE['invalid-range'])
+        for command in value:
+            if len(command) > MDI_LINE_LENGTH or not MDI_LINE.match(command):
+                raise ValidationError(MESSAGE['invalid-mdi-command'])
+
+
 class ManualControlSchema(Schema):
     """Schema that validates the input for the manual control API endpoint"""
     axes = fields.Integer(required=True, strict=True)
@@ -120,11 +145,39 @@ class UpdateQueueSchema(Schema):
     new_queue = fields.List(fields.String())
 
 
+class QueueSchema(CommandSchema):
+    """Schema that validates the input for the queue runner API endpoint"""
+    confirm = fields.Boolean()
+
+    @validates('command')
+    def validate_queue(self, value):
+        """Validate that input is either: start, stop or confirm"""
+        if value not in ("start", "stop", "confirm"):
+            raise ValidationError(MESSAGE['invalid-queue-command'])
+
+
 class OpenFileSchema(Schema):
     """Schema that validates the input for the open file API endpoint"""
     name = fields.String(required=True)
 
 
+class UploadInitSchema(Schema):
+    """Schema that validates the input for starting a chunked upload"""
+    name = fields.String(required=True)
+    size = fields.Integer(strict=True)
+
+    @validates("size")
+    def validate_size(self, value):
+        """Validate that size isn't negative"""
+        if value < 0:
+            raise ValidationError(MESSAGE['invalid-range'])
+
+
+class UploadFinalizeSchema(Schema):
+    """Schema that validates the input for finishing a chunked upload"""
+    sha256 = fields.String(required=True)
+
+
 class HalcmdSchema(Schema):
     """Schema that validates the input for the HALCMD API endpoint"""
     halcmd = fields.String(required=True)
@@ -145,5 +198,30 @@ class HalcmdSchema(Schema):
         if not is_in_list:
             raise ValidationError(MESSAGE['invalid-command'])
 
-        if "&&" in value:
+        if "&&" in value or "\n" in value or "\r" in value:
             raise ValidationError(MESSAGE['invalid-multiple-commands'])
+
+
+class HalBatchSchema(Schema):
+    """Schema that validates the input for the batched HAL API endpoint"""
+    get = fields.List(fields.String())
+    set = fields.Dict()
+
+    @validates("get")
+    def validate_get(self, value):
+        """Validate that every name is a HAL pin or param name"""
+        if len(value) > HAL_BATCH_LIMIT:
+            raise ValidationError(MESSAGE['invalid-range'])
+        for name in value:
+            if not HAL_NAME.match(name):
+                raise ValidationError(MESSAGE['invalid-hal-name'])
+
+    @validates("set")
+    def validate_set(self, value):
+        """Validate the names and values of the pins and params to set. Values can't contain whitespace"""
+        if len(value) > HAL_BATCH_LIMIT:
+            raise ValidationError(MESSAGE['invalid-range'])
+        for name, pin_value in value.items():
+            if not HAL_NAME.match(name) or not HAL_VALUE.match(
+                    str(pin_value)):
+                raise ValidationError(MESSAGE['invalid-hal-name'])
@@ -1,32 +1,19 @@
-import sys
+import os
 import configparser
 import settings
 from flask import render_template
 from config.startup import app
+from config.components import start_components, stop_components
 
 app = app()
-settings.init()
 CONFIG = configparser.ConfigParser()
 CONFIG.read("default.ini")
+PRODUCTION = CONFIG['server'].get('production') == 'true'
+DEBUG = CONFIG['server'].get('debug') == 'true' and not PRODUCTION
 
-if CONFIG['server']['mock'] == 'true':
-    from mock.machinekitController import MachinekitController
-    settings.controller = MachinekitController()
-    settings.machinekit_running = True
-else:
-    import linuxcnc
-    from classes.machinekitController import MachinekitController
-
-    try:
-        settings.controller = MachinekitController(
-            CONFIG["server"]["axis_config"])
-        settings.machinekit_running = True
-    except (linuxcnc.error) as err:
-        print(
-            "Machinekit is down please start machinekit and then restart the server"
-        )
-    except Exception as err:
-        sys.exit({"errors": [err]})
+# With debug on, the reloader process runs this module too and must not take the jog port
+start_components(CONFIG,
+                 jog=not DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true")
 
 
 @app.route("/", methods=['GET'])
@@ -48,8 +35,32 @@ def home():
                            port=CONFIG['server']['port'])
 
 
+def serve():
+    """ Serve with cheroot in production. Requests are handled by a thread pool:
+    status reads come from the poller snapshots and commands are serialized by the command worker.
+    Not waitress, it drops headers with an underscore like API_KEY """
+    try:
+        from cheroot.wsgi import Server
+    except ImportError:
+        print("cheroot is not installed, falling back to the threaded development server")
+        app.run(CONFIG['server']['host'],
+                port=CONFIG['server']['port'],
+                threaded=True)
+        return
+    server = Server((CONFIG['server']['host'], int(CONFIG['server']['port'])),
+                    app,
+                    numthreads=int(CONFIG['server']['threads']))
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+        stop_components()
+
+
 if __name__ == "__main__":
-    app.run(
-        CONFIG['server']['host'],
-        debug=((CONFIG['server'].get('debug') == 'true') if True else False),
-        port=CONFIG['server']['port'])
+    if PRODUCTION:
+        serve()
+    else:
+        app.run(CONFIG['server']['host'],
+                debug=DEBUG,
+                port=CONFIG['server']['port'])
@@ -2,6 +2,32 @@ def init():
     global machinekit_running
     global controller
     global file_queue
+    global poller
+    global worker
+    global halcmd
+    global catalog
+    global uploads
+    global analyzer
+    global preview
+    global program_window
+    global queue_runner
+    global jog_server
+    global history
+    global recorder
+    global streams
     machinekit_running = False
     controller = None
+    poller = None
+    worker = None
+    halcmd = None
+    catalog = None
+    uploads = None
+    analyzer = None
+    preview = None
+    program_window = None
+    queue_runner = None
+    jog_server = None
+    history = None
+    recorder = None
+    streams = None
     file_queue = []
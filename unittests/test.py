@@ -1,10 +1,34 @@
+import io
+import os
 import sys
 import json
+import math
+import hashlib
 import time
+import shutil
+import socket
+import struct
+import tempfile
+import threading
 import configparser
 import unittest
 import settings
 from config.startup import app
+from classes.statusPoller import StatusPoller
+from classes.commandWorker import CommandWorker
+from classes.halcmdPool import HalcmdPool
+from classes.fileCatalog import FileCatalog
+from classes.chunkedUpload import UploadManager
+from classes.gcodeAnalysis import GcodeAnalyzer, analyse_file
+from classes.toolpathPreview import ToolpathPreview
+from classes.programWindow import ProgramWindow
+from classes.queueRunner import QueueRunner
+from classes.jogChannel import JogServer
+from classes.jobRecorder import JobRecorder, read_recording
+from classes.streamLimit import StreamLimit
+from classes.statusPoller import VitalsSnapshot
+from classes import telemetryHistory, toolpathPreview, jobRecorder, metrics
+from decorators import negotiate
 from flask import Flask, jsonify
 from flask_testing import TestCase
 
@@ -15,6 +39,9 @@ with open("./jsonFiles/errorMessages.json") as f:
 settings.init()
 config = configparser.ConfigParser()
 config.read("default.ini")
+settings.catalog = FileCatalog(config['storage']['upload_folder'])
+settings.uploads = UploadManager(config['storage']['upload_folder'])
+settings.streams = StreamLimit(int(config['server']['max_streams']))
 
 global homed
 homed = False
@@ -22,7 +49,8 @@ global mock
 mock = False
 if config['server']['mock'] == 'true':
     from mock.machinekitController import MachinekitController
-    settings.controller = MachinekitController()
+    settings.controller = MachinekitController(
+        float(config['server']['stat_freshness']))
     settings.machinekit_running = True
     mock = True
 
@@ -32,7 +60,8 @@ else:
 
     try:
         settings.controller = MachinekitController(
-            config["server"]["axis_config"])
+            config["server"]["axis_config"],
+            float(config["server"]["stat_freshness"]))
         settings.machinekit_running = True
     except (linuxcnc.error) as e:
         print(
@@ -40,6 +69,31 @@ else:
     except Exception as e:
         sys.exit({"errors": [e]})
 
+if settings.machinekit_running:
+    settings.poller = StatusPoller(settings.controller)
+    settings.worker = CommandWorker()
+    settings.halcmd = HalcmdPool()
+    values = settings.controller.get_all_vitals()["values"]
+    settings.analyzer = GcodeAnalyzer(config['storage']['upload_folder'],
+                                      values["velocity"],
+                                      values["max_acceleration"])
+    settings.catalog.subscribe(settings.analyzer.sync)
+    settings.preview = ToolpathPreview(config['storage']['upload_folder'],
+                                       settings.controller.axes,
+                                       settings.analyzer)
+    settings.program_window = ProgramWindow(config['storage']['upload_folder'])
+    settings.queue_runner = QueueRunner(settings.poller, settings.worker,
+                                        settings.controller,
+                                        config['storage']['upload_folder'],
+                                        settings.file_queue, settings.catalog,
+                                        settings.analyzer,
+                                        settings.program_window)
+    if telemetryHistory.numpy is not None:
+        settings.history = telemetryHistory.TelemetryHistory(
+            settings.poller, settings.controller.axes)
+    settings.recorder = JobRecorder(settings.poller, settings.controller.axes,
+                                    tempfile.mkdtemp())
+
 
 def make_orderer():
     order = {}
@@ -55,8 +109,133 @@ def make_orderer():
 
 
 ordered, compare = make_orderer()
+
+
+def jog_frame(text, opcode=0x1):
+    """Encode a masked websocket frame like a pendant sends it, a text frame by default"""
+    payload = bytearray(text.encode("utf-8"))
+    mask = bytearray(b"\x01\x02\x03\x04")
+    for i in range(len(payload)):
+        payload[i] ^= mask[i % 4]
+    return struct.pack("!BB", 0x80 | opcode, 0x80 | len(payload)) + bytes(mask) + bytes(payload)
+
+
+def jog_connect(server):
+    """Open an authenticated websocket to the jog channel"""
+    sock = socket.create_connection(("127.0.0.1", server.port), 5)
+    sock.sendall(("GET /?token=%s HTTP/1.1\r\n"
+                  "Host: localhost\r\n"
+                  "Upgrade: websocket\r\n"
+                  "Connection: Upgrade\r\n"
+                  "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                  "Sec-WebSocket-Version: 13\r\n\r\n" %
+                  config['security'].get("token")).encode("latin-1"))
+    handshake = b""
+    while b"\r\n\r\n" not in handshake:
+        handshake += sock.recv(1)
+    return sock, handshake
+
+
+def jog_reply(sock):
+    """Read a short websocket text frame from the jog channel"""
+    header = bytearray(sock.recv(2))
+    payload = b""
+    while len(payload) < header[1]:
+        payload += sock.recv(header[1] - len(payload))
+    return json.loads(payload.decode("utf-8"))
 unittest.defaultTestLoader.sortTestMethodsUsing = compare
 
+
+class StubHalcmd(object):
+    """Answers setp/getp like halcmd for a fixed set of pins and records the commands it was sent"""
+    def __init__(self, pins):
+        self.pins = pins
+        self.commands = []
+
+    def execute_many(self, commands, timeout=None):
+        outputs = []
+        for command in commands:
+            self.commands.append(command)
+            action, name = command.split(" ")[:2]
+            if name not in self.pins:
+                outputs.append("<stdin>:1: pin or parameter '%s' not found\n" % name)
+            elif action == "setp":
+                self.pins[name] = command.split(" ")[2]
+                outputs.append("")
+            else:
+                outputs.append("%s\n" % self.pins[name])
+        return outputs
+
+class StubErrorLog(object):
+    """Error log without errors"""
+    last_seq = 0
+
+    def since(self, seq):
+        return []
+
+
+class StubQueueController(object):
+    """Records the files the queue runner opens and starts. Starting fails while fail_start is set"""
+    def __init__(self):
+        self.error_log = StubErrorLog()
+        self.started = []
+        self.fail_start = False
+
+    def open_file(self, folder, name):
+        self.opened = name
+
+    def run_program(self, command):
+        if self.fail_start:
+            raise RuntimeError("Machine is not ready", 502, "RuntimeError")
+        self.started.append(self.opened)
+        return {"success": "Command executed"}
+
+
+class StubAnalyzer(object):
+    """Every program has its last move on line 10"""
+    def result(self, name):
+        return {"last_line": 10}
+
+
+def queue_vitals(interp_state, motion_line=0, task_mode="MODE_AUTO", enabled=True, estop=False):
+    """The vitals the queue runner follows"""
+    return {
+        "program": {"interp_state": interp_state, "motion_line": motion_line,
+                    "task_mode": task_mode, "file": "/files/a.ngc"},
+        "power": {"enabled": enabled, "estop": estop}
+    }
+
+
+def queue_runner(test, names, confirm=False):
+    """A queue runner over empty programs that starts the first one. The programs are removed after the test"""
+    folder = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, folder)
+    for name in names:
+        open(os.path.join(folder, name), "w").close()
+    runner = QueueRunner(None, CommandWorker(), StubQueueController(), folder,
+                         list(names), analyzer=StubAnalyzer(), confirm=confirm)
+    runner.check(queue_vitals("INTERP_IDLE"))
+    with runner.lock:
+        runner.enabled = True
+    runner.advance()
+    runner.check(queue_vitals("INTERP_READING", 4))
+    return runner
+
+
+def job_snapshot(version, timestamp, interp_state, task_mode="MODE_AUTO", x=0.0):
+    """A snapshot of the mock vitals with the given program state and x position"""
+    vitals = settings.controller.get_all_vitals()
+    position = dict(vitals["position"])
+    position[settings.controller.axes[0]] = dict(position[settings.controller.axes[0]], pos=x)
+    return VitalsSnapshot(version, timestamp, dict(
+        vitals, position=position,
+        program=dict(vitals["program"], interp_state=interp_state, task_mode=task_mode)))
+
+
+def tearDownModule():
+    shutil.rmtree(settings.recorder.folder, ignore_errors=True)
+
+
 class Startup(TestCase):
 
     def create_app(self):
@@ -85,6 +264,173 @@ class Startup(TestCase):
                 break
         self.assert200(res)
 
+    @ordered
+    def test_pass_get_position(self):
+        """Test should pass and return the position of every axe from the shared status snapshot"""
+        res = self.client.get("/machinekit/position",
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        self.assertEqual(sorted(res.json.keys()),
+                         sorted(settings.controller.axes))
+
+    @ordered
+    def test_pass_status_not_modified(self):
+        """Test should pass and return 304 when the client already has the latest vitals"""
+        res = self.client.get("/machinekit/status",
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        etag = res.headers["ETag"]
+        res = self.client.get("/machinekit/status",
+                              headers={"API_KEY": config['security'].get("token"),
+                                       "If-None-Match": etag})
+        self.assertStatus(res, 304)
+        self.assertEqual(res.headers["ETag"], etag)
+
+    @ordered
+    def test_pass_status_fields(self):
+        """Test should pass and only return the selected subtrees of the vitals"""
+        res = self.client.get("/machinekit/status?fields=position,program.interp_state",
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        self.assertEqual(sorted(res.json.keys()), ["position", "program"])
+        self.assertEqual(list(res.json['program'].keys()), ["interp_state"])
+
+    @ordered
+    def test_fail_status_unknown_field(self):
+        """Test should fail because the vitals have no such field"""
+        res = self.client.get("/machinekit/status?fields=program.unknown",
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert400(res)
+
+    @ordered
+    def test_pass_status_msgpack(self):
+        """Test should pass and return the same vitals as MessagePack when the client asks for it"""
+        if negotiate.msgpack is None:
+            self.skipTest("msgpack is not installed")
+        res = self.client.get("/machinekit/position",
+                              headers={"API_KEY": config['security'].get("token"),
+                                       "Accept": "application/msgpack"})
+        self.assert200(res)
+        self.assertEqual(res.mimetype, "application/msgpack")
+        self.assertEqual(negotiate.msgpack.unpackb(res.data, raw=False),
+                         settings.poller.snapshot().vitals["position"])
+
+    @ordered
+    def test_pass_get_history(self):
+        """Test should pass and return downsampled series of every channel"""
+        if telemetryHistory.numpy is None:
+            self.skipTest("numpy is not installed")
+        res = self.client.get("/machinekit/history?points=10",
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        self.assertLessEqual(len(res.json['time']), 10)
+        for axis in settings.controller.axes:
+            self.assertEqual(len(res.json['series'][axis]['mean']),
+                             len(res.json['time']))
+
+    @ordered
+    def test_fail_get_history_not_finite(self):
+        """Test should fail because the time range isn't a finite number"""
+        if telemetryHistory.numpy is None:
+            self.skipTest("numpy is not installed")
+        for query in ["from=nan", "to=inf", "from=-inf", "from=10&to=5"]:
+            res = self.client.get("/machinekit/history?" + query,
+                                  headers={"API_KEY": config['security'].get("token")})
+            self.assert400(res)
+
+    @ordered
+    def test_pass_get_errors(self):
+        """Test should pass and return the buffered machine errors after the given sequence number"""
+        res = self.client.get("/machinekit/errors?after=0",
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        for record in res.json['result']:
+            self.assertGreater(record['seq'], 0)
+
+    @ordered
+    def test_fail_get_errors_invalid_cursor(self):
+        """Test should fail because the after parameter isn't a number"""
+        res = self.client.get("/machinekit/errors?after=abc",
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert400(res)
+
+    @ordered
+    def test_pass_status_stream(self):
+        """Test should pass and start the vitals stream with a full snapshot"""
+        res = self.client.get("/machinekit/status/stream",
+                              headers={"API_KEY": config['security'].get("token")},
+                              buffered=False)
+        self.assert200(res)
+        self.assertEqual(res.mimetype, "text/event-stream")
+        first_event = next(iter(res.response))
+        self.assertEqual(settings.streams.open, 1)
+        res.close()
+        self.assertIn(b"event: snapshot", first_event)
+        self.assertEqual(settings.streams.open, 0)
+
+    @ordered
+    def test_pass_status_read_while_streams_open(self):
+        """Test should pass and serve a status read on a small cheroot pool while every stream slot is taken,
+        the stream after the limit is refused with 503 and closed streams free their slot"""
+        try:
+            from cheroot.wsgi import Server
+        except ImportError:
+            self.skipTest("cheroot is not installed")
+        from routes.status import status as status_route
+        keepalive = status_route.STREAM_KEEPALIVE
+        status_route.STREAM_KEEPALIVE = 0.2
+        settings.streams = StreamLimit(2)
+        server = Server(("127.0.0.1", 0), self.app, numthreads=3)
+        server.prepare()
+        thread = threading.Thread(target=server.serve)
+        thread.daemon = True
+        thread.start()
+
+        def get(path):
+            sock = socket.create_connection(("127.0.0.1", server.bind_addr[1]), 5)
+            sock.sendall(("GET %s HTTP/1.1\r\nHost: localhost\r\nAPI_KEY: %s\r\n\r\n" % (
+                path, config['security'].get("token"))).encode("latin-1"))
+            head = b""
+            while b"\r\n\r\n" not in head:
+                head += sock.recv(1)
+            return sock, int(head.split(b" ")[1])
+
+        try:
+            streams = [get("/machinekit/status/stream") for _ in range(2)]
+            self.assertEqual([status for sock, status in streams], [200, 200])
+            sock, status = get("/machinekit/status/stream")
+            sock.close()
+            self.assertEqual(status, 503)
+            sock, status = get("/machinekit/position")
+            sock.close()
+            self.assertEqual(status, 200)
+
+            for sock, status in streams:
+                sock.close()
+            for attempt in range(50):
+                if settings.streams.open == 0:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(settings.streams.open, 0)
+        finally:
+            server.stop()
+            status_route.STREAM_KEEPALIVE = keepalive
+            settings.streams = StreamLimit(int(config['server']['max_streams']))
+
+    @ordered
+    def test_pass_controller_commands_serialized(self):
+        """Test should pass and hold a controller command back while another one has the controller lock"""
+        done = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (settings.controller.ready_for_mdi_commands(), done.set()))
+        settings.controller.lock.acquire()
+        try:
+            thread.start()
+            self.assertFalse(done.wait(0.2))
+        finally:
+            settings.controller.lock.release()
+        self.assertTrue(done.wait(2))
+
     @ordered
     def test_fail_invalid_json(self):
         """Test should fail because it doesnt specify the content it is sending"""
@@ -176,6 +522,102 @@ class Startup(TestCase):
         self.assert200(
             res, "Should move axes to given position. Will not work if axes are not homed")
 
+    @ordered
+    def test_pass_mdi_batch(self):
+        """Test should pass and run every command of the batch in order"""
+        command = {"commands": ["Y1 X1 Z1", "Y0 X0 Z0"]}
+        res = self.client.post(
+            '/machinekit/position/mdi/batch', headers={"API_KEY": config['security'].get("token"), "Content-Type": "application/json"}, data=json.dumps(command))
+        self.assert200(
+            res, "Should move axes to given positions. Will not work if axes are not homed")
+        self.assertEqual([result['status'] for result in res.json['results']],
+                         ["done", "done"])
+
+    @ordered
+    def test_pass_mdi_batch_words(self):
+        """Test should pass and only put a G0 in front of the commands that start with an axis word"""
+        command = {"commands": ["G21", "X1"]}
+        res = self.client.post(
+            '/machinekit/position/mdi/batch', headers={"API_KEY": config['security'].get("token"), "Content-Type": "application/json"}, data=json.dumps(command))
+        self.assert200(res)
+        self.assertEqual(settings.controller.c.command.sent[-2:], ["G21", "G0 X1"])
+
+    @ordered
+    def test_pass_jog_deadman(self):
+        """Test should pass and stop a continuous jog when the pendant stops sending frames"""
+        server = JogServer(settings.controller, "127.0.0.1", 0,
+                           config['security'].get("token"), 0.2)
+        server.start()
+        sock, handshake = jog_connect(server)
+        self.assertIn(b" 101 ", handshake.split(b"\r\n")[0])
+
+        sock.sendall(jog_frame('["start", 0, 1]'))
+        self.assertEqual(jog_reply(sock), {"success": "start"})
+        self.assertEqual(jog_reply(sock)['errors'], errorMessages['jog-deadman'])
+        sock.close()
+        server.close()
+
+    @ordered
+    def test_pass_jog_deadman_ignores_pongs(self):
+        """Test should pass and stop a continuous jog when the pendant only sends websocket pongs"""
+        server = JogServer(settings.controller, "127.0.0.1", 0,
+                           config['security'].get("token"), 0.2)
+        server.start()
+        sock = jog_connect(server)[0]
+        sock.sendall(jog_frame('["start", 0, 1]'))
+        self.assertEqual(jog_reply(sock), {"success": "start"})
+        started = time.time()
+        sock.settimeout(0.05)
+        reply = None
+        while reply is None and time.time() - started < 1:
+            sock.sendall(jog_frame("", 0xA))
+            try:
+                reply = jog_reply(sock)
+            except socket.timeout:
+                pass
+        self.assertEqual(reply['errors'], errorMessages['jog-deadman'])
+        self.assertLess(time.time() - started, 0.5)
+        self.assertNotIn(0, settings.controller.jogging)
+        sock.close()
+        server.close()
+
+    @ordered
+    def test_fail_jog_invalid_frame(self):
+        """Test should fail on an invalid frame and stop the axes that were jogging"""
+        server = JogServer(settings.controller, "127.0.0.1", 0,
+                           config['security'].get("token"), 5)
+        server.start()
+        sock = jog_connect(server)[0]
+        sock.sendall(jog_frame('["start", 0, 1]'))
+        self.assertEqual(jog_reply(sock), {"success": "start"})
+        self.assertIn(0, settings.controller.jogging)
+        sock.sendall(jog_frame('["start", 99, 1]'))
+        self.assertEqual(jog_reply(sock)['errors'], errorMessages['invalid-jog-frame'])
+        self.assertNotIn(0, settings.controller.jogging)
+        sock.close()
+        server.close()
+
+    @ordered
+    def test_fail_jog_busy(self):
+        """Test should fail to start a jog while another command holds the controller, stopping still works"""
+        server = JogServer(settings.controller, "127.0.0.1", 0,
+                           config['security'].get("token"), 5)
+        server.start()
+        sock = jog_connect(server)[0]
+        settings.controller.lock.acquire()
+        try:
+            sock.sendall(jog_frame('["start", 0, 1]'))
+            self.assertEqual(jog_reply(sock)['errors']['status'], 409)
+            sock.sendall(jog_frame('["inc", 0, 1, 0.5]'))
+            self.assertEqual(jog_reply(sock)['errors']['status'], 409)
+            sock.sendall(jog_frame('["stop", 0]'))
+            self.assertEqual(jog_reply(sock), {"success": "stop"})
+        finally:
+            settings.controller.lock.release()
+        self.assertNotIn(0, settings.controller.jogging)
+        sock.close()
+        server.close()
+
     @ordered
     def test_pass_spindle_reverse(self):
         """Test should pass and start spinning the spindle counter clockwise"""
@@ -269,6 +711,99 @@ class Startup(TestCase):
             i += 0.1
             self.assert200(res)
 
+    @ordered
+    def test_pass_async_feed_override(self):
+        """Test should pass and return a job handle that reports the result of the command"""
+        command = {"command": 1}
+        res = self.client.post('/machinekit/feed?async=true',
+                               headers={
+                                   "API_KEY": config['security'].get("token"),
+                                   "Content-Type": "application/json"
+                               },
+                               data=json.dumps(command))
+        self.assertStatus(res, 202)
+        job = res.json['job']
+        settings.worker.get(job['id']).wait(5)
+        res = self.client.get('/machinekit/jobs/' + job['id'],
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        self.assertEqual(res.json['status'], "done")
+        self.assertEqual(res.json['result'], {"success": "Command executed"})
+
+    @ordered
+    def test_fail_unknown_job(self):
+        """Test should fail because the job id is unknown"""
+        res = self.client.get('/machinekit/jobs/unknown',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert404(res)
+
+    @ordered
+    def test_pass_job_history_keeps_pending_jobs(self):
+        """Test should pass and keep a running job when more jobs than the history are submitted"""
+        worker = CommandWorker(history=2)
+        worker.start()
+        release = threading.Event()
+        running = worker.submit(release.wait, 5)
+        queued = [worker.submit(time.time) for _ in range(5)]
+        self.assertIs(worker.get(running.id), running)
+        release.set()
+        queued[-1].wait(5)
+        latest = worker.submit(time.time)
+        self.assertIs(worker.get(latest.id), latest)
+        self.assertLessEqual(len(worker.jobs), 2)
+
+    def post_hal_batch(self, command, halcmd):
+        """Post a HAL batch with a stub halcmd pool in place of the real one"""
+        pool, settings.halcmd = settings.halcmd, halcmd
+        try:
+            return self.client.post('/machinekit/hal', data=json.dumps(command),
+                                    headers={"API_KEY": config['security'].get("token"),
+                                             "Content-Type": "application/json"})
+        finally:
+            settings.halcmd = pool
+
+    @ordered
+    def test_pass_hal_batch_set_then_get(self):
+        """Test should pass and read the values after setting them, on one session"""
+        halcmd = StubHalcmd({"spindle.0.speed-in": "0", "motion.enable": "FALSE"})
+        command = {"get": ["spindle.0.speed-in", "motion.enable"],
+                   "set": {"spindle.0.speed-in": 1200, "motion.enable": True}}
+        res = self.post_hal_batch(command, halcmd)
+        self.assert200(res)
+        self.assertEqual(halcmd.commands, ["setp motion.enable true",
+                                           "setp spindle.0.speed-in 1200",
+                                           "getp spindle.0.speed-in",
+                                           "getp motion.enable"])
+        self.assertEqual(res.json['result'], {"spindle.0.speed-in": "1200",
+                                              "motion.enable": "true"})
+        self.assertEqual(sorted(res.json['set']), ["motion.enable", "spindle.0.speed-in"])
+        self.assertEqual(res.json['failed'], {})
+
+    @ordered
+    def test_pass_hal_batch_reports_failures(self):
+        """Test should pass and report the pins halcmd couldn't set or read next to the ones that worked"""
+        halcmd = StubHalcmd({"motion.enable": "TRUE"})
+        command = {"get": ["missing.get", "motion.enable"], "set": {"missing.set": 1}}
+        res = self.post_hal_batch(command, halcmd)
+        self.assert200(res)
+        self.assertEqual(res.json['result'], {"motion.enable": "TRUE"})
+        self.assertEqual(res.json['set'], [])
+        self.assertEqual(sorted(res.json['failed']), ["missing.get", "missing.set"])
+
+    @ordered
+    def test_fail_hal_batch_invalid(self):
+        """Test should fail because of invalid names, values or too many pins, without running halcmd"""
+        halcmd = StubHalcmd({})
+        for command in ({"get": ["motion.enable; loadrt x"]},
+                        {"get": ["motion enable"]},
+                        {"set": {"motion.enable": "1 && rm"}},
+                        {"set": {"bad name": 1}},
+                        {"get": ["pin.%d" % i for i in range(101)]},
+                        {"set": dict(("pin.%d" % i, 1) for i in range(101))}):
+            res = self.post_hal_batch(command, halcmd)
+            self.assert400(res)
+        self.assertEqual(halcmd.commands, [])
+
     @ordered
     def test_pass_maxvel_override(self):
         """Test should pass and control the maxvel slider"""
@@ -286,6 +821,534 @@ class Startup(TestCase):
             i += 300
             self.assert200(res)
 
+    @ordered
+    def test_pass_tool_change(self):
+        """Test should pass and return right away. Without a prepped tool the toolchange status reports the
+        request neither acknowledged nor pending"""
+        settings.controller.s.pocket_prepped = -1
+        settings.controller.invalidate()
+        res = self.client.get('/machinekit/toolchange',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        time.sleep(1)
+        res = self.client.get('/machinekit/toolchange/status',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        self.assertFalse(res.json['acknowledged'])
+        self.assertFalse(res.json['pending'])
+        self.assertEqual(res.json['message'], "No tool prepped")
+
+    @ordered
+    def test_pass_tool_change_acknowledged(self):
+        """Test should pass and report the toolchange acknowledged once the prepped tool is in the spindle"""
+        controller = settings.controller
+        controller.s.pocket_prepped = 3
+        controller.invalidate()
+        controller.toolchange_request = {"requested": time.time(),
+                                         "tool_in_spindle": controller.s.tool_in_spindle,
+                                         "pocket_prepped": 3}
+        res = self.client.get('/machinekit/toolchange/status',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assertFalse(res.json['acknowledged'])
+        self.assertTrue(res.json['pending'])
+        res = self.client.get('/machinekit/toolchange',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        res = self.client.get('/machinekit/toolchange/status',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        self.assertTrue(res.json['acknowledged'])
+        self.assertFalse(res.json['pending'])
+        self.assertEqual(res.json['tool_in_spindle'], 3)
+        self.assertEqual(res.json['pocket_prepped'], -1)
+
+    @ordered
+    def test_pass_chunked_upload(self):
+        """Test should pass and resume an upload at the offset the server reports, reject a wrong offset and a
+        wrong checksum and add the file once it is complete"""
+        headers = {"API_KEY": config['security'].get("token")}
+        data = b"G0 X1\nG1 X2 F100\nM2\n"
+        res = self.client.post('/server/file_upload/chunked',
+                               data=json.dumps({"name": "chunked-test.ngc", "size": len(data)}),
+                               headers=dict(headers, **{"Content-Type": "application/json"}))
+        self.assertStatus(res, 201)
+        upload_id = res.json['upload_id']
+        url = '/server/file_upload/chunked/' + upload_id
+        res = self.client.put(url + '?offset=0', data=data[:6], headers=headers)
+        self.assert200(res)
+        res = self.client.get(url, headers=headers)
+        self.assertEqual(res.json['offset'], 6)
+        res = self.client.put(url + '?offset=0', data=data[6:], headers=headers)
+        self.assertStatus(res, 409)
+        self.assertEqual(res.json['offset'], 6)
+        res = self.client.post(url + '/finalize',
+                               data=json.dumps({"sha256": hashlib.sha256(data).hexdigest()}),
+                               headers=dict(headers, **{"Content-Type": "application/json"}))
+        self.assertStatus(res, 409)
+        res = self.client.put(url + '?offset=6', data=data[6:], headers=headers)
+        self.assert200(res)
+        self.assertEqual(res.json['offset'], len(data))
+        res = self.client.post(url + '/finalize',
+                               data=json.dumps({"sha256": hashlib.sha256(b"other").hexdigest()}),
+                               headers=dict(headers, **{"Content-Type": "application/json"}))
+        self.assert400(res)
+        res = self.client.post(url + '/finalize',
+                               data=json.dumps({"sha256": hashlib.sha256(data).hexdigest()}),
+                               headers=dict(headers, **{"Content-Type": "application/json"}))
+        self.assertStatus(res, 201)
+        self.assertIn("chunked-test.ngc", settings.catalog)
+        os.remove(os.path.join(config['storage']['upload_folder'], "chunked-test.ngc"))
+        settings.catalog.update("chunked-test.ngc")
+
+    @ordered
+    def test_fail_chunked_upload_too_large(self):
+        """Test should fail because the chunk is larger than the announced size, checked before and while streaming"""
+        headers = {"API_KEY": config['security'].get("token")}
+        upload = settings.uploads.create("too-large.ngc", 4)
+        url = '/server/file_upload/chunked/' + upload.id
+        res = self.client.put(url + '?offset=0', data=b"G0 X1\n", headers=headers)
+        self.assert400(res)
+        self.assertEqual(res.json['offset'], 0)
+        self.assertRaises(ValueError, upload.append, io.BytesIO(b"G0 X1\n"))
+        self.assertEqual(upload.offset, 0)
+        res = self.client.delete(url, headers=headers)
+        self.assert200(res)
+        self.assertFalse(os.path.exists(upload.path))
+        res = self.client.get(url, headers=headers)
+        self.assert404(res)
+
+    @ordered
+    def test_pass_chunked_upload_recover(self):
+        """Test should pass and recover the size and offset of an upload from its part file"""
+        upload = settings.uploads.create("recover.ngc", 10)
+        upload.append(io.BytesIO(b"G0 X1\n"))
+        manager = UploadManager(config['storage']['upload_folder'])
+        recovered = manager.get(upload.id)
+        self.assertEqual(recovered.as_dict(), upload.as_dict())
+        self.assertEqual(recovered.sha256.hexdigest(), upload.sha256.hexdigest())
+        os.utime(upload.path, (time.time() - 100, time.time() - 100))
+        UploadManager(config['storage']['upload_folder'], 50)
+        self.assertFalse(os.path.exists(upload.path))
+
+    @ordered
+    def test_pass_get_files(self):
+        """Test should pass and return the files in the upload folder with their analysis"""
+        res = self.client.get('/server/files',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        for name, path in res.json['result']:
+            self.assertIn(name, res.json['analysis'])
+
+    @ordered
+    def test_pass_analyse_file(self):
+        """Test should pass and return the bounds, distances and time of a program with R and I/K arcs in two
+        planes, G91.1 and a drilling cycle"""
+        program = tempfile.NamedTemporaryFile(suffix=".ngc", delete=False)
+        program.write(b"G21 G90 G17\n"
+                      b"G0 X0 Y0 Z5\n"
+                      b"G1 Z0 F600\n"
+                      b"G2 X10 Y0 R5\n"
+                      b"G91.1\n"
+                      b"G1 X20\n"
+                      b"G90.1 G18 G2 X10 Z0 I15 K0\n"
+                      b"G0 Z5\n"
+                      b"G81 X30 Y0 Z-2 R1\n"
+                      b"G80\n"
+                      b"M2\n")
+        program.close()
+        result = analyse_file(program.name, 20, 0, "mm")
+        os.remove(program.name)
+        self.assertEqual(result['lines'], 11)
+        self.assertEqual(result['units'], "mm")
+        self.assertEqual(result['bounds'], {"x": [0, 30], "y": [0, 0], "z": [-2, 5]})
+        # 5 + 5pi + 10 + 5pi + 3 at F600, rapids 5 + 5 + 20 + 4 + 7 at the 20 mm/s velocity limit
+        self.assertEqual(result['cut_distance'], round(18 + 10 * math.pi, 3))
+        self.assertEqual(result['rapid_distance'], 41)
+        self.assertEqual(result['cycle_time'], round((18 + 10 * math.pi) / 10 + 41 / 20., 1))
+        self.assertEqual(result['last_line'], 9)
+
+    @ordered
+    def test_fail_analyse_unreadable_file(self):
+        """Test should fail and report an error instead of pending for a file that can't be read"""
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        analyzer = GcodeAnalyzer(folder, 20, 0)
+        analyzer.sync({"gone.ngc": {"size": 10, "mtime": 1}})
+        self.assertIn("errors", analyzer.result("gone.ngc"))
+        self.assertEqual(analyzer.pending, 0)
+
+    @ordered
+    def test_pass_preview_levels_of_detail(self):
+        """Test should pass and return rapid and cutting polylines without the collinear points, build every file
+        once for concurrent requests, keep only the newest files in the disk cache and build once more when the tiles
+        are gone before they are read"""
+        if toolpathPreview.numpy is None:
+            self.skipTest("numpy is not installed")
+        folder = tempfile.mkdtemp()
+        with open(os.path.join(folder, "square.ngc"), "wb") as program:
+            program.write(b"G0 X0 Y0 Z1\nG1 Z0 F100\nG1 X10\nG1 X20\nG1 Y10\n")
+        with open(os.path.join(folder, "line.ngc"), "wb") as program:
+            program.write(b"G1 X5 F100\n")
+        preview = ToolpathPreview(folder, ["x", "y", "z"], keep=1)
+        builds = []
+        build = preview.build
+
+        def slow_build(name, digest):
+            builds.append(name)
+            time.sleep(0.2)
+            build(name, digest)
+
+        preview.build = slow_build
+        threads = [threading.Thread(target=preview.get, args=("square.ngc", lod))
+                   for lod in range(len(toolpathPreview.LOD_TOLERANCES))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(builds, ["square.ngc"])
+
+        tile = preview.get("square.ngc", 0)
+        self.assertEqual(tile['axes'], ["x", "y", "z"])
+        self.assertEqual(tile['lod'], 0)
+        self.assertEqual(tile['paths'], [
+            {"rapid": True, "points": [[0, 0, 0], [0, 0, 1]]},
+            {"rapid": False, "points": [[0, 0, 1], [0, 0, 0], [20, 0, 0], [20, 10, 0]]}
+        ])
+        square = preview.digest("square.ngc")
+        for lod in range(len(toolpathPreview.LOD_TOLERANCES)):
+            os.utime(toolpathPreview.tile_path(preview.cache_dir, square, lod),
+                     (time.time() - 100, time.time() - 100))
+        preview.get("line.ngc", 3)
+        self.assertFalse(any(name.startswith(square) for name in os.listdir(preview.cache_dir)))
+        self.assertEqual(len(os.listdir(preview.cache_dir)), len(toolpathPreview.LOD_TOLERANCES))
+
+        def pruned_build(name, digest):
+            preview.build = build
+
+        preview.build = pruned_build
+        preview.tiles.clear()
+        self.assertEqual(preview.get("square.ngc", 0)['lod'], 0)
+        self.assertIs(preview.build, build)
+        os.remove(os.path.join(folder, "line.ngc"))
+        self.assertRaises((IOError, OSError), preview.get, "line.ngc", 0)
+        shutil.rmtree(folder)
+
+    @ordered
+    def test_fail_preview_unknown_file(self):
+        """Test should fail because the file isn't in the upload folder"""
+        res = self.client.get('/server/files/unknown.ngc/preview',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert404(res)
+
+    @ordered
+    def test_pass_program_lines(self):
+        """Test should pass and answer 202 while the index of the program is built, then return the numbered
+        lines around the requested line, clipped at the first and the last line"""
+        headers = {"API_KEY": config['security'].get("token")}
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "lines.ngc")
+        with open(path, "wb") as program:
+            program.write(b"".join(b"N%d G1 X%d\n" % (number, number) for number in range(1, 26)))
+        window = settings.program_window
+        settings.program_window = ProgramWindow(folder)
+        settings.program_window.start()
+        loaded = settings.controller.s.file
+        settings.controller.s.file = path
+        try:
+            res = self.client.get('/machinekit/program/lines?line=1&context=3', headers=headers)
+            self.assertStatus(res, 202)
+            self.assertEqual(res.json, {"status": "indexing"})
+            for attempt in range(50):
+                res = self.client.get('/machinekit/program/lines?line=1&context=3', headers=headers)
+                if res.status_code != 202:
+                    break
+                time.sleep(0.05)
+            self.assert200(res)
+            self.assertEqual((res.json['line'], res.json['first'], res.json['total']), (1, 1, 25))
+            self.assertEqual(res.json['lines'], ["N1 G1 X1", "N2 G1 X2", "N3 G1 X3", "N4 G1 X4"])
+            self.assertEqual(res.json['file'], path)
+
+            res = self.client.get('/machinekit/program/lines?line=12&context=1', headers=headers)
+            self.assertEqual(res.json['first'], 11)
+            self.assertEqual(res.json['lines'], ["N11 G1 X11", "N12 G1 X12", "N13 G1 X13"])
+
+            res = self.client.get('/machinekit/program/lines?line=1000&context=2', headers=headers)
+            self.assertEqual((res.json['line'], res.json['first']), (25, 23))
+            self.assertEqual(res.json['lines'], ["N23 G1 X23", "N24 G1 X24", "N25 G1 X25"])
+        finally:
+            settings.controller.s.file = loaded
+            settings.program_window = window
+            shutil.rmtree(folder)
+
+    @ordered
+    def test_pass_program_lines_changed_file(self):
+        """Test should pass and index a program again when it is rewritten in place, not read the old lines"""
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, "lines.ngc")
+        with open(path, "wb") as program:
+            program.write(b"G0 X1\nG0 X2\nG0 X3\n")
+        window = ProgramWindow(folder)
+        self.assertEqual(window.window(path, 2, 5)['lines'], ["G0 X1", "G0 X2", "G0 X3"])
+        with open(path, "r+b") as program:
+            program.truncate(0)
+            program.write(b"G1 Y1\n")
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(window.window(path, 2, 5)['lines'], ["G1 Y1"])
+
+    @ordered
+    def test_fail_program_lines_invalid_context(self):
+        """Test should fail because the context is larger than allowed"""
+        res = self.client.get('/machinekit/program/lines?context=100000',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert400(res)
+
+    @ordered
+    def test_fail_mdi_batch_invalid_command(self):
+        """Test should fail because the second command isn't a single line of G-code"""
+        command = {"commands": ["G21", "X1\nM2"]}
+        res = self.client.post('/machinekit/position/mdi/batch', data=json.dumps(command),
+                               headers={"API_KEY": config['security'].get("token"),
+                                        "Content-Type": "application/json"})
+        self.assert400(res)
+
+    @ordered
+    def test_pass_queue_status(self):
+        """Test should pass and return the state of the file queue runner"""
+        res = self.client.get('/machinekit/queue',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        self.assertEqual(res.json['queue'], settings.file_queue)
+
+    @ordered
+    def test_pass_queue_chains_finished_program(self):
+        """Test should pass and start the next file once the last move was reached, not before"""
+        runner = queue_runner(self, ["a.ngc", "b.ngc"])
+        self.assertEqual(runner.controller.started, ["a.ngc"])
+        self.assertEqual(runner.queue, ["b.ngc"])
+        runner.check(queue_vitals("INTERP_READING", 10))
+        runner.check(queue_vitals("INTERP_IDLE", 10))
+        self.assertEqual(runner.controller.started, ["a.ngc", "b.ngc"])
+        self.assertEqual(runner.queue, [])
+        self.assertEqual(runner.state, "running")
+
+    @ordered
+    def test_pass_queue_chains_unseen_program(self):
+        """Test should pass and start the next file when the program ran between two polls, but not on a
+        snapshot polled before it started"""
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        for name in ["a.ngc", "b.ngc"]:
+            open(os.path.join(folder, name), "w").close()
+        runner = QueueRunner(None, CommandWorker(), StubQueueController(), folder,
+                             ["a.ngc", "b.ngc"], analyzer=StubAnalyzer())
+        with runner.lock:
+            runner.enabled = True
+        polled = time.time()
+        runner.advance()
+        runner.check(queue_vitals("INTERP_IDLE"), polled)
+        self.assertEqual(runner.controller.started, ["a.ngc"])
+        self.assertEqual(runner.state, "running")
+        runner.check(queue_vitals("INTERP_IDLE"), time.time())
+        self.assertEqual(runner.controller.started, ["a.ngc", "b.ngc"])
+        self.assertEqual(runner.queue, [])
+
+    @ordered
+    def test_pass_queue_stops_after_abort(self):
+        """Test should pass and not start the next file when the program is aborted, the machine goes into
+        estop or is turned off"""
+        endings = [
+            [queue_vitals("INTERP_IDLE", 4)],
+            [queue_vitals("INTERP_READING", 10, estop=True),
+             queue_vitals("INTERP_IDLE", 10, estop=True)],
+            [queue_vitals("INTERP_IDLE", 10, task_mode="MODE_MANUAL", enabled=False)]
+        ]
+        for vitals in endings:
+            runner = queue_runner(self, ["a.ngc", "b.ngc"])
+            for snapshot in vitals:
+                runner.check(snapshot)
+            self.assertFalse(runner.enabled)
+            self.assertEqual(runner.controller.started, ["a.ngc"])
+            self.assertEqual(runner.queue, ["b.ngc"])
+
+    @ordered
+    def test_pass_queue_waits_for_confirm(self):
+        """Test should pass and hold the next file until the operator confirms"""
+        runner = queue_runner(self, ["a.ngc", "b.ngc"], confirm=True)
+        runner.check(queue_vitals("INTERP_IDLE", 10))
+        self.assertTrue(runner.waiting())
+        self.assertEqual(runner.controller.started, ["a.ngc"])
+        runner.advance()
+        self.assertEqual(runner.controller.started, ["a.ngc", "b.ngc"])
+        self.assertEqual(runner.queue, [])
+
+    @ordered
+    def test_fail_queue_start_keeps_file(self):
+        """Test should fail to start the next file and keep it in the queue"""
+        runner = queue_runner(self, ["a.ngc", "b.ngc"])
+        runner.controller.fail_start = True
+        runner.check(queue_vitals("INTERP_IDLE", 10))
+        self.assertEqual((runner.enabled, runner.state), (False, "error"))
+        self.assertEqual(runner.queue, ["b.ngc"])
+
+    @ordered
+    def test_fail_queue_confirm_not_waiting(self):
+        """Test should fail because the queue isn't waiting for a confirmation"""
+        command = {"command": "confirm"}
+        res = self.client.post('/machinekit/queue', data=json.dumps(command),
+                               headers={"API_KEY": config['security'].get("token"),
+                                        "Content-Type": "application/json"})
+        self.assertStatus(res, 409)
+
+    @ordered
+    def test_pass_recordings(self):
+        """Test should pass and list the recording of a job and download it"""
+        settings.recorder.check(job_snapshot(1, time.time(), "INTERP_READING"))
+        settings.recorder.check(job_snapshot(2, time.time(), "INTERP_READING"))
+        settings.recorder.check(job_snapshot(3, time.time(), "INTERP_IDLE"))
+        res = self.client.get('/machinekit/recordings',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        recording = res.json['result'][0]
+        self.assertEqual(recording['records'], 2)
+        res = self.client.get('/machinekit/recordings/' + recording['name'],
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        self.assertEqual(len(res.data), recording['header_size'] + 2 * recording['record_size'])
+
+    @ordered
+    def test_pass_recording_skips_mdi(self):
+        """Test should pass and not record MDI commands as job"""
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        recorder = JobRecorder(settings.poller, settings.controller.axes, folder)
+        recorder.check(job_snapshot(1, time.time(), "INTERP_READING", "MODE_MDI"))
+        recorder.check(job_snapshot(2, time.time(), "INTERP_IDLE", "MODE_MDI"))
+        self.assertEqual(recorder.recordings(), [])
+
+    @ordered
+    def test_pass_read_recording(self):
+        """Test should pass and read the records of a job back as NumPy array"""
+        if jobRecorder.numpy is None:
+            self.skipTest("numpy is not installed")
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        recorder = JobRecorder(settings.poller, settings.controller.axes, folder)
+        for version, x in enumerate([1.5, 2.5, 3.5]):
+            recorder.check(job_snapshot(version + 1, 1000 + version, "INTERP_READING", x=x))
+        recorder.finish()
+        name = recorder.recordings()[0]['name']
+        header, records = read_recording(os.path.join(folder, name))
+        self.assertEqual(header['records'], 3)
+        self.assertEqual(header['axes'], settings.controller.axes)
+        self.assertEqual(records['time'].tolist(), [1000, 1001, 1002])
+        self.assertEqual(records[settings.controller.axes[0]].tolist(), [1.5, 2.5, 3.5])
+        self.assertEqual(records['task_mode'].tolist(),
+                         [jobRecorder.TASK_MODES.index("MODE_AUTO") + 1] * 3)
+
+    @ordered
+    def test_pass_recording_rotation(self):
+        """Test should pass and start a new segment when one is full and delete the oldest segments above keep"""
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        recorder = JobRecorder(settings.poller, settings.controller.axes, folder,
+                               capacity=2, keep=3)
+        for version in range(5):
+            recorder.check(job_snapshot(version + 1, 1000 + version, "INTERP_READING"))
+        recorder.check(job_snapshot(6, 1005, "INTERP_IDLE"))
+        first_job = sorted(recorder.list_names())
+        self.assertEqual([name[-7:] for name in first_job], ["000.rec", "001.rec", "002.rec"])
+        self.assertEqual([recording['records'] for recording in reversed(recorder.recordings())],
+                         [2, 2, 1])
+
+        recorder.check(job_snapshot(7, 2000, "INTERP_READING"))
+        recorder.finish()
+        names = sorted(recorder.list_names())
+        self.assertEqual(len(names), 3)
+        self.assertEqual(names[:2], first_job[1:])
+
+    @ordered
+    def test_pass_recording_failure_resets_job(self):
+        """Test should pass and drop a job that can't be recorded, the next job is recorded again"""
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        recorder = JobRecorder(settings.poller, settings.controller.axes, folder)
+        jobRecorder.LOG.disabled = True
+        self.addCleanup(setattr, jobRecorder.LOG, "disabled", False)
+        os.rmdir(folder)
+        recorder.update(job_snapshot(1, 1000, "INTERP_READING"))
+        self.assertIsNone(recorder.job)
+        os.mkdir(folder)
+        recorder.update(job_snapshot(2, 1001, "INTERP_READING"))
+        recorder.finish()
+        self.assertEqual(len(recorder.recordings()), 1)
+
+    @ordered
+    def test_fail_recording_not_found(self):
+        """Test should fail because the recording doesn't exist"""
+        res = self.client.get('/machinekit/recordings/missing.rec',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert404(res)
+
+    @ordered
+    def test_pass_metrics(self):
+        """Test should pass and export request and controller call histograms"""
+        self.client.get('/machinekit/status',
+                        headers={"API_KEY": config['security'].get("token")})
+        res = self.client.get('/metrics',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        body = res.data.decode("utf-8")
+        self.assertIn('webui_request_duration_seconds_count{blueprint="status",'
+                      'endpoint="status.get_machine_status",method="GET"}', body)
+        self.assertIn('webui_controller_call_duration_seconds_bucket{call="stat.poll",le="+Inf"}', body)
+
+    @ordered
+    def test_pass_metrics_retire_thread_shards(self):
+        """Test should pass and keep the counts of threads that ended without keeping their shards"""
+        counter = metrics.Counter("test_total", "Test counter", ("kind", ))
+        threads = [threading.Thread(target=counter.inc, args=(("thread", ), 2)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        counter.inc(("main", ))
+        # The thread locals are cleared just after join returns
+        for attempt in range(50):
+            if len(counter.shards) == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(counter.shards), 1)
+        self.assertEqual(counter.collect(), {("thread", ): [10], ("main", ): [1]})
+
+    @ordered
+    def test_pass_server_timing(self):
+        """Test should pass and return the timing of every stage of a traced request"""
+        command = {"command": 1}
+        res = self.client.post('/machinekit/feed', data=json.dumps(command),
+                               headers={"API_KEY": config['security'].get("token"),
+                                        "Content-Type": "application/json",
+                                        "X-Trace": "1"})
+        self.assert200(res)
+        stages = [timing.split(";")[0] for timing in res.headers["Server-Timing"].split(", ")]
+        for name in ("auth", "validate", "queue", "controller.feedoverride", "total"):
+            self.assertIn(name, stages)
+        self.assertNotIn("Timing-Allow-Origin", res.headers)
+
+    @ordered
+    def test_fail_server_timing_unauthorized(self):
+        """Test should fail authorization and not leak the timing of the request"""
+        res = self.client.get('/machinekit/position', headers={"X-Trace": "1"})
+        self.assert401(res)
+        self.assertNotIn("Server-Timing", res.headers)
+
+    @ordered
+    def test_pass_untraced_request(self):
+        """Test should pass and not add a Server-Timing header without the trace header"""
+        res = self.client.get('/machinekit/position',
+                              headers={"API_KEY": config['security'].get("token")})
+        self.assert200(res)
+        self.assertNotIn("Server-Timing", res.headers)
+
     @ordered
     def test_pass_enable_estop(self):
         """Test should pass and put the machine back in estop modus"""